@@ -34,8 +34,8 @@ import argparse
 # Handle logging.
 import logging
 
-# JSON library to read configuration file.
-import json
+# To read the configuration file (refer to config_loader.py)
+import config_loader
 
 # For a fancy and cross-platform way of getting the home directory for the user.
 from os.path import expanduser
@@ -61,15 +61,11 @@ def main():
         check ~/.ssh/authorized_keys looking for them, if any keys are missing, 
         they will be appended.
     '''
-    # A list to store the SSH keys.
-    key_list = []
-
     # Open and read the JSON file containing the keys.
     try:
-        keys_json_data = json.load(open(keys_file, "r+"))
-        # Add the SSH keys to a list.
-        for item in keys_json_data["keys"]:
-            key_list.append(item["key"])
+        # (Never cached on disk, it decides who can log in.)
+        key_list = config_loader.load(keys_file, 
+            config_loader.compile_ssh_keys, cache=False)
     except Exception as exception:
         log.error("Error reading SSH keys from file. Exception: "\
             "{0}".format(exception))
@@ -78,13 +74,18 @@ def main():
     # Look for every SSH key and add it to authorized_keys if it is not 
     # there already.
     try:
-        for key in key_list:
-            # Open the authorized_keys file in ~/.ssh/
-            with open(authorized_keys_file, "a+") as authorized_keys:
-                if not any(key == line.rstrip("\n") for line in authorized_keys):
+        # Open the authorized_keys file in ~/.ssh/ (once, the keys that are 
+        # already there are looked up in a set).
+        with open(authorized_keys_file, "a+") as authorized_keys:
+            authorized_keys.seek(0)
+            present = set(line.rstrip("\n") for line in authorized_keys)
+            authorized_keys.seek(0, os.SEEK_END)
+            for key in key_list:
+                if key not in present:
                     log.info("Adding key: {0}".format(key))
                     # Append key (And newlines, for aesthetic purposes only).
                     authorized_keys.write("\n" + key + "\n")
+                    present.add(key)
     except Exception as exception:
         log.error("Unable to add key to authorized_keys file. Exception: "\
             "{0}".format(exception))
@@ -0,0 +1,564 @@
+#!/usr/bin/env python
+'''
+    Usage:
+        python benchmark.py [-h] [-k] {hours,reader,joblog,smtp} ...
+
+        python benchmark.py hours [-r ROWS] [-s]
+        python benchmark.py reader [-r ROWS]
+        python benchmark.py joblog [-s SIZE] [-e ERRORS]
+        python benchmark.py smtp [-m MESSAGES] [-l LATENCY]
+
+    Arguments:
+        -h, --help      Show this help message and exit.
+        -k, --keep      Do not remove the synthetic data when finished.
+
+        hours           Compare the old list-based hour check of
+                        findMissingCSR.py with the one-pass hour coverage
+                        bitmap (analyze_csr_file).
+            -r ROWS, --rows ROWS
+                        Number of records in the synthetic CSR file.
+                        Defaults to 2000000.
+            -s, --per-second
+                        Spread the start times over every second of the day
+                        instead of the top of every hour. The old check is
+                        O(records x distinct start times), so this takes
+                        several minutes with the default number of rows.
+
+        reader          Compare csv.reader with csr_reader.py: full parse of
+                        every record, and the date, hour and feed fast paths.
+            -r ROWS, --rows ROWS
+                        Number of records in the synthetic CSR file.
+                        Defaults to 1000000.
+
+        joblog          Compare ET.parse + findall(".//message") with the
+                        streaming scanner of sccm_error_log_emailer.py
+                        (scan_log) on a synthetic jobrunner log. Each one
+                        runs in its own process, and its peak memory is
+                        printed too.
+            -s SIZE, --size SIZE
+                        Approximate size of the synthetic log, in MB.
+                        Defaults to 300.
+            -e ERRORS, --errors ERRORS
+                        Number of ERROR messages in the log. Defaults to 100.
+
+        smtp            Compare one SMTP connection per email (what emailer.py
+                        used to do) with the SMTP session of emailer.py
+                        (SMTPSession.send_many) and the email spool
+                        (email_spool.SpoolSender), against a local stand-in
+                        SMTP server that accepts and discards every email.
+                        The bodies are not ASCII (UTF-8, like a log excerpt),
+                        and every email must arrive once per method.
+            -m MESSAGES, --messages MESSAGES
+                        Number of emails to send. Defaults to 500.
+            -l LATENCY, --latency LATENCY
+                        Milliseconds the stand-in server waits before its
+                        greeting (E.g. a DNS lookup or a TLS handshake of a
+                        real server). Defaults to 0.
+
+    Description:
+        Benchmarks for the performance-sensitive parts of the SCCM tools.
+        Every benchmark generates its own synthetic data in a temporary
+        directory, runs the old and the new implementation against it and
+        prints the elapsed time of each one.
+'''
+
+# Needed for system and environment information.
+import os
+
+# Needed for system and environment information.
+import sys
+
+# Handling arguments.
+import argparse
+
+# The synthetic data lives in a temporary directory.
+import tempfile
+import shutil
+
+# Timing.
+import time
+
+# To generate the synthetic data.
+import random
+
+# The old implementations read the CSR files with the csv module.
+import csv
+
+# Each joblog benchmark runs in its own process (to measure its peak memory).
+import multiprocessing
+import resource
+
+# Handle logging.
+import logging
+
+# The stand-in SMTP server of the smtp benchmark.
+import threading
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+import smtplib
+from email.mime.text import MIMEText
+
+
+# Where findMissingCSR.py writes its log (it must exist before the module is 
+# imported).
+sccm_log_dir = os.path.join(os.sep, "tmp", "logs", "sccm")
+
+# Feed used in the synthetic CSR records.
+SYNTHETIC_FEED = "SBY_US_POWER_nova"
+
+
+def timed(label, function, *args):
+    '''
+        Run function(*args), print how long it took and return its result.
+    '''
+    start = time.time()
+    result = function(*args)
+    print("{0:<50} {1:10.3f} s".format(label, time.time() - start))
+    return result
+
+
+def synthetic_csr_record(date, hour, minute, second):
+    '''
+        Build one MCS-like CSR record (start time in the fourth column,
+        quoted identifier values including the metadata fields).
+    '''
+    return "MCS,{0},{0},{1:02d}:{2:02d}:{3:02d},{1:02d}:{2:02d}:{3:02d},1,6,"\
+        "Feed,\"{4}\",VMName,\"vm-{5:06d}\",ActionInProgress,\"None\","\
+        "NetworkZone,\"zone-1\",TemplateName,\"RHEL7, 64 bit\","\
+        "AccountCode,\"ACCT{6:04d}\",2,CPU,{7},MEMORY,{8}\n".format(
+        date, hour, minute, second, SYNTHETIC_FEED, random.randint(0, 999999),
+        random.randint(0, 9999), random.randint(1, 64),
+        random.randint(1, 512))
+
+
+def write_synthetic_csr(file_name, rows, date="20171123", hourly=True):
+    '''
+        Write a synthetic daily CSR file with rows records spread (in order)
+        over the 24 hours of the day. If hourly is True, every record starts
+        at the top of its hour (like the MCS usage records do), otherwise the
+        start times are spread over every second of the day.
+    '''
+    with open(file_name, "w") as file_handle:
+        for row in range(rows):
+            seconds = row * 86400 // rows
+            if hourly:
+                seconds -= seconds % 3600
+            file_handle.write(synthetic_csr_record(date, seconds // 3600,
+                seconds // 60 % 60, seconds % 60))
+    return file_name
+
+
+def list_hours(full_input_file):
+    '''
+        The hour check findMissingCSR.py used to do: a list of the distinct
+        start times, with a linear membership test for every record.
+    '''
+    file_hours = []
+    with open(full_input_file, "rb") as file_handle:
+        for row in csv.reader(file_handle):
+            if row[3] not in file_hours:
+                file_hours.append(row[3])
+    return file_hours
+
+
+def benchmark_hours(args, work_dir):
+    '''
+        Old list-based hour check vs. the hour coverage bitmap.
+    '''
+    # findMissingCSR.py opens its log file when it is imported.
+    if not os.path.isdir(sccm_log_dir):
+        os.makedirs(sccm_log_dir)
+    import findMissingCSR
+    # Only the hour check is being compared.
+    findMissingCSR.metadata = []
+
+    csr_file = timed("Writing {0} synthetic records".format(args.rows),
+        write_synthetic_csr, os.path.join(work_dir, "20171123.txt"),
+        args.rows, "20171123", not args.per_second)
+    print("Synthetic file size: {0:.1f} MB".format(
+        os.path.getsize(csr_file) / 1048576.0))
+    file_hours = timed("List of distinct start times (old)", list_hours,
+        csr_file)
+    hours = timed("Hour coverage bitmap (analyze_csr_file)",
+        findMissingCSR.analyze_csr_file, csr_file)
+    missing = findMissingCSR.hour_mask(0, 23) & ~hours
+    print("Distinct start times: {0}, hours covered: {1}, missing: "\
+        "{2}".format(len(file_hours), bin(hours).count("1"),
+        bin(missing).count("1")))
+
+
+def read_with(full_input_file, function):
+    '''
+        Apply function to every line of the file, return how many results 
+        were not None.
+    '''
+    count = 0
+    with open(full_input_file, "rb") as file_handle:
+        for line in file_handle:
+            if function(line) is not None:
+                count += 1
+    return count
+
+
+def csv_rows(full_input_file, function):
+    '''
+        Apply function to every row of the file parsed by csv.reader, return 
+        how many results were not None.
+    '''
+    count = 0
+    with open(full_input_file, "rb") as file_handle:
+        for row in csv.reader(file_handle):
+            if function(row) is not None:
+                count += 1
+    return count
+
+
+def csv_feed(row):
+    '''
+        The feed of a csv.reader row (the value after the "Feed" identifier).
+    '''
+    try:
+        return row[row.index("Feed") + 1]
+    except ValueError:
+        return None
+
+
+def record_hour_and_feed(line):
+    '''
+        The hour and the feed of a line, through a (lazy) CSRRecord.
+    '''
+    import csr_reader
+    record = csr_reader.CSRRecord(line)
+    return record.hour, record.feed
+
+
+def benchmark_reader(args, work_dir):
+    '''
+        csv.reader vs. csr_reader, for the full parse and the fast paths.
+    '''
+    import csr_reader
+
+    csr_file = timed("Writing {0} synthetic records".format(args.rows),
+        write_synthetic_csr, os.path.join(work_dir, "20171123.txt"),
+        args.rows, "20171123", False)
+    print("Synthetic file size: {0:.1f} MB".format(
+        os.path.getsize(csr_file) / 1048576.0))
+
+    # Both parsers must agree before their times mean anything.
+    with open(csr_file, "rb") as file_handle:
+        with open(csr_file, "rb") as csv_handle:
+            for line, row in zip(file_handle, csv.reader(csv_handle)):
+                if csr_reader.split_fields(line) != row:
+                    print("csr_reader and csv.reader differ on: {0}".format(
+                        line))
+                    exit(1)
+
+    timed("Reading the lines only", read_with, csr_file, len)
+    timed("Full parse (csv.reader)", csv_rows, csr_file, len)
+    timed("Full parse (csr_reader.split_fields)", read_with, csr_file,
+        csr_reader.split_fields)
+    timed("Date (csv.reader)", csv_rows, csr_file, lambda row: row[1])
+    timed("Date (csr_reader.record_date)", read_with, csr_file,
+        csr_reader.record_date)
+    timed("Hour (csv.reader)", csv_rows, csr_file, lambda row: row[3][:2])
+    timed("Hour (csr_reader.record_hour)", read_with, csr_file,
+        csr_reader.record_hour)
+    timed("Feed (csv.reader)", csv_rows, csr_file, csv_feed)
+    timed("Feed (csr_reader.record_feed)", read_with, csr_file,
+        csr_reader.record_feed)
+    timed("Hour and feed (CSRRecord)", read_with, csr_file,
+        record_hour_and_feed)
+
+
+def write_synthetic_job_log(file_name, size_mb, errors):
+    '''
+        Write a synthetic jobrunner XML log of about size_mb MB, with errors 
+        ERROR messages spread over it. Returns the number of messages.
+    '''
+    message = "        <message time=\"{0}\" type=\"{1}\">Step {2}: "\
+        "processed CSR record {3} of the feed SBY_US_POWER_nova</message>\n"
+    # Roughly the size of one message.
+    messages = size_mb * 1048576 // len(message.format(
+        "2017-11-23 03:00:00", "INFO", 1, 1000000))
+    error_every = max(1, messages // max(1, errors))
+    with open(file_name, "w") as file_handle:
+        file_handle.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"\
+            "<Jobs>\n  <Job name=\"Nightly\" active=\"true\">\n")
+        # (A while loop: in Python 2, range() would build a list of every 
+        # number, which the scanner processes would inherit.)
+        number = 0
+        while number < messages:
+            if number % 10000 == 0:
+                if number:
+                    file_handle.write("    </Step>\n")
+                file_handle.write("    <Step id=\"Step{0}\">\n".format(
+                    number // 10000))
+            file_handle.write(message.format(
+                "2017-11-23 03:{0:02d}:{1:02d}".format(number // 60 % 60, 
+                number % 60), "ERROR" if number % error_every == 0 and 
+                number // error_every < errors else "INFO", 
+                number // 10000, number))
+            number += 1
+        file_handle.write("    </Step>\n  </Job>\n</Jobs>\n")
+    return messages
+
+
+def dom_scan(log_file):
+    '''
+        What sccm_error_log_emailer.py used to do: build the whole tree and 
+        look for the ERROR messages.
+    '''
+    import xml.etree.ElementTree as ET
+    root = ET.parse(log_file).getroot()
+    job_name = root.find("./Job").get("name")
+    error_message = []
+    for message in root.findall(".//message"):
+        if message.get("type").strip() == "ERROR":
+            error_message.append("Timestamp: {0} Message: "\
+                "{1}".format(message.get("time"), message.text))
+    return job_name, error_message
+
+
+def stream_scan(log_file):
+    '''
+        The streaming scanner of sccm_error_log_emailer.py.
+    '''
+    import sccm_error_log_emailer
+    return sccm_error_log_emailer.scan_log(log_file)
+
+
+def scan_in_process(arguments):
+    '''
+        Run one of the scanners and return how long it took, its peak memory 
+        (in MB) and the number of ERROR messages it found.
+    '''
+    scanner, log_file = arguments
+    start = time.time()
+    job_name, error_message = scanner(log_file)
+    return (time.time() - start, 
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 
+        len(error_message))
+
+
+def benchmark_joblog(args, work_dir):
+    '''
+        ET.parse of the whole log vs. the streaming (iterparse) scanner.
+    '''
+    log_file = os.path.join(work_dir, "Nightly_20171123.xml")
+    messages = timed("Writing a synthetic log of about {0} MB".format(
+        args.size), write_synthetic_job_log, log_file, args.size, args.errors)
+    print("Synthetic log size: {0:.1f} MB, {1} messages".format(
+        os.path.getsize(log_file) / 1048576.0, messages))
+    for label, scanner in (("ET.parse + findall (old)", dom_scan), 
+        ("Streaming scan_log (iterparse)", stream_scan)):
+        # A new process for each scanner, so ru_maxrss is its own.
+        pool = multiprocessing.Pool(1)
+        try:
+            elapsed, peak_memory, errors = pool.apply(scan_in_process, 
+                ((scanner, log_file),))
+        finally:
+            pool.close()
+            pool.join()
+        print("{0:<50} {1:10.3f} s {2:10.1f} MB peak, {3} errors".format(
+            label, elapsed, peak_memory, errors))
+
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    '''
+        Just enough SMTP for smtplib: every command is accepted, and the 
+        emails are counted and discarded.
+    '''
+    def handle(self):
+        time.sleep(self.server.latency)
+        self.wfile.write(b"220 localhost stand-in SMTP server\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b"EHLO", b"HELO"):
+                self.wfile.write(b"250 localhost\r\n")
+            elif command == b"DATA":
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b".\r\n":
+                        break
+                self.server.messages += 1
+                self.wfile.write(b"250 OK\r\n")
+            elif command == b"QUIT":
+                self.wfile.write(b"221 Bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 OK\r\n")
+
+
+class StandInSMTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, latency):
+        socketserver.TCPServer.__init__(self, ("127.0.0.1", 0), 
+            StandInSMTPHandler)
+        self.latency = latency
+        self.messages = 0
+
+
+def connection_per_email(server, messages):
+    '''
+        What emailer.py used to do: a new connection for every email.
+    '''
+    for email_from, email_to, message in messages:
+        connection = smtplib.SMTP(server)
+        connection.sendmail(email_from, email_to, message)
+        connection.quit()
+
+
+def session_batch(server, messages):
+    '''
+        The SMTP session of emailer.py.
+    '''
+    import emailer
+    # (One line per email sent would be timed too.)
+    emailer.log.setLevel(logging.WARNING)
+    session = emailer.SMTPSession(server)
+    try:
+        return session.send_many(messages)
+    finally:
+        session.close()
+
+
+def spool_sender(server, messages, work_dir):
+    '''
+        The email spool: every email is queued (written to the spool and read
+        back) and delivered by a SpoolSender.
+    '''
+    import emailer
+    import email_spool
+    emailer.log.setLevel(logging.WARNING)
+    email_spool.log.setLevel(logging.WARNING)
+    spool = email_spool.Spool(os.path.join(work_dir, "email_spool"))
+    for email_from, email_to, message in messages:
+        spool.enqueue(email_from, email_to, message)
+    email_spool.SpoolSender(spool, lambda: emailer.SMTPSession(server)).run()
+
+
+def benchmark_smtp(args, work_dir):
+    smtp_server = StandInSMTPServer(args.latency / 1000.0)
+    thread = threading.Thread(target=smtp_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server = "{0}:{1}".format(*smtp_server.server_address)
+    try:
+        messages = []
+        for index in range(args.messages):
+            text = u"Synthetic notification {0}, r\u00e9sum\u00e9.\n".format(
+                index) * 20
+            if sys.version_info[0] < 3:
+                # What emailer.py builds under Python 2: an 8-bit str body.
+                text = text.encode("utf-8")
+            message = MIMEText(text, "plain")
+            message["Subject"] = "Benchmark email {0}".format(index)
+            messages.append(("benchmark@localhost", ["billing@localhost"], 
+                message.as_string()))
+        print("{0} emails, {1} ms of server latency per connection".format(
+            args.messages, args.latency))
+        for label, function, extra in (("One connection per email", 
+            connection_per_email, ()), ("SMTPSession.send_many", 
+            session_batch, ()), ("email_spool.SpoolSender", spool_sender, 
+            (work_dir,))):
+            start = time.time()
+            timed(label, function, server, messages, *extra)
+            print("{0:<50} {1:10.0f} emails/s".format("", 
+                args.messages / (time.time() - start)))
+    finally:
+        smtp_server.shutdown()
+        smtp_server.server_close()
+    print("The stand-in server received {0} emails (expected {1})".format(
+        smtp_server.messages, 3 * args.messages))
+    if smtp_server.messages != 3 * args.messages:
+        sys.exit(1)
+
+
+def get_args(argv):
+    '''
+        Get, validate and parse arguments.
+    '''
+    parser = argparse.ArgumentParser(description="Benchmarks for the SCCM "\
+        "tools.")
+    parser.add_argument("-k", "--keep",
+        help = "Do not remove the synthetic data when finished.",
+        dest = "keep",
+        default = False,
+        action = "store_true")
+    subparsers = parser.add_subparsers(dest = "benchmark")
+
+    hours_parser = subparsers.add_parser("hours",
+        help = "findMissingCSR hour check: list vs. coverage bitmap.")
+    hours_parser.add_argument("-r", "--rows",
+        help = "Number of records in the synthetic CSR file.",
+        dest = "rows",
+        default = 2000000,
+        type = int)
+    hours_parser.add_argument("-s", "--per-second",
+        help = "Spread the start times over every second of the day instead "\
+            "of the top of every hour (the old check gets very slow).",
+        dest = "per_second",
+        default = False,
+        action = "store_true")
+    hours_parser.set_defaults(function = benchmark_hours)
+
+    reader_parser = subparsers.add_parser("reader",
+        help = "CSR record parsing: csv.reader vs. csr_reader.")
+    reader_parser.add_argument("-r", "--rows",
+        help = "Number of records in the synthetic CSR file.",
+        dest = "rows",
+        default = 1000000,
+        type = int)
+    reader_parser.set_defaults(function = benchmark_reader)
+
+    joblog_parser = subparsers.add_parser("joblog",
+        help = "Jobrunner log scan: ET.parse vs. streaming iterparse.")
+    joblog_parser.add_argument("-s", "--size",
+        help = "Approximate size of the synthetic log, in MB.",
+        dest = "size",
+        default = 300,
+        type = int)
+    joblog_parser.add_argument("-e", "--errors",
+        help = "Number of ERROR messages in the log.",
+        dest = "errors",
+        default = 100,
+        type = int)
+    joblog_parser.set_defaults(function = benchmark_joblog)
+
+    smtp_parser = subparsers.add_parser("smtp",
+        help = "Email delivery: one connection per email vs. SMTP session.")
+    smtp_parser.add_argument("-m", "--messages",
+        help = "Number of emails to send.",
+        dest = "messages",
+        default = 500,
+        type = int)
+    smtp_parser.add_argument("-l", "--latency",
+        help = "Milliseconds the stand-in server waits before its greeting.",
+        dest = "latency",
+        default = 0,
+        type = int)
+    smtp_parser.set_defaults(function = benchmark_smtp)
+
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix="sccm_benchmark_")
+    try:
+        args.function(args, work_dir)
+    finally:
+        if args.keep:
+            print("Synthetic data kept in {0}".format(work_dir))
+        else:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    # Parse arguments from the CLI.
+    get_args(sys.argv[1:])
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+'''
+    Usage:
+        import config_loader
+
+        # The parsed JSON file.
+        config = config_loader.load("/path/to/deploy_config.json")
+
+        # Compiled (E.g. indexed) by a function of the data.
+        mail_list = config_loader.load(mail_list_file,
+            config_loader.compile_mail_list)
+        group = mail_list["groups"].get("Job_failures")
+
+    Description:
+        The JSON configuration files of the SCCM tools (mailList.json,
+        regions.json, connection_parameters.json, sccm_ssh_keys.json and
+        deploy_config.json), loaded in one place.
+        A file is parsed (and compiled) once per process: later calls only
+        stat it, and load it again if its modification time or size changed.
+        The compiled form is also cached on disk (config_cache_dir), along
+        with the modification time, size and SHA-1 of the file, so the next
+        executions of the tools reuse it while the file does not change
+        (a file that was touched, but whose contents are the same, is
+        recognized by its hash). The cache directory belongs to the user
+        running the tool (config_cache_<uid>), and the cache is only used if
+        that directory, and every cache file, is owned by that user and not
+        accessible by anyone else; otherwise the files are parsed every time.
+        Files with secrets, or that decide what runs as root or who can log
+        in (connection_parameters.json, deploy_config.json and
+        sccm_ssh_keys.json), are loaded with cache=False, so they are always
+        read from the file itself.
+        The compiled configurations are shared by every caller of the
+        process: they must not be modified.
+'''
+
+# Needed for system and environment information.
+import os
+
+# Parsing the configuration files and the cache.
+import json
+
+# To validate the cache.
+import hashlib
+
+# To check the owner and the permissions of the cache.
+import stat
+
+# To check the dates of regions.json.
+from datetime import datetime
+
+# Handle logging.
+import logging
+
+
+# Where the compiled configurations are cached (one directory per user, only
+# accessible by that user).
+config_cache_dir = os.path.join(os.sep, "tmp", "logs", "sccm",
+    "config_cache_{0}".format(os.getuid()))
+
+# Change this when the cached data changes, so old caches are ignored.
+CACHE_VERSION = 1
+
+# Logging configuration.
+log = logging.getLogger("config_loader")
+
+# The configurations loaded by this process:
+# {(path, compiler name): ((mtime, size), compiled)}
+loaded = {}
+
+
+def compile_json(data):
+    '''
+        The default compiler: the parsed JSON as it is.
+    '''
+    return data
+
+
+def compile_mail_list(data):
+    '''
+        mailList.json, with its groups indexed by name ({"groups": {name:
+        group}}).
+    '''
+    return {"groups": dict((group["name"], group)
+        for group in data["groups"])}
+
+
+def compile_regions(data):
+    '''
+        regions.json as {"prod": [[name, "YYYY-MM-DD"]], "non_prod":
+        [name]}: the prod regions, with the date they became prod (checked
+        and normalized here, so it can be compared with date.isoformat()),
+        and every region of the other types.
+    '''
+    prod = []
+    non_prod = []
+    for region in data["regions"]:
+        for subregion in region["regions"]:
+            if region["type"] == "prod":
+                prod.append([subregion["name"], datetime.strptime(
+                    subregion["date"], "%Y-%m-%d").date().isoformat()])
+            else:
+                non_prod.append(subregion["name"])
+    return {"prod": prod, "non_prod": non_prod}
+
+
+def compile_ssh_keys(data):
+    '''
+        sccm_ssh_keys.json as the list of keys.
+    '''
+    return [item["key"] for item in data["keys"]]
+
+
+def compiler_name(compiler):
+    return "{0}.{1}".format(compiler.__module__, compiler.__name__)
+
+
+def cache_file_for(config_file):
+    '''
+        The cache file of config_file (named after the file and a hash of
+        its full path).
+    '''
+    path_hash = hashlib.sha1(os.path.abspath(config_file).encode(
+        "utf-8")).hexdigest()[:12]
+    return os.path.join(config_cache_dir, "{0}.{1}.json".format(
+        os.path.basename(config_file), path_hash))
+
+
+def owner_only(file_stat):
+    '''
+        True if file_stat is of a file owned by the running user, that
+        nobody else can read or write.
+    '''
+    return file_stat.st_uid == os.getuid() and \
+        not stat.S_IMODE(file_stat.st_mode) & 0o077
+
+
+def cache_dir_usable():
+    '''
+        Create config_cache_dir (only accessible by its owner) if it does
+        not exist. Returns False if it cannot be trusted (E.g. it was
+        created by another user, or it is a link), so the cache is not used.
+    '''
+    try:
+        if not os.path.lexists(config_cache_dir):
+            parent_dir = os.path.dirname(config_cache_dir)
+            if not os.path.isdir(parent_dir):
+                os.makedirs(parent_dir)
+            try:
+                os.mkdir(config_cache_dir, 0o700)
+            except OSError:
+                # Created by another process in the meantime.
+                if not os.path.lexists(config_cache_dir):
+                    raise
+        dir_stat = os.lstat(config_cache_dir)
+    except OSError as exception:
+        log.warning("Unable to use config cache {0}. Exception: "\
+            "{1}".format(config_cache_dir, exception))
+        return False
+    if not stat.S_ISDIR(dir_stat.st_mode) or not owner_only(dir_stat):
+        log.warning("Not using config cache {0}: it must be a directory "\
+            "only accessible by its owner (uid {1}).".format(
+            config_cache_dir, os.getuid()))
+        return False
+    return True
+
+
+def read_cache(cache_file):
+    '''
+        The cache in cache_file, or None if there is none (or it is not
+        owned by the running user, or others can access it).
+    '''
+    try:
+        file_descriptor = os.open(cache_file,
+            os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+    except OSError as exception:
+        if os.path.lexists(cache_file):
+            log.warning("Ignoring unreadable config cache {0}. Exception: "\
+                "{1}".format(cache_file, exception))
+        return None
+    with os.fdopen(file_descriptor) as file_handle:
+        if not owner_only(os.fstat(file_descriptor)):
+            log.warning("Ignoring config cache {0}: it is not only "\
+                "accessible by its owner (uid {1}).".format(cache_file, 
+                os.getuid()))
+            return None
+        try:
+            return json.load(file_handle)
+        except ValueError as exception:
+            log.warning("Ignoring unreadable config cache {0}. Exception: "\
+                "{1}".format(cache_file, exception))
+            return None
+
+
+def write_cache(cache_file, cache):
+    '''
+        Write the cache (only readable by its owner, the configurations may
+        have addresses or hostnames).
+    '''
+    temporary_file = cache_file + ".tmp"
+    try:
+        file_descriptor = os.open(temporary_file,
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(file_descriptor, "w") as file_handle:
+            json.dump(cache, file_handle)
+        os.rename(temporary_file, cache_file)
+    except (IOError, OSError) as exception:
+        log.warning("Unable to write config cache {0}. Exception: "\
+            "{1}".format(cache_file, exception))
+
+
+def load(config_file, compiler=compile_json, cache=True):
+    '''
+        Return the configuration of config_file (a JSON file) compiled by
+        compiler. Errors reading or parsing the file are raised (IOError,
+        OSError, ValueError, or whatever compiler raises).
+    '''
+    name = compiler_name(compiler)
+    file_stat = os.stat(config_file)
+    stamp = [file_stat.st_mtime, file_stat.st_size]
+    entry = loaded.get((config_file, name))
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+
+    key = [CACHE_VERSION, name] + stamp
+    cache = cache and cache_dir_usable()
+    cache_file = cache_file_for(config_file) if cache else None
+    cached = read_cache(cache_file) if cache else None
+    if cached is not None and cached.get("key") == key:
+        compiled = cached["compiled"]
+    else:
+        with open(config_file, "rb") as file_handle:
+            contents = file_handle.read()
+        content_hash = hashlib.sha1(contents).hexdigest()
+        if cached is not None and cached.get("key", [])[:2] == key[:2] and \
+            cached.get("hash") == content_hash:
+            # Touched, but not changed.
+            compiled = cached["compiled"]
+        else:
+            log.info("Parsing {0}".format(config_file))
+            compiled = compiler(json.loads(contents.decode("utf-8")))
+        if cache:
+            write_cache(cache_file, {"key": key, "hash": content_hash,
+                "compiled": compiled})
+    loaded[(config_file, name)] = (stamp, compiled)
+    return compiled
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+'''
+    Usage:
+        import coverage_store
+
+        store = coverage_store.CoverageStore("/path/to/coverage.dat")
+        store.set("SBY_US_POWER_nova", datetime.date(2017, 11, 23), hours)
+        hours = store.get("SBY_US_POWER_nova", datetime.date(2017, 11, 23))
+        for day, hours in store.history("SBY_US_POWER_nova", start, end):
+            ...
+        store.close()
+
+    Description:
+        A compact, memory-mapped store of the hour coverage bitmaps that
+        findMissingCSR.py computes for every (provider, day), so questions
+        like "which hours were missing last month for feed X" can be answered
+        without reading the CSR files again.
+
+        File layout:
+            Header: magic (8 bytes), days per slot (uint32), reserved (uint32)
+            One slot per provider:
+                Provider name (64 bytes, NUL padded)
+                DAYS_PER_SLOT entries: day (int32, date.toordinal(), 0 if
+                empty) and hour bitmap (uint32, bit N = hour N covered).
+
+        Every day is stored in entry (day % DAYS_PER_SLOT), so each provider
+        keeps the last DAYS_PER_SLOT days (about 17 months) and older days
+        are overwritten. An entry is only valid if its stored day matches.
+        Each slot is 4160 bytes, so even hundreds of providers take a few MB.
+        Several processes can use the store at the same time: writers hold
+        an flock on the file while they add a slot or set an entry, and the
+        slot table is read again (the file mapped again) when a provider is
+        not found, since another process may have added it.
+'''
+
+# Needed for system and environment information.
+import os
+
+# Memory mapping of the store.
+import mmap
+
+# Locking of the store between writers.
+import fcntl
+
+# Packing of the header and the entries.
+import struct
+
+# Iterating over days.
+import datetime
+
+
+MAGIC = b"SCCMCOV1"
+HEADER = struct.Struct("<8sII")
+ENTRY = struct.Struct("<iI")
+NAME_SIZE = 64
+
+# How many days every provider keeps.
+DAYS_PER_SLOT = 512
+
+
+class CoverageStore(object):
+    '''
+        A memory-mapped file of hour coverage bitmaps per (provider, day).
+        The file is created if it does not exist.
+    '''
+    def __init__(self, path, days_per_slot=DAYS_PER_SLOT):
+        self.path = path
+        self.file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o666),
+            "r+b")
+        # (Locked, so only one process writes the header of a new store.)
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            header = self.file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                self.file.seek(0)
+                self.file.truncate()
+                self.file.write(HEADER.pack(MAGIC, days_per_slot, 0))
+                self.file.flush()
+                header = HEADER.pack(MAGIC, days_per_slot, 0)
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        magic, self.days_per_slot, reserved = HEADER.unpack(header)
+        if magic != MAGIC:
+            self.file.close()
+            raise ValueError("{0} is not a coverage store.".format(path))
+        self.slot_size = NAME_SIZE + self.days_per_slot * ENTRY.size
+        self.map = None
+        self._map()
+
+        # Provider name -> slot number.
+        self.slots = {}
+        self._load_slots()
+
+    def _map(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(),
+            os.fstat(self.file.fileno()).st_size)
+
+    def _slot_count(self):
+        return (len(self.map) - HEADER.size) // self.slot_size
+
+    def _load_slots(self):
+        '''
+            Read the slots added since the slot table was last read (mapping
+            the file again if another process added any). Slots are only
+            ever appended.
+        '''
+        if os.fstat(self.file.fileno()).st_size != len(self.map):
+            self._map()
+        for slot in range(len(self.slots), self._slot_count()):
+            offset = HEADER.size + slot * self.slot_size
+            name = self.map[offset:offset + NAME_SIZE].rstrip(b"\0")
+            self.slots[name.decode("utf-8")] = slot
+
+    def _slot(self, provider, create=False):
+        '''
+            Return the slot number of provider (adding a new slot at the end
+            of the file if create is True, which needs the lock), or None.
+        '''
+        slot = self.slots.get(provider)
+        if slot is None:
+            # It may have been added by another process.
+            self._load_slots()
+            slot = self.slots.get(provider)
+        if slot is None and create:
+            name = provider.encode("utf-8")
+            if len(name) > NAME_SIZE:
+                raise ValueError("Provider name too long: {0}".format(
+                    provider))
+            slot = self._slot_count()
+            offset = HEADER.size + slot * self.slot_size
+            self.map.flush()
+            self.file.seek(offset)
+            self.file.write(name.ljust(self.slot_size, b"\0"))
+            self.file.flush()
+            self._map()
+            self.slots[provider] = slot
+        return slot
+
+    def _offset(self, slot, day_number):
+        return (HEADER.size + slot * self.slot_size + NAME_SIZE +
+            (day_number % self.days_per_slot) * ENTRY.size)
+
+    def set(self, provider, day, hours):
+        '''
+            Store the hour coverage bitmap of provider for day (a date).
+        '''
+        day_number = day.toordinal()
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            # (The slot must be created before self.map is used, since
+            # adding a slot maps the file again.)
+            offset = self._offset(self._slot(provider, True), day_number)
+            ENTRY.pack_into(self.map, offset, day_number, hours)
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def get(self, provider, day):
+        '''
+            Return the hour coverage bitmap of provider for day, or None if
+            that day was never checked (or is older than the store keeps).
+        '''
+        slot = self._slot(provider)
+        if slot is None:
+            return None
+        day_number = day.toordinal()
+        stored_day, hours = ENTRY.unpack_from(self.map,
+            self._offset(slot, day_number))
+        if stored_day != day_number:
+            return None
+        return hours
+
+    def history(self, provider, start_date, end_date):
+        '''
+            Yield (day, hours) for every day from start_date to end_date
+            (inclusive). hours is None for the days that were not checked.
+        '''
+        day = start_date
+        while day <= end_date:
+            yield day, self.get(provider, day)
+            day += datetime.timedelta(days=1)
+
+    def providers(self):
+        return sorted(self.slots)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        self.file.close()
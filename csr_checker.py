@@ -11,13 +11,20 @@
         python csr_checker.py -y|--year YYYY 
             -m|--month CURMON|PREMON|MM (01-12) 
             -d|--day DD (01-31)
+        python csr_checker.py -w|--watch [-r|--reconcile-interval SECONDS]
+        python csr_checker.py --from CCYYMMDD [--to CCYYMMDD]
+            [--matrix-format {csv,json}] [--matrix-file MATRIX_FILE]
 
         csr_checker.py [-h] [-y YEAR] -m
                             {01,02,03,04,05,06,07,08,09,10,11,12,PREMON,CURMON}
                             [-d {01,02,03,04,05,06,07,08,09,10,
                                 11,12,13,14,15,16,17,18,19,20,
                                 21,22,23,24,25,26,27,28,29,30,31}]
-                            [-v]
+                            [-v] [-w] [-r RECONCILE_INTERVAL]
+                            [--from FROM_DATE] [--to TO_DATE]
+                            [--matrix-format {csv,json}]
+                            [--matrix-file MATRIX_FILE] [-c]
+                            [-j CONCURRENCY]
 
         optional arguments:
             -h, --help          show this help message and exit
@@ -31,7 +38,40 @@
                                 The two-digit number of the day.
             -v, --verbose       Using -v/--verbose will print INFO, WARNING, 
                                 and ERROR messages to the stdout or stderr.
-
+            -w, --watch         Keep running and copy every CSR file to its 
+                                collector's destination as soon as it is 
+                                written (Linux only, uses inotify). -m/--month 
+                                is not required in this mode.
+            -r RECONCILE_INTERVAL, --reconcile-interval RECONCILE_INTERVAL
+                                In watch mode, how often (in seconds) to look 
+                                for CSR files of today and yesterday that were 
+                                not copied yet. Defaults to 900.
+            --from FROM_DATE    Check all the days from this date (CCYYMMDD) 
+                                up to the --to date in one pass, and write a 
+                                coverage matrix (satellite x day, per job) 
+                                instead of one error per missing file.
+            --to TO_DATE        The last date (CCYYMMDD) to check with --from.
+                                Defaults to yesterday.
+            --matrix-format {csv,json}
+                                The format of the coverage matrix. Defaults 
+                                to csv.
+            --matrix-file MATRIX_FILE
+                                Where to write the coverage matrix (it is 
+                                attached to the notification email). Defaults 
+                                to the stdout.
+            -c, --checksum      Checksum the files while they are copied 
+                                (the source is read only once), verify the 
+                                copies and keep the checksums in a 
+                                .csr_checksums.json manifest in every 
+                                collectors directory. Copies that still match 
+                                their manifest entry are not copied again, 
+                                and copies that no longer match are reported.
+            -j CONCURRENCY, --concurrency CONCURRENCY
+                                How many stat/listdir calls to issue at the 
+                                same time while looking for the CSR files 
+                                (useful on NFS mounts, where every call is a 
+                                network round trip). Defaults to 16. 1 checks 
+                                the files one after another.
 
         Examples:
             Checking all the files in a specific date (February 20th, 2015):
@@ -46,10 +86,18 @@
             Checking all the files in the current month up to yesterday:
                 python csr_checker.py -m CURMON
 
+            Checking a whole quarter and saving the coverage matrix:
+                python csr_checker.py --from 20170101 --to 20170331 \\
+                    --matrix-file /tmp/csr_coverage.csv
+
+            Copying the CSR files as soon as they are uploaded:
+                python csr_checker.py --watch
+
     Return codes:
         0 - Everything went fine. No missing files.
         1 - At least one CSR file is missing. Notification email was sent.
-        2 - The user provided an invalidad date to check (E.g. 2017-02-31).
+        2 - The user provided an invalidad date to check (E.g. 2017-02-31),
+            or a --from date after the --to date.
 
     Author:
         Alan Verdugo (alanvemu@mx1.ibm.com)
@@ -109,7 +157,26 @@ import glob
 import argparse
 
 # Copying of files (using copy2, metadata is copied as well).
-from shutil import copy2
+from shutil import copy2, copystat
+
+# Checksums of the copied files.
+import hashlib
+
+# Locking of the checksum manifests between checkers.
+import fcntl
+
+# Concurrent stat calls (the upload trees may be NFS mounts).
+from multiprocessing.pool import ThreadPool
+
+# scandir() avoids one stat per directory entry, but it is only part of the 
+# standard library since Python 3.5 (otherwise it is the scandir package).
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # Needed for system and environment information.
 import socket
@@ -117,9 +184,25 @@ import socket
 # Custom module for email sending (refer to emailer.py)
 import emailer
 
+# Custom module for collecting the errors (refer to error_sink.py)
+import error_sink
+
 # Handle output.
 import logging
 
+# To match the CSR filenames (CCYYMMDD.txt).
+import re
+
+# For the reconciliation interval of the watch mode.
+import time
+
+# Watching the upload directories (refer to inotify_watcher.py).
+import inotify_watcher
+
+# Writing the coverage matrix.
+import csv
+import json
+
 
 ## Environmental variables.
 
@@ -138,15 +221,54 @@ dest_path = os.path.join(sccm_home, "samples", "logs", "collectors")
 # The path where this script and the distribution list are located.
 binary_home = os.path.join(sccm_home, "bin", "custom")
 
+# The jobs (directories inside CSR_path) that we collect CSR files from.
+job_names = ["consolidation_backups",
+    "consolidation_cinder_volume",
+    "consolidation_nova_compute"]
+
+# CSR filenames are the date of the data they contain (E.g. 20170711.txt).
+csr_filename = re.compile(r"^\d{8}\.txt$")
+
+# inotify events for the watch mode. In the job directories we only care 
+# about new satellite directories, in the satellite directories we care about 
+# files that were completely written (or moved into place).
+job_events = (inotify_watcher.IN_CREATE | inotify_watcher.IN_MOVED_TO |
+    inotify_watcher.IN_ONLYDIR)
+satellite_events = (inotify_watcher.IN_CLOSE_WRITE | 
+    inotify_watcher.IN_MOVED_TO | inotify_watcher.IN_ONLYDIR)
+
+# How often (in seconds) the watch mode reconciles the upload and the 
+# collectors directories, in case any inotify event was lost.
+reconcile_interval = 900
+
+# If True (-c/--checksum), files are checksummed while they are copied, the 
+# copy is verified and the checksum is stored in a sidecar manifest in every 
+# collectors directory.
+checksum_copies = False
+
+# The name of the sidecar manifest, and the size of the chunks that are 
+# read, checksummed and written while copying.
+manifest_filename = ".csr_checksums.json"
+copy_chunk_size = 1024 * 1024
+
+# How many stat/listdir calls are issued at the same time while looking for 
+# the CSR files (-j/--concurrency). On NFS, every call is a network round 
+# trip, so they are much faster in parallel. 1 disables the thread pool.
+scan_concurrency = 16
+
+# The thread pool for those calls (created the first time it is needed).
+scan_pool = None
+
+# The manifests read so far (destination_directory -> (stamp, dict)), so 
+# every manifest is only read again when another process replaced it.
+manifests = {}
+
 # Sender address.
 email_from = "SCCM@" + hostname
 
-# Error checking.
-error_found = False
-error = ""
-
-# A list to which we will append error messages.
-error_message = []
+# The errors found (streamed to a spool file, only their counters and the 
+# first few messages are kept in memory).
+errors = error_sink.ErrorSink("csr_checker")
 
 # Email distribution group.
 distribution_group = "CSR_checker"
@@ -161,6 +283,8 @@ def get_args(argv):
     month = None
     day = None
     global curmon
+    global checksum_copies
+    global scan_concurrency
     curmon = None
 
     parser = argparse.ArgumentParser()
@@ -172,10 +296,8 @@ def get_args(argv):
         help = "The two-digit number of the month (01-12). PREMON will check \
             the previous month. CURMON the current month",
         dest = "month",
-        default = "PREMON",
         choices = ['01','02','03','04','05','06','07','08','09','10','11',
-            '12','PREMON','CURMON'],
-        required = True)
+            '12','PREMON','CURMON'])
     parser.add_argument("-d","--day",
         help = "The two-digit number of the day.",
         dest = "day",
@@ -189,8 +311,83 @@ def get_args(argv):
         default = False,
         required = False,
         action = "store_true")
+    parser.add_argument("-w","--watch",
+        help = "Keep running and copy every CSR file to its collector's \
+            destination as soon as it is written (uses inotify).",
+        dest = "watch",
+        default = False,
+        action = "store_true")
+    parser.add_argument("-r","--reconcile-interval",
+        help = "In watch mode, how often (in seconds) to look for CSR files \
+            that were not copied yet. Defaults to {0}.".format(
+            reconcile_interval),
+        dest = "reconcile_interval",
+        default = reconcile_interval,
+        type = int)
+    parser.add_argument("--from",
+        help = "Check all the days from this date (CCYYMMDD) up to the --to \
+            date, in one pass.",
+        dest = "from_date",
+        type = parse_date)
+    parser.add_argument("--to",
+        help = "The last date (CCYYMMDD) to check with --from. Defaults to \
+            yesterday.",
+        dest = "to_date",
+        type = parse_date)
+    parser.add_argument("--matrix-format",
+        help = "The format of the coverage matrix written by --from/--to. \
+            Defaults to csv.",
+        dest = "matrix_format",
+        default = "csv",
+        choices = ["csv", "json"])
+    parser.add_argument("--matrix-file",
+        help = "Where to write the coverage matrix (it is attached to the \
+            notification email). Defaults to the stdout.",
+        dest = "matrix_file")
+    parser.add_argument("-c","--checksum",
+        help = "Checksum the files while they are copied, verify the copies \
+            and keep the checksums in a manifest in every collectors \
+            directory.",
+        dest = "checksum",
+        default = False,
+        action = "store_true")
+    parser.add_argument("-j","--concurrency",
+        help = "How many stat/listdir calls to issue at the same time while \
+            looking for the CSR files. Defaults to {0}.".format(
+            scan_concurrency),
+        dest = "concurrency",
+        default = scan_concurrency,
+        type = int)
     args = parser.parse_args()
 
+    checksum_copies = args.checksum
+    scan_concurrency = max(1, args.concurrency)
+
+    if args.verbose:
+        log.setLevel(logging.INFO)
+
+    # The watch mode does not check any specific date.
+    if args.watch:
+        watch(args.reconcile_interval)
+        return
+    elif args.from_date:
+        if args.month or args.day:
+            parser.error("--from/--to cannot be used with -m/--month or "\
+                "-d/--day")
+        if args.to_date is None:
+            args.to_date = datetime.date.today() - datetime.timedelta(days=1)
+        if args.from_date > args.to_date:
+            logging.error("The --from date must not be after the --to "\
+                "date.\n")
+            exit(2)
+        main_range(args.from_date, args.to_date, args.matrix_format, 
+            args.matrix_file)
+        return
+    elif args.to_date:
+        parser.error("--to requires --from")
+    elif args.month is None:
+        parser.error("argument -m/--month is required")
+
     # If the month argument is "PREMON", get the current month and year and 
     # calculate the previous month.
     if args.month == "PREMON":
@@ -216,102 +413,455 @@ def get_args(argv):
             logging.error("Provided date is invalid.\n")
             exit(2)
 
+    main(args.year, args.month, args.day)
 
-    if args.verbose:
-        log.setLevel(logging.INFO)
 
-    main(args.year, args.month, args.day)
+def handle_error(error, category="Error"):
+    '''
+        Log the error and add it to the errors sink (which will be used to 
+        build the notification email).
+    '''
+    log.error(error)
+    errors.add(error, category)
+
+
+def collect_file(CSR_full_path, destination_directory, 
+    destination_ready=False):
+    '''
+        Copy a CSR file to its collector's destination directory (creating 
+        the directory if it does not exist). If the caller already verified 
+        that the destination directory exists and is writeable, 
+        destination_ready skips those checks.
+    '''
+    log.info("Copying file {0} to final destination...".format(
+        CSR_full_path))
+
+    # Check that the destination path exists.
+    if destination_ready:
+        pass
+    elif not os.path.isdir(destination_directory):
+        log.warning("{0} does not exist".format(destination_directory))
+        log.info("Attempting to create {0}".format(destination_directory))
+        try:
+            # If it does not exist, create it.
+            os.makedirs(destination_directory, 0755)
+        except OSError as exception:
+            handle_error("Unable to create {0}. Exception: {1}".format(
+                destination_directory, exception), 
+                "Destination not writeable")
+
+    # Validate the destination directory is writeable.
+    # This is probably overkill since, if the directory is not writeable, 
+    # the copy attempt will fail and the exception will report the lack of 
+    # permissions.
+    if not destination_ready and not os.access(destination_directory, 
+        os.W_OK):
+        handle_error("Unable to write to {0}".format(destination_directory),
+            "Destination not writeable")
+
+    if checksum_copies:
+        copy_with_checksum(CSR_full_path, destination_directory)
+        return
+
+    # Copy the file to the desired location.
+    try:
+        copy2(CSR_full_path, destination_directory)
+    except IOError as exception:
+        handle_error("Unable to copy file. {0}\n".format(exception), 
+            "Copy failed")
+    else:
+        log.info("Copy completed!")
+
+
+def manifest_stamp(manifest_file):
+    '''
+        What identifies a version of a manifest (it is always replaced by a 
+        rename, so a new version is a new inode), or None if there is none.
+    '''
+    try:
+        manifest_stat = os.stat(manifest_file)
+    except OSError:
+        return None
+    return (manifest_stat.st_ino, manifest_stat.st_mtime, 
+        manifest_stat.st_size)
+
+
+def load_manifest(destination_directory):
+    '''
+        Return the checksum manifest of a collectors directory 
+        (filename -> {"size", "mtime", "md5"}). An unreadable manifest is 
+        treated as empty, so the files will simply be copied again.
+        It is only read again if another process (E.g. the cron checker 
+        and the watch mode) replaced it since.
+    '''
+    manifest_file = os.path.join(destination_directory, manifest_filename)
+    stamp = manifest_stamp(manifest_file)
+    cached = manifests.get(destination_directory)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    try:
+        with open(manifest_file) as file_handle:
+            manifest = json.load(file_handle)
+    except (IOError, ValueError) as exception:
+        if os.path.exists(manifest_file):
+            log.warning("Ignoring unreadable manifest {0}. Exception: "\
+                "{1}".format(manifest_file, exception))
+        manifest = {}
+    manifests[destination_directory] = (stamp, manifest)
+    return manifest
+
+
+def update_manifest(destination_directory, filename, entry):
+    '''
+        Record the manifest entry of filename in a collectors directory. 
+        The manifest is read again and atomically replaced while holding an 
+        flock on its lock file, so the checkers (E.g. the cron checker and 
+        the watch mode) do not overwrite each other's entries.
+    '''
+    manifest_file = os.path.join(destination_directory, manifest_filename)
+    temporary_file = "{0}.{1}.tmp".format(manifest_file, os.getpid())
+    try:
+        with open(manifest_file + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest = load_manifest(destination_directory)
+            manifest[filename] = entry
+            with open(temporary_file, "w") as file_handle:
+                json.dump(manifest, file_handle, indent=4, sort_keys=True)
+            os.rename(temporary_file, manifest_file)
+            manifests[destination_directory] = (manifest_stamp(
+                manifest_file), manifest)
+    except (IOError, OSError) as exception:
+        handle_error("Unable to write manifest {0}. Exception: {1}".format(
+            manifest_file, exception), "Manifest not writeable")
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+
+def file_checksum(file_name):
+    '''
+        Return the MD5 hex digest of a file, reading it in chunks.
+    '''
+    checksum = hashlib.md5()
+    with open(file_name, "rb") as file_handle:
+        for chunk in iter(lambda: file_handle.read(copy_chunk_size), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def copy_with_checksum(CSR_full_path, destination_directory):
+    '''
+        Copy a CSR file while computing the checksum of the bytes that go 
+        through, so the source is read only once. The copy is written to a 
+        temporary file, verified (size and checksum of what actually landed 
+        on disk) and only then renamed to its final name, so a truncated 
+        copy never replaces a good one.
+        If the manifest shows the destination is already a verified copy of 
+        the same source (same size and modification time), nothing is copied. 
+        If the destination no longer matches its manifest entry, it is 
+        reported as corrupted and copied again.
+    '''
+    filename = os.path.basename(CSR_full_path)
+    destination_file = os.path.join(destination_directory, filename)
+    temporary_file = destination_file + ".part"
+    manifest = load_manifest(destination_directory)
+    entry = manifest.get(filename)
+
+    try:
+        source_stat = os.stat(CSR_full_path)
+    except OSError as exception:
+        handle_error("Unable to copy file. {0}\n".format(exception), 
+            "Copy failed")
+        return
+
+    if entry is not None:
+        try:
+            destination_stat = os.stat(destination_file)
+        except OSError:
+            destination_stat = None
+        if (destination_stat is not None and 
+            destination_stat.st_size == entry["size"] and 
+            int(destination_stat.st_mtime) == entry["mtime"]):
+            if (source_stat.st_size == entry["size"] and 
+                int(source_stat.st_mtime) == entry["mtime"]):
+                log.info("{0} is already a verified copy.".format(
+                    destination_file))
+                return
+        elif destination_stat is not None:
+            handle_error("The file {0} does not match its manifest entry "\
+                "(expected {1} bytes, found {2}), it may be corrupted. "\
+                "Copying it again.".format(destination_file, entry["size"], 
+                destination_stat.st_size), "Corrupted copy")
+
+    checksum = hashlib.md5()
+    copied_bytes = 0
+    try:
+        with open(CSR_full_path, "rb") as source:
+            with open(temporary_file, "wb") as destination:
+                for chunk in iter(lambda: source.read(copy_chunk_size), b""):
+                    checksum.update(chunk)
+                    destination.write(chunk)
+                    copied_bytes += len(chunk)
+                destination.flush()
+                os.fsync(destination.fileno())
+            # If the file changed while we were copying it (E.g. it is still 
+            # being uploaded), the copy is not reliable.
+            if os.fstat(source.fileno()).st_size != copied_bytes:
+                raise IOError("{0} changed while it was being copied.".format(
+                    CSR_full_path))
+        copystat(CSR_full_path, temporary_file)
+
+        # Verify the copy against the checksum computed from the source.
+        if os.path.getsize(temporary_file) != copied_bytes:
+            raise IOError("Truncated copy of {0} ({1} of {2} bytes).".format(
+                CSR_full_path, os.path.getsize(temporary_file), copied_bytes))
+        if file_checksum(temporary_file) != checksum.hexdigest():
+            raise IOError("Checksum mismatch while copying {0}.".format(
+                CSR_full_path))
+        os.rename(temporary_file, destination_file)
+    except (IOError, OSError) as exception:
+        handle_error("Unable to copy file. {0}\n".format(exception), 
+            "Copy failed")
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+        return
+
+    update_manifest(destination_directory, filename, {
+        "size": copied_bytes,
+        "mtime": int(source_stat.st_mtime),
+        "md5": checksum.hexdigest()})
+    log.info("Copy completed and verified! (MD5 {0})".format(
+        checksum.hexdigest()))
+
+
+def concurrent_map(function, items):
+    '''
+        Like map(), but the calls are spread over the scan thread pool. 
+        The results keep the order of items.
+    '''
+    global scan_pool
+    items = list(items)
+    if scan_concurrency <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    if scan_pool is None:
+        scan_pool = ThreadPool(scan_concurrency)
+    return scan_pool.map(function, items)
+
+
+def list_entries(path):
+    '''
+        Return the names inside path as (name, is_directory) tuples, or None 
+        if path cannot be listed. is_directory is None when it is not known 
+        without a stat (no scandir).
+        This runs in the scan thread pool, so it must not use the pool 
+        (refer to discover_satellites).
+    '''
+    try:
+        if scandir is not None:
+            return [(entry.name, entry.is_dir()) for entry in scandir(path)]
+        return [(name, None) for name in os.listdir(path)]
+    except OSError:
+        return None
+
+
+def discover_satellites():
+    '''
+        Return a list of (job_name, sub_dir_name) tuples, one for every 
+        satellite directory (there is one dir for every satellite server) 
+        inside every job directory. The job directories are listed 
+        concurrently, and then (without scandir) their entries are checked 
+        concurrently. The two steps are separate so no pool task waits for 
+        other tasks of the same pool.
+    '''
+    satellites = []
+    job_paths = [os.path.join(CSR_path, job_name) for job_name in job_names]
+    listings = concurrent_map(list_entries, job_paths)
+    unknown = [os.path.join(job_path, name) 
+        for job_path, entries in zip(job_paths, listings) if entries 
+        for name, is_directory in entries if is_directory is None]
+    stat_results = dict(zip(unknown, concurrent_map(os.path.isdir, unknown)))
+    for job_name, job_path, entries in zip(job_names, job_paths, listings):
+        if entries is None:
+            handle_error("The path {0} does not exist.\n".format(job_path),
+                "Missing job directory")
+            continue
+        for sub_dir_name in sorted(name for name, is_directory in entries 
+            if is_directory or (is_directory is None and 
+            stat_results[os.path.join(job_path, name)])):
+            satellites.append((job_name, sub_dir_name))
+    return satellites
 
 
 def check_day(year, month, day):
-    global error_message
-    global error_found
+    # This next line will ensure the month and day are zero-padded in case 
+    # they are single digit numbers (E.g. "3" will become "03")
+    filename = datetime.date(int(year), int(month), 
+        int(day)).strftime("%Y%m%d") + ".txt"
+
+    def probe(satellite):
+        '''
+            All the stat calls needed for one satellite. These are issued 
+            concurrently, only the results are used by the main thread.
+        '''
+        job_name, sub_dir_name = satellite
+        # Build an OS-agnostic full path to the CSR file(s).
+        CSR_full_path = os.path.join(CSR_path, job_name, sub_dir_name, 
+            filename)
+        # Destination directory.
+        destination_directory = os.path.join(dest_path, job_name, 
+            sub_dir_name)
+        present = os.path.isfile(CSR_full_path)
+        destination_ready = (present and 
+            os.path.isdir(destination_directory) and 
+            os.access(destination_directory, os.W_OK))
+        return CSR_full_path, destination_directory, present, \
+            destination_ready
+
+    # Find the files for the specified date, in every satellite directory 
+    # of every job.
+    for CSR_full_path, destination_directory, present, destination_ready in \
+        concurrent_map(probe, discover_satellites()):
+        # See if the satellite directories have all the expected files in 
+        # them.
+        if not present:
+            handle_error("File not found: {0}".format(CSR_full_path), 
+                "File not found")
+        else:
+            log.info("The file {0} is present.".format(CSR_full_path))
+            collect_file(CSR_full_path, destination_directory, 
+                destination_ready)
+
+
+def needs_copy(CSR_full_path, destination_file):
+    '''
+        Return True if the CSR file exists and its copy in the collector's 
+        directory is missing or differs in size or modification time (copy2 
+        preserves the modification time, so a good copy always matches).
+        This only costs two stat calls per file.
+    '''
+    try:
+        source_stat = os.stat(CSR_full_path)
+    except OSError:
+        return False
+    try:
+        destination_stat = os.stat(destination_file)
+    except OSError:
+        return True
+    return (source_stat.st_size != destination_stat.st_size or
+        int(source_stat.st_mtime) != int(destination_stat.st_mtime))
+
+
+def reconcile(days):
+    '''
+        Lightweight safety net for the watch mode: look for CSR files of the 
+        given days that were not copied yet (e.g. because they arrived while 
+        the watcher was not running or an inotify event was lost) and copy 
+        them. Missing CSR files are not reported here, that is still the job 
+        of the regular (cron) execution.
+    '''
+    log.info("Reconciling CSR files for {0}".format(
+        ", ".join(str(day) for day in days)))
+    filenames = [day.strftime("%Y%m%d") + ".txt" for day in days]
+
+    def probe(satellite):
+        job_name, sub_dir_name = satellite
+        satellite_path = os.path.join(CSR_path, job_name, sub_dir_name)
+        destination_directory = os.path.join(dest_path, job_name, 
+            sub_dir_name)
+        return [(os.path.join(satellite_path, filename), 
+            destination_directory) for filename in filenames 
+            if needs_copy(os.path.join(satellite_path, filename), 
+            os.path.join(destination_directory, filename))]
+
+    for pending in concurrent_map(probe, discover_satellites()):
+        for CSR_full_path, destination_directory in pending:
+            collect_file(CSR_full_path, destination_directory)
+
+
+def notify_errors(header=None, attachments=None):
+    '''
+        Send the notification email with the summary of the errors found so 
+        far, and forget them (removing their spool file). The full list of 
+        errors is attached (compressed) when it does not fit in the summary.
+    '''
+    attachments = list(attachments or [])
+    errors_file = errors.attachment()
+    if errors_file:
+        attachments.append(errors_file)
 
-    # Find the files for the specified date.
-    for job_name in ["consolidation_backups",
-        "consolidation_cinder_volume",
-        "consolidation_nova_compute"]:
+    # Queue the notification email (it is sent in the background).
+    emailer.queue_email(distribution_group, "SCCM CSR processing error", 
+        email_from, errors.summary(header), attachments or None)
+    errors.reset()
 
-        # Build an OS-agnostic path to the jobfiles directories.
+
+def watch(reconcile_interval):
+    '''
+        Long-running watch mode. Every consolidation_* job directory (and 
+        every satellite directory inside them) is watched with inotify, and 
+        CSR files are copied to their collector destination as soon as they 
+        are closed after writing (or moved into place). Every 
+        reconcile_interval seconds, the files for today and yesterday are 
+        reconciled in case an event was missed.
+    '''
+    watcher = inotify_watcher.InotifyWatcher()
+    job_paths = {}
+
+    def watch_satellite(satellite_path):
+        try:
+            watcher.add_watch(satellite_path, satellite_events)
+        except OSError as exception:
+            handle_error("Unable to watch {0}. Exception: {1}".format(
+                satellite_path, exception), "Watch failed")
+
+    for job_name in job_names:
         job_path = os.path.join(CSR_path, job_name)
+        if not os.path.isdir(job_path):
+            handle_error("The path {0} does not exist.\n".format(job_path),
+                "Missing job directory")
+            continue
+        watcher.add_watch(job_path, job_events)
+        job_paths[job_path] = job_name
+        for sub_dir_name in os.listdir(job_path):
+            satellite_path = os.path.join(job_path, sub_dir_name)
+            if os.path.isdir(satellite_path):
+                watch_satellite(satellite_path)
 
-        # Check inside every directory inside the job_names 
-        # (there is one dir for every satellite server).
-        # Check if any of the arguments are invalid directories.
-        if os.path.exists(job_path):
-            # Read the contents of the path and see if there are any 
-            # directories inside.
-            for dir_name, dir_names, filenames in os.walk(job_path):
-                for sub_dir_name in dir_names:
-                    # This next line will ensure the month and day are 
-                    # zero-padded in case they are single digit numbers 
-                    # (E.g. "3" will become "03")
-                    filename = datetime.date(int(year), int(month), 
-                        int(day)).strftime("%Y%m%d") + ".txt"
-
-                    # Build an OS-agnostic full path to the CSR file(s).
-                    CSR_full_path = os.path.join(CSR_path, job_name, 
-                        sub_dir_name, filename)
-
-                    # Destination directory.
-                    destination_directory = os.path.join(dest_path, job_name, 
-                        sub_dir_name)
-
-                    # If we do find directories inside, see if they have all 
-                    # the expected files in them.
-                    if not (os.path.isfile(CSR_full_path)):
-                        error = "File not found: {0}".format(CSR_full_path)
-                        log.error(error)
-                        error_message.append(error)
-                        error_found = True
-                    else:
-                        log.info("The file {0} " \
-                            "is present.".format(CSR_full_path))
-                        log.info("Copying file to final destination...")
-
-                        # Check that the destination path exists.
-                        if not os.path.isdir(destination_directory):
-                            log.warning("{0} does not exist".format(
-                                destination_directory))
-                            log.info("Attempting to create {0}".format(
-                                destination_directory))
-                            try:
-                                # If it does not exist, create it.
-                                os.makedirs(destination_directory, 0755)
-                            except e as exception:
-                                error = "Unable to create {0}. Exception: "\
-                                    "{1}".format(destination_directory, 
-                                    exception)
-                                log.error(error)
-                                error_message.append(error)
-                                error_found = True
-
-                        # Validate the destination directory is writeable.
-                        # This is probably overkill since, if the directory 
-                        # is not writeable, the copy attempt will fail and 
-                        # the exception will report the lack of permissions.
-                        if not os.access(destination_directory, os.W_OK):
-                            error = "Unable to write to {0}".format(
-                                destination_directory)
-                            log.error(error)
-                            error_message.append(error)
-                            error_found = True
-
-                        # Copy the file to the desired location.
-                        try:
-                            copy2(CSR_full_path, destination_directory)
-                        except IOError as exception:
-                            error = "Unable to copy file. {0}"\
-                                "\n".format(exception)
-                            log.error(error)
-                            error_message.append(error)
-                            error_found = True
-                        else:
-                            log.info("Copy completed!")
-        else:
-            error_message.append("The path {0}" \
-                " does not exist.\n".format(job_path))
-            error_found = True
+    log.info("Watching {0} directories under {1}".format(
+        len(watcher.watches), CSR_path))
+
+    next_reconcile = 0
+    try:
+        while True:
+            now = time.time()
+            if now >= next_reconcile:
+                today = datetime.date.today()
+                reconcile([today - datetime.timedelta(days=1), today])
+                if errors:
+                    notify_errors()
+                next_reconcile = now + reconcile_interval
+                continue
+
+            for path, mask, name in watcher.read_events(
+                timeout=next_reconcile - now):
+                if mask & inotify_watcher.IN_Q_OVERFLOW:
+                    # Some events were lost, reconcile right away.
+                    log.warning("inotify queue overflow, reconciling.")
+                    next_reconcile = 0
+                elif path in job_paths:
+                    # A new satellite directory. Watch it and reconcile, 
+                    # since files could have landed in it before the watch 
+                    # was in place.
+                    if mask & inotify_watcher.IN_ISDIR:
+                        log.info("New satellite directory {0}".format(name))
+                        watch_satellite(os.path.join(path, name))
+                        next_reconcile = 0
+                elif csr_filename.match(name):
+                    job_name = os.path.basename(os.path.dirname(path))
+                    sub_dir_name = os.path.basename(path)
+                    collect_file(os.path.join(path, name), 
+                        os.path.join(dest_path, job_name, sub_dir_name))
+    finally:
+        watcher.close()
 
 
 def check_month(year, month):
@@ -343,6 +893,137 @@ def check_month(year, month):
         day+=1
 
 
+def parse_date(date_string):
+    '''
+        argparse type for the --from and --to arguments (CCYYMMDD).
+    '''
+    try:
+        return datetime.datetime.strptime(date_string, "%Y%m%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError("{0} is not a valid CCYYMMDD "\
+            "date.".format(date_string))
+
+
+def format_day_ranges(days):
+    '''
+        Condense a sorted list of dates into a string of ranges, E.g. 
+        "2017-07-01..2017-07-03, 2017-07-09".
+    '''
+    ranges = []
+    for day in days:
+        if ranges and day - ranges[-1][1] == datetime.timedelta(days=1):
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return ", ".join(str(first) if first == last else 
+        "{0}..{1}".format(first, last) for first, last in ranges)
+
+
+def write_coverage_matrix(days, coverage, matrix_format, matrix_file):
+    '''
+        Write the coverage matrix (one row per job and satellite, one column 
+        per day, 1 if the CSR file is present and 0 if it is missing) as CSV 
+        or JSON. In JSON, every row is a compact string of 1s and 0s.
+        If matrix_file is None, the matrix is written to the stdout.
+    '''
+    day_names = [day.strftime("%Y%m%d") for day in days]
+    if matrix_file:
+        output = open(matrix_file, "wb" if matrix_format == "csv" else "w")
+    else:
+        output = sys.stdout
+    try:
+        if matrix_format == "csv":
+            writer = csv.writer(output)
+            writer.writerow(["job", "satellite"] + day_names)
+            for job_name in sorted(coverage):
+                for sub_dir_name in sorted(coverage[job_name]):
+                    writer.writerow([job_name, sub_dir_name] + 
+                        [int(present) for present in 
+                        coverage[job_name][sub_dir_name]])
+        else:
+            json.dump({
+                "from": day_names[0],
+                "to": day_names[-1],
+                "jobs": dict((job_name, dict((sub_dir_name, 
+                    "".join("1" if present else "0" for present in row))
+                    for sub_dir_name, row in satellites.items()))
+                    for job_name, satellites in coverage.items())
+                }, output, indent=4, sort_keys=True)
+            output.write("\n")
+    finally:
+        if matrix_file:
+            output.close()
+
+
+def check_range(start_date, end_date):
+    '''
+        Check (and collect) all the CSR files between start_date and end_date 
+        (inclusive) in one pass over the upload tree: every satellite 
+        directory is listed only once, no matter how many days are checked.
+        Files are only copied when their collector's copy is missing or 
+        outdated.
+        Returns the list of days and the coverage of every satellite of 
+        every job (a list of booleans, one per day).
+    '''
+    days = []
+    day = start_date
+    while day <= end_date:
+        days.append(day)
+        day += datetime.timedelta(days=1)
+    filenames = [day.strftime("%Y%m%d") + ".txt" for day in days]
+    log.info("Checking CSR files from {0} to {1} ({2} days).".format(
+        start_date, end_date, len(days)))
+
+    def probe(satellite):
+        '''
+            List the satellite directory (once) and find which of its files 
+            need to be copied. Issued concurrently for all satellites.
+        '''
+        job_name, sub_dir_name = satellite
+        satellite_path = os.path.join(CSR_path, job_name, sub_dir_name)
+        destination_directory = os.path.join(dest_path, job_name, 
+            sub_dir_name)
+        try:
+            present_files = set(os.listdir(satellite_path))
+        except OSError:
+            present_files = set()
+        row = [filename in present_files for filename in filenames]
+        pending = [os.path.join(satellite_path, filename) 
+            for filename, present in zip(filenames, row) 
+            if present and needs_copy(os.path.join(satellite_path, filename),
+            os.path.join(destination_directory, filename))]
+        return row, destination_directory, pending
+
+    satellites = discover_satellites()
+    coverage = {}
+    for (job_name, sub_dir_name), (row, destination_directory, pending) in \
+        zip(satellites, concurrent_map(probe, satellites)):
+        for CSR_full_path in pending:
+            collect_file(CSR_full_path, destination_directory)
+        coverage.setdefault(job_name, {})[sub_dir_name] = row
+
+        # One summary line per satellite instead of one per file.
+        missing_days = [day for day, present in zip(days, row) 
+            if not present]
+        if missing_days:
+            handle_error("{0}/{1}: {2} of {3} file(s) missing: "\
+                "{4}".format(job_name, sub_dir_name, len(missing_days), 
+                len(days), format_day_ranges(missing_days)), 
+                "Satellite with missing files")
+    return days, coverage
+
+
+def main_range(start_date, end_date, matrix_format, matrix_file):
+    days, coverage = check_range(start_date, end_date)
+    write_coverage_matrix(days, coverage, matrix_format, matrix_file)
+    if errors:
+        # Attach the full matrix (if it was written to a file).
+        notify_errors("Missing CSR files between {0} and {1} in "\
+            "{2}:\n".format(start_date, end_date, hostname), 
+            [matrix_file] if matrix_file else None)
+        exit (1)
+
+
 def main(year, month, day):
     # Check if we are going to check (?) a whole month or an individual day.
     if year and month and day:
@@ -351,13 +1032,8 @@ def main(year, month, day):
     elif year and month and not(day):
         # Check all the days in a month.
         check_month(year, month)
-    if error_found:
-        # Join the error message list into a string object.
-        error_message_string = "\n".join(error_message)
-
-        # Send the notification email.
-        emailer.build_email(distribution_group, "SCCM CSR processing error", 
-            email_from, error_message_string, None)
+    if errors:
+        notify_errors()
         exit (1)
 
 
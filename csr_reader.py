@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+'''
+    Usage:
+        import csr_reader
+
+        with open("/path/to/20171123.txt", "rb") as file_handle:
+            for record in csr_reader.read_records(file_handle):
+                print(record.date, record.hour, record.feed)
+                if record.identifier("TemplateName") is None:
+                    ...
+
+        # Without building record objects:
+        hour = csr_reader.record_hour(line)
+        fields = csr_reader.split_fields(line)
+
+    Description:
+        A small, shared parser of CSR records, so the SCCM tools do not each
+        parse them in their own way (or pay for a full csv.reader parse when
+        they only need one or two fields).
+        A CSR record looks like:
+            MCS,20171123,20171123,03:00:00,03:59:59,1,2,Feed,"SBY_US_POWER_nova",
+            TemplateName,"RHEL7, 64 bit",2,CPU,4,MEMORY,8192
+        that is: the record type, start date, end date, start time, end time,
+        shift code, the number of identifiers, the identifier (name, "value")
+        pairs, the number of resources and the resource (rate code, value)
+        pairs. The identifier values are quoted (as produced by
+        input_file.sql), and they may contain commas.
+        The header fields are never quoted, so the date and the hour are read
+        with a bounded split of the line, and the feed is found with a
+        substring search. The whole record is only tokenized when a record's
+        fields are used, and then only once.
+        Fields are decoded like csv.reader does with the default dialect (the
+        quoted records are in fact tokenized by csv.reader, which is written
+        in C).
+'''
+
+# The quoted records are tokenized by the csv module.
+import csv
+
+# To format the date values of format_record.
+import datetime
+
+
+# Positions of the header fields.
+RECORD_TYPE = 0
+START_DATE = 1
+END_DATE = 2
+START_TIME = 3
+END_TIME = 4
+SHIFT_CODE = 5
+IDENTIFIER_COUNT = 6
+
+
+def split_fields(line):
+    '''
+        Return the list of fields of a CSR record (without its line 
+        terminator). Commas inside quoted values do not separate fields, and 
+        "" inside a quoted value is a literal quote.
+        Lines without quotes are just split on the commas, the others are 
+        parsed by csv.reader (which, even for a single line, is faster than 
+        anything that can be written here in Python).
+    '''
+    line = line.rstrip("\r\n")
+    if '"' not in line:
+        return line.split(",")
+    return next(csv.reader((line,)))
+
+
+def record_date(line):
+    '''
+        The start date (CCYYMMDD) of a CSR record.
+    '''
+    return line.split(",", START_DATE + 1)[START_DATE]
+
+
+def record_hour(line):
+    '''
+        The hour ("HH") of the start time of a CSR record.
+    '''
+    return line.split(",", START_TIME + 1)[START_TIME][:2]
+
+
+def record_identifier(line, name):
+    '''
+        The value of the identifier name of a CSR record, or None if the
+        record does not have it. Quoted values are found with a substring
+        search, other records are tokenized.
+    '''
+    start = line.find(",{0},\"".format(name))
+    if start >= 0:
+        start += len(name) + 3
+        end = line.find('"', start)
+        if end >= 0 and not line.startswith('"', end + 1):
+            return line[start:end]
+    return identifier_value(split_fields(line), name)
+
+
+def record_feed(line):
+    '''
+        The feed (provider) of a CSR record, or None.
+    '''
+    return record_identifier(line, "Feed")
+
+
+def identifier_value(fields, name):
+    '''
+        The value of the identifier name in the fields of a CSR record, or
+        None.
+    '''
+    try:
+        count = int(fields[IDENTIFIER_COUNT])
+    except (IndexError, ValueError):
+        return None
+    for index in range(IDENTIFIER_COUNT + 1,
+        min(IDENTIFIER_COUNT + 1 + 2 * count, len(fields) - 1), 2):
+        if fields[index] == name:
+            return fields[index + 1]
+    return None
+
+
+class CSRRecord(object):
+    '''
+        One CSR record. Only the line is kept until the fields are needed,
+        then they are tokenized once and cached.
+    '''
+    __slots__ = ("line", "_fields")
+
+    def __init__(self, line):
+        self.line = line.rstrip("\r\n")
+        self._fields = None
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = split_fields(self.line)
+        return self._fields
+
+    def __getitem__(self, index):
+        return self.fields[index]
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __repr__(self):
+        return "CSRRecord({0!r})".format(self.line)
+
+    @property
+    def record_type(self):
+        return self.line.split(",", 1)[0]
+
+    @property
+    def date(self):
+        return record_date(self.line)
+
+    @property
+    def hour(self):
+        return record_hour(self.line)
+
+    @property
+    def feed(self):
+        return self.identifier("Feed")
+
+    def identifier(self, name):
+        '''
+            The value of the identifier name, or None.
+        '''
+        if self._fields is not None:
+            return identifier_value(self._fields, name)
+        return record_identifier(self.line, name)
+
+    def identifiers(self):
+        '''
+            Return the identifiers as a list of (name, value) pairs (in the
+            order of the record).
+        '''
+        fields = self.fields
+        count = int(fields[IDENTIFIER_COUNT])
+        start = IDENTIFIER_COUNT + 1
+        return list(zip(fields[start:start + 2 * count:2],
+            fields[start + 1:start + 2 * count:2]))
+
+    def resources(self):
+        '''
+            Return the resources as a list of (rate code, value) pairs.
+        '''
+        fields = self.fields
+        start = IDENTIFIER_COUNT + 1 + 2 * int(fields[IDENTIFIER_COUNT])
+        count = int(fields[start])
+        start += 1
+        return list(zip(fields[start:start + 2 * count:2],
+            fields[start + 1:start + 2 * count:2]))
+
+
+def read_records(lines):
+    '''
+        Yield a CSRRecord for every non-empty line (E.g. of an open CSR
+        file).
+    '''
+    for line in lines:
+        if line.strip():
+            yield CSRRecord(line)
+
+
+def format_record(values):
+    '''
+        Build a CSR line (without line terminator) from a sequence of values.
+        Dates are written as CCYYMMDD, everything else with str(). Values are
+        not quoted (the quotes of the identifier values are already part of
+        the values produced by input_file.sql).
+    '''
+    return ",".join(value.strftime("%Y%m%d") if type(value) is datetime.date
+        else str(value) for value in values)
@@ -53,8 +53,8 @@ import os
 # Needed for system and environment information.
 import sys
 
-# For reading the configuration file.
-import json
+# For reading the configuration file (refer to config_loader.py)
+import config_loader
 
 # Handling arguments.
 import argparse
@@ -184,7 +184,8 @@ def main(git_repo, mode, environment):
 
     # Open and parse the configuration file.
     try:
-        config = json.load(open(config_file, "r+"))
+        # (Never cached on disk, it decides what runs as root.)
+        config = config_loader.load(config_file, cache=False)
         # Parse the common/generic configurations that should apply to all the
         # server types.
         for cronjob in config["common"]["cronjobs"]:
@@ -0,0 +1,706 @@
+#!/usr/bin/env python
+'''
+    Usage:
+        import email_spool
+
+        spool = email_spool.Spool()
+        spool.enqueue(email_from, email_to, message)
+        # Or, to be combined with the other emails to the same group:
+        spool.hold("Job_failures", email_spool.group_policy(group), 
+            email_from, email_to, subject, message)
+        email_spool.start_sender()
+
+        python email_spool.py [-h] [-d SPOOL_DIR] [-w WORKERS]
+
+    Arguments:
+        -h, --help      Show this help message and exit.
+        -d SPOOL_DIR, --directory SPOOL_DIR
+                        The spool directory. Defaults to
+                        /tmp/logs/sccm/email_spool.
+        -w WORKERS, --workers WORKERS
+                        Number of emails delivered concurrently (each one
+                        over its own SMTP session). Defaults to 2.
+
+    Description:
+        A spool directory of outgoing emails, so the checkers do not wait
+        for the SMTP server (and do not lose their notifications when it is
+        down).
+        Every email is written, as JSON (the envelope, and the message bytes
+        in base64), to the tmp/ subdirectory and then renamed into queue/,
+        so a sender never sees half-written emails. The name of every queued email holds the
+        time it is due and the number of delivery attempts, so the queue is
+        sorted and scheduled without reading the emails.
+        The sender (this program, started in the background by
+        start_sender(), or by cron) claims every due email by renaming it
+        into active/, and delivers it through emailer.SMTPSession. Delivered
+        emails are removed. The ones that fail go back to queue/, due after
+        an exponential backoff (RETRY_DELAY, doubled after every attempt, up
+        to MAX_RETRY_DELAY); after MAX_ATTEMPTS they are moved to failed/.
+        The sender keeps running while there are emails to retry.
+        The emails held for a distribution group (hold/<group>/, written by 
+        emailer.queue_email) are not queued one by one: when the first one 
+        has waited for the coalescing window of the group, all of them are 
+        combined into one email (a summary, and every email attached as 
+        message/rfc822, up to MAX_MERGED emails and MAX_MERGED_SIZE bytes; 
+        the rest are only listed, and counted as suppressed). Every group 
+        also has a token bucket (burst emails, refilled at a rate per hour, 
+        kept in rate_limits.json): while it is empty, the emails of the 
+        group keep accumulating. The window and the rate limit of a group 
+        can be set in mailList.json (refer to group_policy).
+        Only one sender works on a spool at a time (it holds an flock on
+        sender.lock), so the emails left in active/ by a sender that died
+        are put back in the queue by the next one.
+'''
+
+# Needed for system and environment information.
+import os
+
+# Needed for system and environment information.
+import sys
+
+# The emails are stored as JSON.
+import json
+
+# The messages are kept as bytes (base64) in the JSON.
+import base64
+
+# To get current seconds since Epoch.
+import time
+
+# Only one sender per spool.
+import fcntl
+
+# To start the sender in the background.
+import subprocess
+
+# Combining the emails held for a group.
+import email
+import email.utils
+import email.header
+try:
+    from email import message_from_bytes
+except ImportError:
+    # Python 2: bytes are str.
+    from email import message_from_string as message_from_bytes
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.message import MIMEMessage
+
+# Concurrent deliveries.
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Handling arguments.
+import argparse
+
+# Handle logging.
+import logging
+
+
+# The default spool directory.
+spool_dir = os.path.join(os.sep, "tmp", "logs", "sccm", "email_spool")
+
+# Where the background sender logs.
+sender_log_file = os.path.join(os.sep, "tmp", "logs", "sccm",
+    "email_spool.log")
+
+# Delivery attempts of an email before it is moved to failed/.
+MAX_ATTEMPTS = 8
+
+# Seconds before the first retry (doubled after every attempt).
+RETRY_DELAY = 30
+
+# The longest wait between two attempts (in seconds).
+MAX_RETRY_DELAY = 3600
+
+# Number of emails delivered concurrently.
+SENDER_WORKERS = 2
+
+# Seconds during which the emails to the same distribution group are 
+# collected into one ("coalesce_window" of the group in mailList.json).
+COALESCE_WINDOW = 300
+
+# Token bucket of every group: the emails that can be sent in a burst 
+# ("rate_burst"), and how many tokens are added per hour ("rate_per_hour").
+RATE_LIMIT_BURST = 5
+RATE_LIMIT_PER_HOUR = 12
+
+# Emails attached in full to a combined email (the rest are only listed).
+MAX_MERGED = 25
+
+# Bytes of the emails attached in full to a combined email (the first one is
+# always attached, the rest only while they fit).
+MAX_MERGED_SIZE = 10 * 1024 * 1024
+
+# Logging configuration.
+log = logging.getLogger("email_spool")
+
+
+def retry_delay(attempts):
+    '''
+        Seconds to wait after the attempts-th failed delivery.
+    '''
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def encode_message(message):
+    '''
+        The message (its bytes, UTF-8 if it is text) as base64 text. JSON 
+        only keeps text, and gives it back as unicode under Python 2, which 
+        smtplib and the email module cannot handle when it is not ASCII.
+    '''
+    if not isinstance(message, bytes):
+        message = message.encode("utf-8")
+    return base64.b64encode(message).decode("ascii")
+
+
+def decode_message(data):
+    '''
+        The message of a spooled email (data), as bytes (str under Python 
+        2).
+    '''
+    if "message_base64" in data:
+        return base64.b64decode(data["message_base64"].encode("ascii"))
+    # Spooled by an older version, as text.
+    message = data["message"]
+    if not isinstance(message, bytes):
+        message = message.encode("utf-8")
+    return message
+
+
+def entry_name(due, attempts, unique):
+    return "{0:017.6f}_{1}_{2}.json".format(due, attempts, unique)
+
+
+def parse_entry_name(name):
+    '''
+        The (due time, attempts, unique id) of a spooled email, or None if
+        name is not one.
+    '''
+    try:
+        due, attempts, unique = name[:-len(".json")].split("_")
+        return float(due), int(attempts), unique
+    except ValueError:
+        return None
+
+
+def group_policy(group):
+    '''
+        The coalescing window and rate limit of a distribution group (its 
+        entry of mailList.json), with the defaults of this module.
+    '''
+    return {"window": group.get("coalesce_window", COALESCE_WINDOW), 
+        "burst": group.get("rate_burst", RATE_LIMIT_BURST), 
+        "per_hour": group.get("rate_per_hour", RATE_LIMIT_PER_HOUR)}
+
+
+class RateLimits(object):
+    '''
+        The token bucket of every group ({group: [tokens, updated]}), kept in 
+        rate_file. Only used by the sender (which holds the spool lock).
+    '''
+    def __init__(self, rate_file):
+        self.rate_file = rate_file
+        self.state = {}
+        try:
+            with open(rate_file) as file_handle:
+                self.state = json.load(file_handle)
+        except (IOError, ValueError):
+            pass
+
+    def tokens(self, group, policy, now):
+        tokens, updated = self.state.get(group, [policy["burst"], now])
+        return min(policy["burst"], 
+            tokens + (now - updated) * policy["per_hour"] / 3600.0)
+
+    def take(self, group, policy, now):
+        '''
+            Take a token from the bucket of group. Returns False if it is 
+            empty.
+        '''
+        tokens = self.tokens(group, policy, now)
+        taken = tokens >= 1
+        self.state[group] = [tokens - 1 if taken else tokens, now]
+        self.save()
+        return taken
+
+    def wait(self, group, policy, now):
+        '''
+            Seconds until the bucket of group has a token.
+        '''
+        if policy["per_hour"] <= 0:
+            return MAX_RETRY_DELAY
+        return max(0, (1 - self.tokens(group, policy, now)) * 3600.0 / 
+            policy["per_hour"])
+
+    def save(self):
+        temporary_file = self.rate_file + ".tmp"
+        try:
+            with open(temporary_file, "w") as file_handle:
+                json.dump(self.state, file_handle)
+            os.rename(temporary_file, self.rate_file)
+        except (IOError, OSError) as exception:
+            log.error("Unable to write the rate limits {0}. Exception: "\
+                "{1}".format(self.rate_file, exception))
+
+
+def native(text):
+    '''
+        text as str (UTF-8 under Python 2, where JSON gives back unicode, 
+        which cannot be mixed with the 8-bit str of the held messages).
+    '''
+    if isinstance(text, str):
+        return text
+    return text.encode("utf-8")
+
+
+def header_value(text):
+    '''
+        text as the value of a header (RFC 2047 encoded if it is not 
+        ASCII).
+    '''
+    text = native(text)
+    if all(ord(character) < 128 for character in text):
+        return text
+    return email.header.Header(text, "utf-8")
+
+
+def combine(group, held):
+    '''
+        One email with all the held emails (dictionaries, oldest first, 
+        their messages as bytes) of group. Returns (email_from, email_to, 
+        message, merged, suppressed).
+    '''
+    first = held[0]
+    if len(held) == 1:
+        return first["from"], first["to"], first["message"], 1, 0
+    # Attach the emails in order, until MAX_MERGED of them or 
+    # MAX_MERGED_SIZE bytes are reached.
+    size = 0
+    for count, entry in enumerate(held):
+        size += len(entry["message"])
+        if count == MAX_MERGED or (count and size > MAX_MERGED_SIZE):
+            break
+    else:
+        count = len(held)
+    merged = held[:count]
+    suppressed = held[count:]
+    lines = ["{0} notifications to {1} were combined into this email "\
+        "({2} attached, {3} suppressed).".format(len(held), native(group), 
+        len(merged), len(suppressed)), ""]
+    for index, entry in enumerate(held):
+        lines.append("{0}  {1}{2}".format(time.strftime("%Y-%m-%d %H:%M:%S", 
+            time.localtime(entry["created"])), native(entry["subject"]), 
+            "" if index < count else " (suppressed)"))
+    # Every recipient of any of the emails.
+    email_to = []
+    for entry in held:
+        email_to.extend(native(address) for address in entry["to"] 
+            if native(address) not in email_to)
+    message = MIMEMultipart()
+    message["Subject"] = header_value("{0} notifications: {1}".format(
+        len(held), native(first["subject"])))
+    message["From"] = header_value(first["from"])
+    message["To"] = header_value(", ".join(email_to))
+    message["Date"] = email.utils.formatdate(localtime=True)
+    message.attach(MIMEText("\n".join(lines), "plain", "utf-8"))
+    for entry in merged:
+        message.attach(MIMEMessage(message_from_bytes(entry["message"])))
+    # (Under Python 3 the attached messages may have 8-bit bodies, which 
+    # only as_bytes keeps.)
+    if hasattr(message, "as_bytes"):
+        message_string = message.as_bytes()
+    else:
+        message_string = message.as_string()
+    return native(first["from"]), email_to, message_string, len(held), \
+        len(suppressed)
+
+
+class Spool(object):
+    '''
+        The spool directory (and its tmp/, queue/, active/, failed/ and 
+        hold/ subdirectories, which are created if needed).
+    '''
+    def __init__(self, directory=None):
+        self.directory = directory or spool_dir
+        self.tmp_dir = os.path.join(self.directory, "tmp")
+        self.queue_dir = os.path.join(self.directory, "queue")
+        self.active_dir = os.path.join(self.directory, "active")
+        self.failed_dir = os.path.join(self.directory, "failed")
+        self.hold_dir = os.path.join(self.directory, "hold")
+        self.counter = 0
+        for directory in (self.tmp_dir, self.queue_dir, self.active_dir,
+            self.failed_dir, self.hold_dir):
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Created by another process in the meantime.
+                    if not os.path.isdir(directory):
+                        raise
+
+    def _write(self, directory, data):
+        '''
+            Write data (an email) to tmp/ and rename it into directory. 
+            Returns its new path.
+        '''
+        self.counter += 1
+        now = time.time()
+        unique = "{0}-{1}-{2}".format(int(now * 1000000), os.getpid(),
+            self.counter)
+        name = entry_name(now, 0, unique)
+        data["created"] = now
+        temporary_file = os.path.join(self.tmp_dir, name)
+        try:
+            with open(temporary_file, "w") as file_handle:
+                json.dump(data, file_handle)
+                file_handle.flush()
+                os.fsync(file_handle.fileno())
+        except:
+            # Do not leave the partial file in tmp/ (E.g. the disk is full).
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+            raise
+        spooled_file = os.path.join(directory, name)
+        os.rename(temporary_file, spooled_file)
+        return spooled_file
+
+    def enqueue(self, email_from, email_to, message):
+        '''
+            Add an email to the queue (due now). Returns its path.
+        '''
+        queued_file = self._write(self.queue_dir, {"from": email_from, 
+            "to": email_to, "message_base64": encode_message(message)})
+        log.info("Email to {0} queued in {1}".format(email_to, queued_file))
+        return queued_file
+
+    def group_dir(self, group):
+        return os.path.join(self.hold_dir, group.replace(os.sep, "_"))
+
+    def hold(self, group, policy, email_from, email_to, subject, message):
+        '''
+            Hold an email for group, to be combined with the others sent to 
+            group during its coalescing window (policy, refer to 
+            group_policy). Returns its path.
+        '''
+        group_dir = self.group_dir(group)
+        if not os.path.isdir(group_dir):
+            try:
+                os.makedirs(group_dir)
+            except OSError:
+                if not os.path.isdir(group_dir):
+                    raise
+        held_file = self._write(group_dir, {"group": group, 
+            "policy": policy, "from": email_from, "to": email_to, 
+            "subject": subject, 
+            "message_base64": encode_message(message)})
+        log.info("Email to {0} held in {1}".format(group, held_file))
+        return held_file
+
+    def held(self):
+        '''
+            The held emails of every group, as {group directory: [names, 
+            oldest first]}.
+        '''
+        held = {}
+        for group_name in os.listdir(self.hold_dir):
+            group_dir = os.path.join(self.hold_dir, group_name)
+            names = sorted(name for name in os.listdir(group_dir) 
+                if parse_entry_name(name) is not None)
+            if names:
+                held[group_dir] = names
+        return held
+
+    def pending(self):
+        '''
+            True if there are queued or held emails.
+        '''
+        return bool(self.entries() or self.held())
+
+    def entries(self):
+        '''
+            The queued emails, as (due time, attempts, name), sorted by due
+            time.
+        '''
+        entries = []
+        for name in os.listdir(self.queue_dir):
+            parsed = parse_entry_name(name)
+            if parsed is not None:
+                entries.append((parsed[0], parsed[1], name))
+        entries.sort()
+        return entries
+
+    def claim(self, name):
+        '''
+            Move a queued email into active/. Returns its new path, or None
+            if it is gone.
+        '''
+        active_file = os.path.join(self.active_dir, name)
+        try:
+            os.rename(os.path.join(self.queue_dir, name), active_file)
+        except OSError:
+            return None
+        return active_file
+
+    def load(self, active_file):
+        '''
+            Read a spooled email. Its "message" is bytes (refer to 
+            decode_message).
+        '''
+        with open(active_file) as file_handle:
+            data = json.load(file_handle)
+        try:
+            data["message"] = decode_message(data)
+        except (KeyError, TypeError) as exception:
+            raise ValueError("No message in {0}: {1}".format(active_file, 
+                exception))
+        return data
+
+    def delivered(self, active_file):
+        os.remove(active_file)
+
+    def failed(self, active_file):
+        '''
+            Put a claimed email back in the queue (due after the backoff), or
+            in failed/ after MAX_ATTEMPTS.
+        '''
+        due, attempts, unique = parse_entry_name(
+            os.path.basename(active_file))
+        attempts += 1
+        if attempts >= MAX_ATTEMPTS:
+            failed_file = os.path.join(self.failed_dir,
+                os.path.basename(active_file))
+            os.rename(active_file, failed_file)
+            log.error("Giving up on {0} after {1} attempts.".format(
+                failed_file, attempts))
+            return
+        due = time.time() + retry_delay(attempts)
+        os.rename(active_file, os.path.join(self.queue_dir,
+            entry_name(due, attempts, unique)))
+        log.warning("Delivery attempt {0} of {1} failed, retrying in {2} "\
+            "seconds.".format(attempts, unique, retry_delay(attempts)))
+
+    def recover(self):
+        '''
+            Put the emails left in active/ (by a sender that died) back in
+            the queue.
+        '''
+        for name in os.listdir(self.active_dir):
+            log.warning("Recovering {0}".format(name))
+            os.rename(os.path.join(self.active_dir, name),
+                os.path.join(self.queue_dir, name))
+
+
+class SpoolSender(object):
+    '''
+        Delivers the emails of a spool with session_factory() sessions
+        (E.g. emailer.SMTPSession), workers at a time.
+    '''
+    def __init__(self, spool, session_factory, workers=SENDER_WORKERS):
+        self.spool = spool
+        self.session_factory = session_factory
+        self.workers = max(1, workers)
+        self.lock_file = os.path.join(spool.directory, "sender.lock")
+        self.rate_limits = RateLimits(os.path.join(spool.directory, 
+            "rate_limits.json"))
+
+    def run(self):
+        '''
+            Deliver every email of the spool, waiting for the ones that are
+            not due yet. Returns False if another sender holds the lock.
+        '''
+        while True:
+            lock = open(self.lock_file, "a")
+            try:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    log.info("Another sender is running.")
+                    return False
+                self.spool.recover()
+                self.drain()
+            finally:
+                lock.close()
+            # An email queued while the lock was being released would be
+            # left behind (its own sender found the lock taken).
+            if not self.spool.pending():
+                return True
+
+    def drain(self):
+        while True:
+            now = time.time()
+            # Seconds until something can be done.
+            waits = [self.release_held(now)]
+            entries = self.spool.entries()
+            due = [name for due, attempts, name in entries if due <= now]
+            if due:
+                self.deliver(due)
+                continue
+            if entries:
+                waits.append(entries[0][0] - now)
+            waits = [wait for wait in waits if wait is not None]
+            if not waits:
+                return
+            time.sleep(max(0.1, min(min(waits), MAX_RETRY_DELAY)))
+
+    def release_held(self, now):
+        '''
+            Combine and queue the held emails of every group whose 
+            coalescing window ended (if its rate limit allows it). Returns 
+            the seconds until the next group can be released, or None if 
+            nothing is held.
+        '''
+        waits = []
+        for group_dir, names in self.spool.held().items():
+            try:
+                wait = self._release_group(group_dir, names, now)
+            except Exception as exception:
+                # Do not let one bad group stop the others (and every later 
+                # sender): its held emails are moved to failed/.
+                log.exception("Unable to release the emails held in {0}. "\
+                    "Exception: {1}".format(group_dir, exception))
+                for name in names:
+                    held_file = os.path.join(group_dir, name)
+                    if os.path.exists(held_file):
+                        os.rename(held_file, os.path.join(
+                            self.spool.failed_dir, name))
+                continue
+            if wait is not None:
+                waits.append(wait)
+        return min(waits) if waits else None
+
+    def _release_group(self, group_dir, names, now):
+        '''
+            Combine and queue the held emails (names) of group_dir, if it is 
+            time. Returns the seconds until it can be released, or None.
+        '''
+        held = []
+        for name in names:
+            held_file = os.path.join(group_dir, name)
+            try:
+                held.append(self.spool.load(held_file))
+            except (IOError, ValueError) as exception:
+                log.error("Unreadable held email {0}. Exception: "\
+                    "{1}".format(held_file, exception))
+                os.rename(held_file, os.path.join(self.spool.failed_dir, 
+                    name))
+        if not held:
+            return None
+        group = held[0]["group"]
+        policy = held[0]["policy"]
+        release_time = held[0]["created"] + policy["window"]
+        if now < release_time:
+            return release_time - now
+        if not self.rate_limits.take(group, policy, now):
+            return self.rate_limits.wait(group, policy, now)
+        email_from, email_to, message, merged, suppressed = combine(
+            group, held)
+        self.spool.enqueue(email_from, email_to, message)
+        for name in names:
+            held_file = os.path.join(group_dir, name)
+            if os.path.exists(held_file):
+                os.remove(held_file)
+        log.info("{0} emails to {1} combined into one ({2} "\
+            "suppressed).".format(merged, group, suppressed))
+        return None
+
+    def deliver(self, names):
+        '''
+            Deliver the queued emails names, with up to self.workers
+            concurrent sessions.
+        '''
+        pending = queue.Queue()
+        for name in names:
+            pending.put(name)
+        threads = [threading.Thread(target=self._worker, args=(pending,))
+            for worker in range(min(self.workers, len(names)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _worker(self, pending):
+        session = self.session_factory()
+        try:
+            while True:
+                try:
+                    name = pending.get_nowait()
+                except queue.Empty:
+                    return
+                active_file = self.spool.claim(name)
+                if active_file is None:
+                    continue
+                try:
+                    email = self.spool.load(active_file)
+                except (IOError, ValueError) as exception:
+                    log.error("Unreadable spooled email {0}. Exception: "\
+                        "{1}".format(active_file, exception))
+                    os.rename(active_file, os.path.join(
+                        self.spool.failed_dir, name))
+                    continue
+                try:
+                    sent = session.send(email["from"], email["to"],
+                        email["message"])
+                except Exception as exception:
+                    # Keep the worker (and the other emails) going, the 
+                    # email is retried like any other failure.
+                    log.exception("Unable to send spooled email {0}. "\
+                        "Exception: {1}".format(active_file, exception))
+                    sent = False
+                if sent:
+                    self.spool.delivered(active_file)
+                else:
+                    self.spool.failed(active_file)
+        finally:
+            session.close()
+
+
+def start_sender(directory=None):
+    '''
+        Start a sender for the spool in the background (it exits right away
+        if one is already running).
+    '''
+    arguments = [sys.executable, os.path.abspath(__file__).replace(".pyc",
+        ".py")]
+    if directory:
+        arguments.extend(["-d", directory])
+    devnull = open(os.devnull, "r+")
+    try:
+        subprocess.Popen(arguments, stdin=devnull, stdout=devnull,
+            stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+    finally:
+        devnull.close()
+
+
+def get_args(argv):
+    '''
+        Get, validate and parse arguments.
+    '''
+    parser = argparse.ArgumentParser(description="Deliver the spooled "\
+        "emails.")
+    parser.add_argument("-d", "--directory",
+        help = "The spool directory.",
+        dest = "directory",
+        default = spool_dir)
+    parser.add_argument("-w", "--workers",
+        help = "Number of emails delivered concurrently.",
+        dest = "workers",
+        default = SENDER_WORKERS,
+        type = int)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(filename=sender_log_file,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        level=logging.INFO)
+    # Custom module for email sending (refer to emailer.py)
+    import emailer
+    SpoolSender(Spool(args.directory), emailer.SMTPSession,
+        args.workers).run()
+
+
+if __name__ == "__main__":
+    # Parse arguments from the CLI.
+    get_args(sys.argv[1:])
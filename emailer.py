@@ -6,7 +6,8 @@
         import send_email from emailer
 
         usage: emailer.py [-h] -r DISTRIBUTION_GROUP -s EMAIL_SUBJECT 
-            -f EMAIL_FROM -m MESSAGE_BODY [-a ATTACHMENT [ATTACHMENT ...]]
+            -f EMAIL_FROM -m MESSAGE_BODY [-a ATTACHMENT [ATTACHMENT ...]] 
+            [-q]
 
         Examples:
             python emailer.py -s "This is a test subject" -f test@example.com 
@@ -33,6 +34,9 @@
                     A file or a list of files (using absolute paths and
                     separated by spaces) that will be attached to the
                     email. (optional).
+            -q, --queue
+                    Queue the email in the spool, to be delivered in the 
+                    background (optional).
 
     Description:
         This program is intended to be used as a Python module or to be called 
@@ -42,6 +46,26 @@
         The fact that this is an independent function allows to have a better 
         control and easier maintenance while editing this code (instead of 
         having the same function replicated in several .py files).
+        build_email and send_email return True if the email was sent (and 
+        False otherwise), they never end the program, so a long-running 
+        caller can send any number of emails. Every email of a process goes 
+        through the same SMTP session (SMTPSession), which is kept open and 
+        reconnected when the server drops it. Several emails can be built 
+        with build_message and delivered together with send_emails.
+        queue_email writes the email to a spool directory and returns right 
+        away; a background sender delivers it, retrying while the SMTP server 
+        is down (refer to email_spool.py). The queued emails to the same 
+        distribution group are combined into one per coalescing window, and 
+        every group is rate limited (a token bucket). The window and the 
+        rate limit of a group can be set in mailList.json ("coalesce_window" 
+        in seconds, "rate_burst" and "rate_per_hour").
+        Attachments are gzip-compressed and base64-encoded in chunks, without 
+        reading them into memory. An email carries at most 
+        MAX_ATTACHMENT_SIZE bytes of (compressed) attachments; larger ones 
+        are reduced to their first and last lines, and the ones that do not 
+        fit after the others are left out, with a note.
+        When called from the CLI, the exit status is 1 if the email could not 
+        be built or sent.
 
     Author:
         Alan Verdugo (alanvemu@mx1.ibm.com)
@@ -67,8 +91,8 @@ import os
 # Needed for system and environment information.
 import sys
 
-# For reading the dist, list.
-import json
+# For reading the dist, list (refer to config_loader.py)
+import config_loader
 
 # Email modules we will need.
 from email.mime.text import MIMEText
@@ -78,6 +102,24 @@ from email.mime.base import MIMEBase
 # The actual email-sending functionality.
 import smtplib
 
+# Errors of the SMTP connection.
+import socket
+
+# To know how long the SMTP session was idle.
+import time
+
+# To close the SMTP session when the process exits.
+import atexit
+
+# The attachments are compressed and encoded in chunks.
+import gzip
+import base64
+import shutil
+import tempfile
+
+# Custom module for the spool of outgoing emails (refer to email_spool.py)
+import email_spool
+
 # Handle output.
 import logging
 
@@ -97,6 +139,26 @@ mail_list_file = os.path.join(binary_home, "mailList.json")
 # The hostname of the SMTP server.
 smtp_server = "localhost"
 
+# Seconds to wait for the SMTP server.
+SMTP_TIMEOUT = 60
+
+# The most bytes of attachments (as they are attached, compressed) carried 
+# by an email. Larger attachments are reduced to their first and last lines.
+MAX_ATTACHMENT_SIZE = 10 * 1024 * 1024
+
+# What is kept out of the uncompressed bytes read of an attachment, for the 
+# gzip header and trailer (the deflate overhead of data that does not 
+# compress is about 5 bytes every 16 KB, well under 1%).
+GZIP_OVERHEAD = 1024
+
+# Attachments are read, compressed and encoded in chunks of this many bytes 
+# (a multiple of 57, which base64 encodes in one 76-character line).
+CHUNK_SIZE = 57 * 1024
+
+# An SMTP session idle for longer than this (in seconds) is checked with a 
+# NOOP before it is used again (servers drop idle clients after a while).
+SESSION_IDLE_TIMEOUT = 60
+
 # Logging configuration.
 log = logging.getLogger("emailer")
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
@@ -135,44 +197,328 @@ def get_args(arguments):
         type = str,
         nargs = "+",
         required = False)
+    parser.add_argument("-q", "--queue",
+        help = "Queue the email in the spool (delivered in the background) "\
+            "instead of sending it now.",
+        dest = "queue",
+        default = False,
+        action = "store_true")
     args = parser.parse_args()
 
-    build_email(args.distribution_group, args.email_subject, args.email_from,
-        args.message_body, args.attachments)
+    send = queue_email if args.queue else build_email
+    if not send(args.distribution_group, args.email_subject, 
+        args.email_from, args.message_body, args.attachments):
+        sys.exit(1)
+
+
+class SMTPSession(object):
+    '''
+        A connection to the SMTP server that is kept open across messages. 
+        It is opened on the first send, and reopened when the server closed 
+        it (or it was idle for longer than the server is likely to keep it), 
+        so a sender that notifies several times only pays for the 
+        connection setup once.
+        send() returns True if the message was accepted; it never exits.
+    '''
+    def __init__(self, server=None, timeout=SMTP_TIMEOUT, 
+        idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.server = server or smtp_server
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.connection = None
+        self.last_used = 0
+
+    def connect(self):
+        self.close()
+        self.connection = smtplib.SMTP(self.server, timeout=self.timeout)
+        self.last_used = time.time()
+
+    def close(self):
+        '''
+            Close the connection (if it is open).
+        '''
+        if self.connection is None:
+            return
+        try:
+            self.connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            self.connection.close()
+        self.connection = None
+
+    def _ensure_connected(self):
+        # An idle connection may have been dropped by the server, check it 
+        # with a NOOP instead of failing in the middle of a message.
+        if self.connection is not None and \
+            time.time() - self.last_used > self.idle_timeout:
+            try:
+                if self.connection.noop()[0] != 250:
+                    self.close()
+            except (smtplib.SMTPException, socket.error):
+                self.connection.close()
+                self.connection = None
+        if self.connection is None:
+            self.connect()
+
+    def send(self, email_from, email_to, message):
+        '''
+            Send one message. A connection that fails is reopened and the 
+            message is sent again (once). Returns True if the message was 
+            sent.
+        '''
+        for attempt in range(2):
+            try:
+                self._ensure_connected()
+            except (smtplib.SMTPException, socket.error) as exception:
+                # Unable to connect (E.g. a 421 greeting, or a failed
+                # EHLO/HELO): a connection failure, try again (or give up).
+                self.connection = None
+                error = exception
+                continue
+            try:
+                self.connection.sendmail(email_from, email_to, message)
+                self.last_used = time.time()
+                log.info("Notification email sent to {0}".format(email_to))
+                return True
+            except (smtplib.SMTPServerDisconnected, socket.error) as exception:
+                # The connection is not usable, reconnect (or give up).
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+                error = exception
+            except smtplib.SMTPException as exception:
+                # The server rejected this message, the connection is fine.
+                log.error("Unable to send notification email. "\
+                    "{0}".format(exception))
+                if self.connection is not None:
+                    try:
+                        self.connection.rset()
+                    except (smtplib.SMTPException, socket.error):
+                        self.close()
+                return False
+        log.error("Unable to send notification email. {0}".format(error))
+        return False
+
+    def send_many(self, messages):
+        '''
+            Send every message (a list of (email_from, email_to, message)) 
+            over the same connection. Returns the number of messages sent.
+        '''
+        return sum(1 for email_from, email_to, message in messages 
+            if self.send(email_from, email_to, message))
+
+
+# The session shared by every email sent by this process (refer to 
+# get_session).
+session = None
+
+
+def get_session():
+    '''
+        The SMTP session of this process (created on first use, and closed 
+        when the process exits).
+    '''
+    global session
+    if session is None:
+        session = SMTPSession()
+        atexit.register(session.close)
+    return session
 
 
 def send_email(email_from, email_to, message):
     '''
         This function will (finally) attempt to deliver the email that was 
-        built by the rest of the process.
+        built by the rest of the process. Returns True if it was sent.
     '''
-    try:
-        s = smtplib.SMTP(smtp_server)
-        s.sendmail(email_from, email_to, message)
-        s.quit()
-    except Exception as exception:
-        log.error("Unable to send notification email. {0}".format(exception))
-        sys.exit(1)
-    else:
-        log.info("Notification email sent to {0}".format(email_to))
-        exit(0)
+    return get_session().send(email_from, email_to, message)
 
 
-def build_email(distribution_group, email_subject, email_from, results_message, 
-    attachments):
+def send_emails(messages):
     '''
-        This function will build the email with all its parts and then it 
-        will attempt to send it using the send_email function.
+        Deliver a batch of emails (a list of (email_from, email_to, message), 
+        as returned by build_message) through the same SMTP session. Returns 
+        the number of emails sent.
+    '''
+    return get_session().send_many(messages)
+
+
+def get_group(distribution_group):
+    '''
+        The entry of distribution_group in the mailList.json file (its 
+        "members", and optionally its coalescing window and rate limit, 
+        refer to email_spool.group_policy), or None if it cannot be read.
     '''
-    # Open and parse the JSON file containing the recipients of the email.
+    # Open and parse the JSON file containing the recipients of the email 
+    # (once per process, with the groups indexed by name).
     try:
-        mail_list = json.load(open(mail_list_file, "r+"))
-        for email_groups in mail_list["groups"]:
-            if email_groups["name"] == distribution_group:
-                email_to = email_groups["members"]
+        mail_list = config_loader.load(mail_list_file, 
+            config_loader.compile_mail_list)
+        if distribution_group in mail_list["groups"]:
+            return mail_list["groups"][distribution_group]
     except Exception as exception:
         log.error("Cannot read email recipients list. {0}".format(exception))
-        sys.exit(2)
+        return None
+    log.error("The distribution group {0} is not in {1}".format(
+        distribution_group, mail_list_file))
+    return None
+
+
+def get_recipients(distribution_group):
+    '''
+        The members of distribution_group (from the mailList.json file), or 
+        None if they cannot be read.
+    '''
+    group = get_group(distribution_group)
+    if group is None:
+        return None
+    return group["members"]
+
+
+def head_and_tail(file_handle, size, limit):
+    '''
+        Yield the contents of file_handle (of size bytes, or None if it is 
+        not known, E.g. a decompressed stream) in chunks. If there are more 
+        than limit bytes, only the first and the last limit / 2 bytes are 
+        yielded (cut at line boundaries), with a note about the omitted 
+        bytes in between. The last value yielded is the number of omitted 
+        bytes (an int).
+    '''
+    half = limit // 2
+    head = file_handle.read(half)
+    if size is not None and size <= limit:
+        yield head
+        while True:
+            chunk = file_handle.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        yield 0
+        return
+    if size is not None:
+        # Only the tail is read.
+        file_handle.seek(max(len(head), size - half))
+        tail = file_handle.read()
+        omitted = size - len(head) - len(tail)
+    else:
+        # Keep the last half bytes of the stream.
+        chunks = []
+        kept = 0
+        omitted = 0
+        while True:
+            chunk = file_handle.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            kept += len(chunk)
+            while kept - len(chunks[0]) >= half:
+                kept -= len(chunks[0])
+                omitted += len(chunks.pop(0))
+        tail = b"".join(chunks)
+        if omitted == 0 and len(head) + len(tail) <= limit:
+            yield head
+            yield tail
+            yield 0
+            return
+        omitted += max(0, len(tail) - half)
+        tail = tail[-half:]
+    # Cut at the line boundaries.
+    newline = head.rfind(b"\n")
+    if newline >= 0:
+        omitted += len(head) - newline - 1
+        head = head[:newline + 1]
+    newline = tail.find(b"\n")
+    if newline >= 0:
+        omitted += newline + 1
+        tail = tail[newline + 1:]
+    yield head
+    yield "\n[... {0} bytes omitted by emailer.py ...]\n\n".format(
+        omitted).encode("ascii")
+    yield tail
+    yield omitted
+
+
+def attachment_part(attachment, budget):
+    '''
+        Build the MIME part of the file attachment: gzip-compressed (unless 
+        it already is), and base64-encoded in chunks, so the file is never 
+        read into memory as a whole. At most budget bytes (compressed, as 
+        they are attached) of it are attached: larger files are reduced to 
+        the head and tail that fit even if they do not compress. Returns the 
+        part (None if nothing fits in budget), the bytes of budget used and 
+        a note for the body of the email (or None).
+    '''
+    name = os.path.basename(attachment)
+    size = os.path.getsize(attachment)
+    # The uncompressed bytes that fit in budget once compressed.
+    limit = budget - budget // 100 - GZIP_OVERHEAD
+    if not (attachment.endswith(".gz") and size <= budget) and limit <= 0:
+        return None, 0, "The file {0} was not attached, the attachments of "\
+            "this email already reached {1} bytes.".format(attachment, 
+            MAX_ATTACHMENT_SIZE)
+    note = None
+    compressed = tempfile.TemporaryFile()
+    try:
+        if attachment.endswith(".gz") and size <= budget:
+            # Attached as it is.
+            with open(attachment, "rb") as source:
+                shutil.copyfileobj(source, compressed, CHUNK_SIZE)
+        else:
+            if attachment.endswith(".gz"):
+                source = gzip.open(attachment, "rb")
+                source_size = None
+                name = name[:-len(".gz")]
+            else:
+                source = open(attachment, "rb")
+                source_size = size
+            destination = gzip.GzipFile(filename=name, mode="wb", 
+                fileobj=compressed)
+            try:
+                for chunk in head_and_tail(source, source_size, limit):
+                    if isinstance(chunk, int):
+                        omitted = chunk
+                    else:
+                        destination.write(chunk)
+            finally:
+                destination.close()
+                source.close()
+            if omitted:
+                note = "The file {0} was too large for this email, only its "\
+                    "first and last lines were attached ({1} bytes were "\
+                    "omitted).".format(attachment, omitted)
+            name += ".gz"
+
+        # The bytes attached.
+        used = compressed.tell()
+
+        # base64, one chunk at a time (CHUNK_SIZE is a multiple of 57 bytes, 
+        # which are encoded in one 76-character line).
+        compressed.seek(0)
+        lines = []
+        while True:
+            chunk = compressed.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            encoded = base64.b64encode(chunk).decode("ascii")
+            lines.extend(encoded[index:index + 76] 
+                for index in range(0, len(encoded), 76))
+    finally:
+        compressed.close()
+    part = MIMEBase("application", "gzip")
+    part.set_payload("\n".join(lines) + "\n")
+    part["Content-Transfer-Encoding"] = "base64"
+    part.add_header("Content-Disposition", "attachment", filename=name)
+    return part, used, note
+
+
+def build_message(distribution_group, email_subject, email_from, 
+    results_message, attachments):
+    '''
+        This function will build the email with all its parts. Returns 
+        (email_from, email_to, message), ready for send_email (or 
+        send_emails), or None if it cannot be built.
+    '''
+    email_to = get_recipients(distribution_group)
+    if email_to is None:
+        return None
 
     # The whole email will consist of two parts: The text/body and the 
     # attachments. We will need to "attach" the two parts to the message.
@@ -183,18 +529,21 @@ def build_email(distribution_group, email_subject, email_from, results_message,
     # A list of filenames that could not be properly attached (if any).
     failed_attachments = []
 
+    # Notes about the attachments that were truncated (if any).
+    attachment_notes = []
+
     # If any attachments were specified, open the file(s) and attach them to 
-    # the message.
+    # the message (compressed, and within MAX_ATTACHMENT_SIZE).
     if attachments != None:
+        budget = MAX_ATTACHMENT_SIZE
         for attachment in attachments:
             try:
-                with open(attachment) as fp:
-                    part1 = MIMEBase("application", "octet-stream")
-                    part1.set_payload(fp.read())
-                # After the file is closed
-                part1.add_header("Content-Disposition", "attachment", 
-                    filename=os.path.basename(attachment))
-                msg.attach(part1)
+                part1, used, note = attachment_part(attachment, budget)
+                budget -= used
+                if part1 is not None:
+                    msg.attach(part1)
+                if note:
+                    attachment_notes.append(note)
             except Exception as exception:
                 # If there is a problem while attaching a file, let's continue 
                 # with the remaining files (if any). Note: In this way, we may 
@@ -214,7 +563,7 @@ def build_email(distribution_group, email_subject, email_from, results_message,
         except Exception as exception:
             log.error("Unable to read file: {0} Exception: "\
                 "{1}".format(body_file, exception))
-            sys.exit(3)
+            return None
 
     # If there were problem while attaching files, let's add a note to the 
     # email's body.
@@ -222,12 +571,57 @@ def build_email(distribution_group, email_subject, email_from, results_message,
         for failed_attachment in failed_attachments:
             results_message = results_message + "\n\rThe file {0} was unable "\
             "to be attached to this email.".format(failed_attachment)
+    for note in attachment_notes:
+        results_message = results_message + "\n\r" + note
 
     part2 = MIMEText(results_message, "plain")
     msg.attach(part2)
+    return email_from, email_to, msg.as_string()
+
 
+def build_email(distribution_group, email_subject, email_from, results_message, 
+    attachments):
+    '''
+        This function will build the email with all its parts and then it 
+        will attempt to send it using the send_email function. Returns True 
+        if it was sent.
+    '''
+    message = build_message(distribution_group, email_subject, email_from, 
+        results_message, attachments)
+    if message is None:
+        return False
     # Finally, attempt to send the email by calling the send_email function.
-    send_email(email_from, email_to, msg.as_string())
+    return send_email(*message)
+
+
+def queue_email(distribution_group, email_subject, email_from, 
+    results_message, attachments):
+    '''
+        Like build_email, but the email is written to the spool (refer to 
+        email_spool.py) and delivered by a background sender, so this 
+        returns as soon as it is queued (True), whether the SMTP server is 
+        up or not. If it cannot be queued, it is sent right away.
+        The emails to the same group are combined during the coalescing 
+        window of the group, and rate limited (refer to 
+        email_spool.group_policy).
+    '''
+    message = build_message(distribution_group, email_subject, email_from, 
+        results_message, attachments)
+    if message is None:
+        return False
+    email_from, email_to, message_string = message
+    try:
+        email_spool.Spool().hold(distribution_group, 
+            email_spool.group_policy(get_group(distribution_group)), 
+            email_from, email_to, email_subject, message_string)
+        email_spool.start_sender()
+    except Exception as exception:
+        # E.g. the spool is not writable (IOError, OSError), or the message
+        # cannot be written as JSON (ValueError).
+        log.error("Unable to queue the notification email, sending it "\
+            "now. {0}".format(exception))
+        return send_email(*message)
+    return True
 
 
 if __name__ == "__main__":
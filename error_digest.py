@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+'''
+    Usage:
+        import error_digest
+
+        digest = error_digest.ErrorDigest()
+        digest.add("Nightly", "2017-11-23 03:00:01", "Connection 1234 refused")
+        ...
+        suppression = error_digest.SuppressionStore(state_file, window=3600)
+        groups = suppression.filter(digest.groups())
+        suppression.save()
+        if groups:
+            body = error_digest.format_digest(groups)
+
+    Description:
+        When a shared dependency breaks (the database, a mount), every job
+        logs the same ERROR messages, only with different timestamps and
+        ids. The messages are normalized (timestamps, ids and numbers are
+        replaced by placeholders) and hashed into a fingerprint, and the
+        errors of every job (and every log) are grouped by fingerprint, so a
+        single digest lists each distinct error once, with the number of
+        occurrences and the jobs that logged it.
+        A fingerprint that was reported is not reported again during the
+        suppression window. The time it was last reported (and the
+        occurrences suppressed since then) are stored in a JSON file, so the
+        window holds across executions; the suppressed occurrences are
+        included in the next digest of the fingerprint.
+'''
+
+# Needed for system and environment information.
+import os
+
+# Normalizing the messages.
+import re
+
+# Fingerprints of the normalized messages.
+import hashlib
+
+# To read and write the suppression state.
+import json
+
+# To get current seconds since Epoch.
+import time
+
+# Handle logging.
+import logging
+
+
+# What is replaced in the messages before they are fingerprinted, in order
+# (the first patterns are the most specific ones).
+NORMALIZATIONS = [
+    # 2017-11-23 03:00:01.123, 2017-11-23T03:00:01
+    (re.compile(r"\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?"),
+        "<TIME>"),
+    # 2017-11-23, 2017/11/23, 11/23/2017
+    (re.compile(r"\d{4}[-/]\d{2}[-/]\d{2}|\d{2}/\d{2}/\d{4}"), "<DATE>"),
+    # 03:00:01, 3:00:01.123
+    (re.compile(r"\d{1,2}:\d{2}:\d{2}(?:[.,]\d+)?"), "<TIME>"),
+    # UUIDs.
+    (re.compile(r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-"
+        r"[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b"), "<ID>"),
+    # Hexadecimal ids and addresses.
+    (re.compile(r"\b0x[0-9a-fA-F]+\b|\b(?=[0-9a-fA-F]*\d)[0-9a-fA-F]{8,}\b"),
+        "<ID>"),
+    # Any other number (process ids, record counts, CCYYMMDD dates).
+    (re.compile(r"\d+"), "<N>"),
+    (re.compile(r"\s+"), " "),
+]
+
+# Fingerprints that were not reported in this many seconds are forgotten.
+STATE_MAX_AGE = 7 * 24 * 3600
+
+# Logging configuration.
+log = logging.getLogger("error_digest")
+
+
+def normalize_message(message):
+    '''
+        The message without the parts that change between occurrences of
+        the same error. An empty (or None) message is normalized to "".
+    '''
+    if not message:
+        return ""
+    for pattern, replacement in NORMALIZATIONS:
+        message = pattern.sub(replacement, message)
+    return message.strip()
+
+
+def fingerprint(message):
+    '''
+        The fingerprint (a hex digest) of the normalized message.
+    '''
+    normalized = normalize_message(message)
+    if not isinstance(normalized, bytes):
+        normalized = normalized.encode("utf-8")
+    return hashlib.md5(normalized).hexdigest()
+
+
+class ErrorGroup(object):
+    '''
+        The occurrences of one error (fingerprint).
+    '''
+    __slots__ = ("fingerprint", "message", "count", "jobs", "first_time",
+        "last_time", "suppressed")
+
+    def __init__(self, fingerprint, message):
+        self.fingerprint = fingerprint
+        # The first message, as it was logged.
+        self.message = message
+        self.count = 0
+        # The jobs that logged the error, in the order they were seen.
+        self.jobs = []
+        self.first_time = None
+        self.last_time = None
+        # Occurrences suppressed since the last time it was reported.
+        self.suppressed = 0
+
+
+class ErrorDigest(object):
+    '''
+        The errors of one execution, grouped by fingerprint (in the order
+        the fingerprints were first seen).
+    '''
+    def __init__(self):
+        self.by_fingerprint = {}
+        self.order = []
+        self.total = 0
+
+    def __len__(self):
+        return self.total
+
+    def __nonzero__(self):
+        return self.total > 0
+
+    __bool__ = __nonzero__
+
+    def add(self, job_name, timestamp, message):
+        self.total += 1
+        message = message or ""
+        key = fingerprint(message)
+        group = self.by_fingerprint.get(key)
+        if group is None:
+            group = self.by_fingerprint[key] = ErrorGroup(key, message)
+            self.order.append(key)
+        group.count += 1
+        if job_name not in group.jobs:
+            group.jobs.append(job_name)
+        if group.first_time is None:
+            group.first_time = timestamp
+        group.last_time = timestamp
+
+    def groups(self):
+        return [self.by_fingerprint[key] for key in self.order]
+
+
+class SuppressionStore(object):
+    '''
+        The time every fingerprint was last reported, and the occurrences
+        suppressed since, kept in state_file. A window of 0 suppresses
+        nothing.
+    '''
+    def __init__(self, state_file, window):
+        self.state_file = state_file
+        self.window = window
+        self.state = {}
+        try:
+            with open(state_file) as file_handle:
+                self.state = json.load(file_handle)
+        except (IOError, ValueError) as exception:
+            if os.path.exists(state_file):
+                log.warning("Ignoring unreadable suppression state {0}. "\
+                    "Exception: {1}".format(state_file, exception))
+
+    def filter(self, groups, now=None):
+        '''
+            Return the groups that should be reported now (recording them as
+            reported), and count the occurrences of the others as
+            suppressed.
+        '''
+        now = time.time() if now is None else now
+        reported = []
+        for group in groups:
+            entry = self.state.get(group.fingerprint)
+            if entry is not None and now - entry["sent"] < self.window:
+                entry["suppressed"] += group.count
+                continue
+            if entry is not None:
+                group.suppressed = entry["suppressed"]
+            self.state[group.fingerprint] = {"sent": now, "suppressed": 0}
+            reported.append(group)
+        return reported
+
+    def save(self, now=None):
+        now = time.time() if now is None else now
+        for key in list(self.state):
+            if now - self.state[key]["sent"] > max(self.window,
+                STATE_MAX_AGE):
+                del self.state[key]
+        temporary_file = self.state_file + ".tmp"
+        try:
+            with open(temporary_file, "w") as file_handle:
+                json.dump(self.state, file_handle)
+            os.rename(temporary_file, self.state_file)
+        except (IOError, OSError) as exception:
+            log.error("Unable to write the suppression state {0}. "\
+                "Exception: {1}".format(self.state_file, exception))
+
+
+def format_digest(groups, line_separator="\n"):
+    '''
+        The body of the digest of groups: every distinct error once, with
+        its occurrences and jobs.
+    '''
+    lines = []
+    for group in groups:
+        lines.append("{0} occurrence(s) in {1}: {2}".format(group.count,
+            ", ".join(group.jobs), group.message or "(no message text)"))
+        if group.count > 1:
+            lines.append("    First: {0} Last: {1}".format(group.first_time,
+                group.last_time))
+        else:
+            lines.append("    Timestamp: {0}".format(group.first_time))
+        if group.suppressed:
+            lines.append("    (plus {0} occurrence(s) suppressed since it "\
+                "was last reported)".format(group.suppressed))
+    return line_separator.join(lines)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+'''
+    Usage:
+        import error_sink
+
+        errors = error_sink.ErrorSink("csr_checker")
+        errors.add("File not found: /path/to/file", "File not found")
+        if errors:
+            body = errors.summary("The following errors were found:")
+            attachment = errors.attachment()
+            # Send the notification, then:
+            errors.reset()
+
+    Description:
+        The checkers (csr_checker.py and findMissingCSR.py) used to keep every
+        error message in a list and join them into the body of the
+        notification email. When a mount disappears, that list (and the email)
+        can grow to several megabytes.
+        An ErrorSink streams every error to a spool file and only keeps, in
+        memory, a counter per category and the first few messages. The
+        notification email carries the summary, and the full list of errors
+        is attached as a gzip-compressed file.
+'''
+
+# Needed for system and environment information.
+import os
+
+# For the timestamp in the spool filename.
+from datetime import datetime
+
+# To compress the full list of errors.
+import gzip
+
+# Copying the spool file into the compressed file in chunks.
+import shutil
+
+# In case the spool directory cannot be used.
+import tempfile
+
+# Handle logging.
+import logging
+
+
+# Where the spool files are written.
+spool_dir = os.path.join(os.sep, "tmp", "logs", "sccm")
+
+# How many error messages are kept in memory (and included in the summary).
+MAX_EXAMPLES = 20
+
+# Logging configuration.
+log = logging.getLogger("error_sink")
+
+
+class ErrorSink(object):
+    '''
+        Collects the errors of one execution of a checker. The spool file is
+        only created when the first error is added.
+    '''
+    def __init__(self, name, max_examples=MAX_EXAMPLES, directory=None):
+        self.name = name
+        self.max_examples = max_examples
+        self.directory = directory or spool_dir
+        self.total = 0
+        # Category -> count, and the order in which categories appeared.
+        self.counts = {}
+        self.categories = []
+        self.examples = []
+        self.spool = None
+        self.spool_file = None
+
+    def __len__(self):
+        return self.total
+
+    def __nonzero__(self):
+        return self.total > 0
+
+    __bool__ = __nonzero__
+
+    def _open_spool(self):
+        '''
+            Create the spool file (falling back to the system's temporary
+            directory if spool_dir cannot be used).
+        '''
+        prefix = "{0}_errors_{1}_".format(self.name,
+            datetime.now().strftime("%Y%m%d_%H%M%S"))
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            file_descriptor, self.spool_file = tempfile.mkstemp(
+                prefix=prefix, suffix=".log", dir=self.directory)
+        except (IOError, OSError) as exception:
+            log.warning("Unable to create spool file in {0}. Exception: "\
+                "{1}".format(self.directory, exception))
+            file_descriptor, self.spool_file = tempfile.mkstemp(
+                prefix=prefix, suffix=".log")
+        self.spool = os.fdopen(file_descriptor, "w")
+
+    def add(self, message, category="Error"):
+        '''
+            Record an error. Only the first max_examples messages are kept in
+            memory, all of them are written to the spool file.
+        '''
+        self.total += 1
+        if category not in self.counts:
+            self.counts[category] = 0
+            self.categories.append(category)
+        self.counts[category] += 1
+        if len(self.examples) < self.max_examples:
+            self.examples.append(message)
+        if self.spool is None:
+            self._open_spool()
+        self.spool.write(message.rstrip("\n") + "\n")
+
+    def summary(self, header=None, footer=None):
+        '''
+            Build the body of the notification email: the counters per
+            category and the first errors.
+        '''
+        lines = []
+        if header:
+            lines.append(header)
+        lines.append("{0} error(s) found:".format(self.total))
+        for category in self.categories:
+            lines.append("    {0}: {1}".format(category,
+                self.counts[category]))
+        lines.append("")
+        if self.total > len(self.examples):
+            lines.append("First {0} errors:".format(len(self.examples)))
+        lines.extend(example.rstrip("\n") for example in self.examples)
+        if self.total > len(self.examples):
+            lines.append("")
+            lines.append("... and {0} more. The full list of errors is "\
+                "attached to this email.".format(
+                self.total - len(self.examples)))
+        if footer:
+            lines.append(footer)
+        return "\n".join(lines)
+
+    def attachment(self):
+        '''
+            Close the spool file and compress it. Returns the path of the
+            compressed file, or None if there is nothing that is not already
+            part of the summary.
+        '''
+        if self.spool is None or self.total <= len(self.examples):
+            return None
+        self.spool.close()
+        compressed_file = self.spool_file + ".gz"
+        try:
+            with open(self.spool_file, "rb") as source:
+                destination = gzip.open(compressed_file, "wb")
+                try:
+                    shutil.copyfileobj(source, destination)
+                finally:
+                    destination.close()
+        except (IOError, OSError) as exception:
+            log.error("Unable to compress {0}. Exception: {1}".format(
+                self.spool_file, exception))
+            return self.spool_file
+        os.remove(self.spool_file)
+        self.spool = None
+        self.spool_file = compressed_file
+        return compressed_file
+
+    def reset(self):
+        '''
+            Forget all the errors (E.g. after a notification was sent). The
+            spool file (or its compressed copy, refer to attachment) is
+            removed.
+        '''
+        if self.spool is not None:
+            self.spool.close()
+        if self.spool_file is not None and os.path.exists(self.spool_file):
+            try:
+                os.remove(self.spool_file)
+            except OSError as exception:
+                log.warning("Unable to remove {0}. Exception: {1}".format(
+                    self.spool_file, exception))
+        self.__init__(self.name, self.max_examples, self.directory)
@@ -2,7 +2,8 @@
 '''
     Usage:
         findMissingCSR.py [-h] [-v]
-            [-y YEAR]
+            [-y YEAR] [-a | -u] [-j JOBS] [-i] [-g MINUTES]
+            [--from FROM_DATE] [--to TO_DATE] [--history FEED]
             [-m {01,02,03,04,05,06,07,08,09,10,11,12}]
             [-d {01,02,03,04,05,06,07,08,09,10,11,12,13,14,15,16,17,18,19,20,
                 21,22,23,24,25,26,27,28,29,30,31}]
@@ -27,6 +28,32 @@
             Check all 24 hours of the day (00:00:00 to 23:00:00).
         -u, --uptonow
             Check all hours of the day up to 'now' (00:00:00 to XX:00:00).
+        -j JOBS, --jobs JOBS
+            Number of worker processes used to check the providers 
+            concurrently. Defaults to 1 (one provider after another).
+        -i, --incremental
+            Only read the data appended to the CSR files since the previous 
+            incremental run (useful for the hourly checks). The offsets are 
+            kept in /tmp/logs/sccm/checkMCS_state.json. Files that were 
+            rotated, truncated or rewritten are read from the beginning.
+        -g MINUTES, --gaps MINUTES
+            Also report every gap longer than MINUTES between the MCS 
+            entries (using their start and end times), so a feed that stops 
+            in the middle of an hour is noticed before the next hour. The 
+            threshold of a provider can be changed in 
+            /opt/ibm/sccm/bin/custom/MCS_gap_thresholds.json, a JSON object 
+            of provider name -> minutes (0 disables the check).
+        --from FROM_DATE
+            Backfill: check all 24 hours of every day from this date 
+            (CCYYMMDD) up to the --to date, for all the providers, in one 
+            process (use -j to fan the checks out over worker processes).
+        --to TO_DATE
+            The last date (CCYYMMDD) of --from or --history. Defaults to 
+            yesterday (in UTC).
+        --history FEED
+            Print the missing hours of FEED for every day from --from to 
+            --to (defaults to the last 30 days), using only the coverage 
+            history. No CSR file is read and no email is sent.
 
     Description:
         This program will check the CSR files from MCS looking for missing data.
@@ -34,6 +61,9 @@
         people (i.e. the people listed under the MCS_checker group in the 
         distribution list JSON file.)
         Not to be confused with csr_checker.py
+        The hour coverage of every (provider, day) checked is kept in a 
+        compact memory-mapped file (/opt/ibm/sccm/logs/checkMCS_coverage.dat, 
+        refer to coverage_store.py) covering the last 512 days.
 
     Author:
         Alan Verdugo (alanvemu@mx1.ibm.com)
@@ -62,7 +92,7 @@ import sys
 import socket
 
 # For timestamp information in the email subject.
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # Handling arguments.
 import argparse
@@ -70,6 +100,15 @@ import argparse
 # Custom module for email sending (refer to emailer.py)
 import emailer
 
+# Custom module for collecting the errors (refer to error_sink.py)
+import error_sink
+
+# Custom module for the hour coverage history (refer to coverage_store.py)
+import coverage_store
+
+# Custom module for the MCS providers (refer to provider_registry.py)
+import provider_registry
+
 # Handle logging.
 import logging
 
@@ -79,6 +118,20 @@ import csv
 # To get the providers from its "JSON" file.
 import json
 
+# To check the providers concurrently.
+import multiprocessing
+
+# For the incremental mode state (partial lines are stored in base64, and a 
+# checksum of the last bytes read detects rewritten files).
+import base64
+import zlib
+
+# To expire old entries of the incremental mode state.
+import time
+
+# The latest end time per second of the day (gap detection).
+import array
+
 
 # Home of the SCCM installation.
 sccm_home = os.path.join(os.sep, "opt", "ibm", "sccm")
@@ -95,11 +148,42 @@ mcs_home = os.path.join(sccm_home,'wlp', 'usr', 'servers', 'mcs')
 # MCS configuration file of providers.
 provider_file = os.path.join(mcs_home, 'data', 'providers.json')
 
+# The providers (with their process and directory) are loaded once per 
+# execution, and their parsed file is cached here.
+registry = None
+
 # Logs home directory.
 log_dir = os.path.join(os.sep, "tmp", "logs", "sccm")
 log_filename = "checkMCS_" + str(datetime.now().strftime("%Y%m%d")) + ".log"
 full_log_file_name = os.path.join(log_dir, log_filename)
 
+# Where the incremental mode (-i/--incremental) remembers how much of every 
+# CSR file was already read. Losing this file only means the next run will 
+# read the files from the beginning.
+state_file = os.path.join(log_dir, "checkMCS_state.json")
+
+# Where the parsed providers file is cached (refer to provider_registry.py).
+provider_cache_file = os.path.join(log_dir, "checkMCS_providers.json")
+
+# The hour coverage of every (provider, day) checked is kept in this file, so 
+# the history can be queried (--history) without reading the CSR files.
+coverage_file = os.path.join(sccm_home, "logs", "checkMCS_coverage.dat")
+
+# Entries of the state file that were not updated in this many seconds are 
+# removed (their CSR files belong to previous days).
+STATE_MAX_AGE = 3 * 24 * 3600
+
+# The incremental mode reads the new data in chunks of this size, and 
+# verifies that this many bytes before the last offset did not change.
+READ_CHUNK_SIZE = 1024 * 1024
+TAIL_CHECK_SIZE = 4096
+
+# Gap detection (-g/--gaps) thresholds per provider (in minutes), if they 
+# differ from the one given in the command line.
+gap_thresholds_file = os.path.join(binary_home, "MCS_gap_thresholds.json")
+
+SECONDS_PER_DAY = 24 * 3600
+
 # The hostname where this is running.
 hostname = socket.gethostname()
 
@@ -109,15 +193,28 @@ email_from = "SCCM_" + hostname + "@" + hostname
 # List of metadata fields that should be present in every CSR record.
 metadata = ["ActionInProgress", "NetworkZone", "TemplateName"]
 
+# The compiled check of the metadata fields (refer to get_validator()).
+validator = None
+NO_FIELDS = frozenset()
+
+# How many sample records are reported for every combination of missing 
+# metadata fields of a feed.
+METADATA_SAMPLES = 3
+
+# Bit of every hour in the hour coverage bitmaps, indexed by the "HH" part 
+# of the start time (E.g. "03" -> 0b1000). A dict lookup is much cheaper 
+# than int() for every record.
+HOUR_BITS = dict(("{0:02d}".format(hour), 1 << hour) for hour in range(24))
+
 # JSON Object of mail_list_file.
 mail_list = ""
 
 # Email distribution group.
 distribution_group = "MCS_checker"
 
-# Error list initialization (just in case we need it).
-errors = []
-errors_found = False
+# The errors found (streamed to a spool file, only their counters and the 
+# first few messages are kept in memory).
+errors = error_sink.ErrorSink("checkMCS")
 
 # Logging configuration.
 log = logging.getLogger("findMissingCSR")
@@ -128,36 +225,82 @@ fh.setFormatter(formatter)
 log.addHandler(fh)
 
 
-def handle_error(error):
+def handle_error(error, category="Error"):
     '''
         To avoid duplication of code, this function will take an error message 
-        and append it to the "errors" list (which then will be used to build 
-        the notification email). It will also log the error and set the 
-        boolean variable "errors_found" to True.
+        and add it to the "errors" sink (which then will be used to build 
+        the notification email). It will also log the error.
     '''
-    global errors_found
-    errors_found = True
-    errors.append(error)
+    errors.add(error, category)
     log.error(error)
 
 
+def get_registry():
+    '''
+        Return the provider registry (refer to provider_registry.py), loading 
+        it (or reloading it, if the providers file changed) first. The parsed 
+        providers file is cached in provider_cache_file, so it is only parsed 
+        again when it changes.
+    '''
+    global registry
+    if registry is None:
+        registry = provider_registry.ProviderRegistry(provider_file, 
+            COLLECTOR_LOGS, provider_cache_file)
+    else:
+        registry.load()
+    return registry
+
+
 def get_providers():
     '''
         (Based on Scott's get_providers.py)
-        The providers file, for ridiculous and mysterious reason stores one JSON 
-        object per line, so we cannot parse the file in the normal way. We have 
-        to parse each line as if it were a complete JSON file.
+        Return the names of the MCS providers, or None if the providers file 
+        cannot be read. The providers file, for ridiculous and mysterious 
+        reason stores one JSON object per line (refer to 
+        provider_registry.py).
     '''
     try:
-        providers = []
-        with open(provider_file, "rb") as file_handle:
-            for row in file_handle:
-                provider_line = json.loads(row)
-                providers.append(provider_line['provider_name'])
-        return providers
+        return get_registry().names()
     except Exception as exception:
         handle_error("Error reading providers file {0} \nException: "\
-            "{1}".format(provider_file, exception))
+            "{1}".format(provider_file, exception), "Unreadable file")
+
+
+class MetadataValidator(object):
+    '''
+        Checks that every metadata field is present in a CSR record, in one 
+        pass over the record (instead of one "field in row" scan per field).
+        The identifier names are always in the same columns for records with 
+        the same layout, so the positions of the fields in the first complete 
+        record are remembered, and the following records are checked with a 
+        direct comparison at those positions. Records with another layout 
+        fall back to the set difference.
+    '''
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.required = frozenset(fields)
+        # ((position, field), ...) of the known layout, or None.
+        self.positions = None
+
+    def missing(self, row):
+        '''
+            Return the (frozen)set of metadata fields missing from row, which 
+            is empty if the record is valid.
+        '''
+        if self.positions is not None:
+            try:
+                for position, field in self.positions:
+                    if row[position] != field:
+                        break
+                else:
+                    return NO_FIELDS
+            except IndexError:
+                pass
+        missing_fields = self.required.difference(row)
+        if not missing_fields and self.positions is None:
+            self.positions = tuple((row.index(field), field) 
+                for field in self.fields)
+        return missing_fields
 
 
 def search_metadata(row):
@@ -167,142 +310,641 @@ def search_metadata(row):
         will return True, otherwise it will return False (so, if any metadata
         field is missing, we will get an alert).
     '''
-    found_fields = 0
-    for field in metadata:
-        if field in row:
-            found_fields += 1
-    if found_fields == len(metadata):
-        return True
-    else:
-        return False
+    return not get_validator().missing(row)
 
 
-def main(full_date, all_day, up_to_now):
-    # Initializing the errors list with a "header" value.
-    errors.append("The following errors were found while verifying the MCS "\
-        "data for {0} in {1}:\n".format(full_date, hostname))
+def get_validator():
+    '''
+        Return the validator of the metadata fields, compiling it again if the 
+        metadata list was changed.
+    '''
+    global validator
+    if validator is None or validator.fields != tuple(metadata):
+        validator = MetadataValidator(metadata)
+    return validator
 
-    # Get a list of providers using the get_providers() function.
-    providers = get_providers()
-    if providers is None:
-        handle_error("No active MCS providers were found in {0}"\
-            .format(provider_file))
+
+def add_metadata_failure(failures, missing_fields, row):
+    '''
+        Count a record with missing metadata fields in failures (missing 
+        field combination -> [count, sample records]), keeping only the first 
+        METADATA_SAMPLES records of every combination.
+    '''
+    failure = failures.get(missing_fields)
+    if failure is None:
+        failures[missing_fields] = [1, [row]]
     else:
-        # Infer the "process" from the provider name.
-        for provider in providers:
-            if provider.endswith("_nova"):
-                process = "nova_compute"
-            elif provider.endswith("_cinder"):
-                # per Charlotte Despres, ICO's OpenStack cinder does not support 
-                # additional volumes with VMware, so we expect no records.
-                # Let's just silently ignore any cinder providers with "VMWARE" 
-                # on their names.
-                if "VMWARE" in provider:
-                    log.info("Ignoring provider {0} (Currently, there is no "\
-                        "support for VMware cinder).".format(provider))
-                    continue
-                else:
-                    process = "cinder_volume"
-            else:
-                handle_error("The provider {0} is not valid.".format(provider))
-            feed = provider
+        failure[0] += 1
+        if len(failure[1]) < METADATA_SAMPLES:
+            failure[1].append(row)
 
-            log.info("Checking CSR files for {0}...\n\tIn feed: {1}\n\tIn "\
-                "process: {2}".format(full_date, feed, process))
 
-            # Build the full path and filename of the input file.
-            input_file = full_date + ".txt"
-            input_file_path = os.path.join(COLLECTOR_LOGS, process, feed)
-            full_input_file = os.path.join(input_file_path, input_file)
+def report_metadata_failures(feed, failures, report=handle_error):
+    '''
+        Report one error per missing field combination of the feed, with the 
+        number of records and a few samples (instead of one error per 
+        record).
+    '''
+    for missing_fields in sorted(failures, key=sorted):
+        count, samples = failures[missing_fields]
+        report("{0} record(s) of {1} are missing the metadata field(s) {2}. "\
+            "Sample record(s):\n{3}\n".format(count, feed, 
+            ", ".join(sorted(missing_fields)), 
+            "\n".join(str(row) for row in samples)), "Missing metadata")
 
-            # Ensure the input file exist.
-            if os.path.exists(input_file_path):
-                if os.path.isfile(full_input_file):
-                    log.info("Now checking {0}".format(full_input_file))
-                else:
-                    handle_error("The file {0} does not exist or is not a "\
-                        "valid file.".format(full_input_file))
-            else:
-                handle_error("The directory {0} does not exist or is not a "\
-                    "valid directory.".format(input_file_path))
 
-            # Read the CSR file and get the unique contents of the fourth 
-            # column (which is the start time of the MCS entry with format 
-            # HH:MM:SS).
-            file_hours = []
-            try:
-                with open(full_input_file, "rb") as file_handle:
-                    reader = csv.reader(file_handle)
-                    for row in reader:
-                        if row[3] not in file_hours:
-                            file_hours.append(row[3])
-                        # Search for metadata fields in the record.
-                        if search_metadata(row) == False:
-                            handle_error("Missing metadata field(s) in the "\
-                                "following record:\n{0}\n".format(row))
-            except Exception as exception:
-                handle_error("Error reading CSR input file {0} \nException: "\
-                    "{1}".format(full_input_file, exception))
-
-            # Get the current timestamp and remove the minutes and seconds.
-            # RabbitMQ events use UTC timestamps so all timestamps in this code 
-            # should be handled in UTC.
-            rounded_current_hour = datetime.utcnow().strftime("%H")
-            rounded_current_time = datetime.utcnow().replace(minute=0, 
-                second=0).strftime("%H:%M:%S")
-
-            # According to what the user specified, build list of hours for 
-            # comparison against the content of the CSR file.
-            comparison_hours = []
-            if all_day == True:
-                # Build a list with all the hours of the day.
-                log.info("Now checking entries from 00:00:00 to 23:00:00...")
-                for i in range(0, 24):
-                    # (range() is not inclusive so we need to add 1 for 
-                    # convenience)
-                    hour = datetime.now().replace(hour=i, minute=0, second=0)\
-                        .strftime("%H:%M:%S")
-                    if hour not in comparison_hours:
-                        comparison_hours.append(hour)
-            elif up_to_now == True:
-                # Build a list with all the hours up until now.
-                log.info("Now checking entries from 00:00:00 to {0}..."\
-                    .format(rounded_current_time))
-                for i in range(0, int(rounded_current_hour)+1):
-                    # (range() is not inclusive so we need to add 1 for 
-                    # convenience)
-                    hour = datetime.now().replace(hour=i, minute=0, second=0)\
-                        .strftime("%H:%M:%S")
-                    if hour not in comparison_hours:
-                        comparison_hours.append(hour)
+def hour_mask(first_hour, last_hour):
+    '''
+        Return the bitmap with the bits of the hours from first_hour to 
+        last_hour (inclusive) set.
+    '''
+    return ((1 << (last_hour + 1)) - 1) & ~((1 << first_hour) - 1)
+
+
+def seconds_of_day(time_string):
+    '''
+        Convert a HH:MM:SS time into seconds since midnight.
+    '''
+    return (int(time_string[:2]) * 3600 + int(time_string[3:5]) * 60 + 
+        int(time_string[6:8]))
+
+
+def format_seconds(seconds):
+    '''
+        Convert seconds since midnight into HH:MM:SS.
+    '''
+    return "{0:02d}:{1:02d}:{2:02d}".format(seconds // 3600, 
+        seconds // 60 % 60, seconds % 60)
+
+
+class GapFinder(object):
+    '''
+        Finds the gaps between the (start, end) intervals of the records of 
+        one day.
+        Instead of collecting and sorting the start times of all the records 
+        (which needs memory for every record), the latest end time of the 
+        records is kept for every second of the day. That array is already 
+        sorted by start time, so the covered intervals are merged with a 
+        single sweep over it. This takes 86400 integers (about 340 KB) no 
+        matter how big the file is, and linear time.
+    '''
+    def __init__(self):
+        self.ends = array.array("i", [-1]) * SECONDS_PER_DAY
+
+    def add(self, start, end):
+        '''
+            Add the interval of a record (in seconds since midnight). A 
+            record that ends on the next day covers the rest of the day.
+        '''
+        if end < start:
+            end = SECONDS_PER_DAY - 1
+        if end > self.ends[start]:
+            self.ends[start] = end
+
+    def add_record(self, row):
+        '''
+            Add the interval of a CSR record (start and end times in the 
+            fourth and fifth columns). Malformed times are ignored.
+        '''
+        try:
+            self.add(seconds_of_day(row[3]), seconds_of_day(row[4]))
+        except (IndexError, ValueError):
+            pass
+
+    def intervals(self):
+        '''
+            Return the merged covered intervals, as a sorted list of 
+            [start, end] (inclusive) lists. Adjacent intervals are merged.
+        '''
+        merged = []
+        current_start = current_end = -1
+        for start, end in enumerate(self.ends):
+            if end < 0:
+                continue
+            if current_start >= 0 and start <= current_end + 1:
+                if end > current_end:
+                    current_end = end
             else:
-                # We will check only the current hour.
-                log.info("Now checking entries for {0}..."\
-                    .format(rounded_current_time))
-                comparison_hours.append(rounded_current_time)
-
-            # Any missing entries/hours in the CSR should be reported.
-            for hour in comparison_hours:
-                if hour not in file_hours:
-                    handle_error("Missing MCS entries for {0} (process: "\
-                        "{1}, feed: {2})".format(hour, process, feed))
-                else:
-                    log.info("Entries found for {0}".format(hour))
+                if current_start >= 0:
+                    merged.append([current_start, current_end])
+                current_start, current_end = start, end
+        if current_start >= 0:
+            merged.append([current_start, current_end])
+        return merged
+
+    def gaps(self, first_second, last_second, threshold):
+        '''
+            Return the (start, end) of the uncovered spans between 
+            first_second and last_second (inclusive) that are longer than 
+            threshold seconds.
+        '''
+        gaps = []
+        position = first_second
+        for start, end in self.intervals() + [[last_second + 1, 
+            last_second + 1]]:
+            if end < position:
+                continue
+            if start > last_second + 1:
+                start = last_second + 1
+            if start - position > threshold:
+                gaps.append((position, start - 1))
+            position = max(position, end + 1)
+            if position > last_second:
+                break
+        return gaps
+
+
+def load_gap_thresholds():
+    '''
+        Read the per-provider gap thresholds (provider -> minutes). The file 
+        is optional.
+    '''
+    if not os.path.exists(gap_thresholds_file):
+        return {}
+    try:
+        with open(gap_thresholds_file) as file_handle:
+            return json.load(file_handle)
+    except (IOError, ValueError) as exception:
+        handle_error("Error reading gap thresholds file {0} \nException: "\
+            "{1}".format(gap_thresholds_file, exception), "Unreadable file")
+        return {}
+
+
+def gap_checks(providers, first_second, last_second, minutes):
+    '''
+        Return the gap detection argument of check_provider for every 
+        provider: (first_second, last_second, threshold in seconds), or None 
+        if the gaps of the provider should not be checked.
+    '''
+    if minutes is None:
+        return dict((provider, None) for provider in providers)
+    thresholds = load_gap_thresholds()
+    gaps = {}
+    for provider in providers:
+        threshold = thresholds.get(provider, minutes)
+        gaps[provider] = ((first_second, last_second, threshold * 60) 
+            if threshold > 0 else None)
+    return gaps
+
+
+def hour_bit(start_time):
+    '''
+        The HOUR_BITS bit of a start time (HH:MM:SS, or H:MM:SS), or 0 if it 
+        is malformed.
+    '''
+    bit = HOUR_BITS.get(start_time[:2])
+    if bit is None:
+        bit = HOUR_BITS.get(start_time.split(":", 1)[0].strip().zfill(2), 0)
+    return bit
+
+
+def analyze_records(lines, failures, gap_finder=None):
+    '''
+        Return the 24-bit coverage bitmap of the given CSR records: bit N is 
+        set if there is at least one record whose start time (fourth column, 
+        HH:MM:SS) is in hour N.
+        Every record is also checked for the metadata fields, failures are 
+        counted in failures (refer to add_metadata_failure).
+        If a gap_finder (GapFinder) is given, the interval of every record is 
+        added to it.
+        Blank lines are skipped. A malformed record (too short, or with a 
+        malformed start time) covers no hour, and the missing metadata fields 
+        of a short one are counted like any other.
+    '''
+    hours = 0
+    missing = get_validator().missing
+    for row in csv.reader(lines):
+        if not row:
+            continue
+        if len(row) > 3:
+            hours |= hour_bit(row[3])
+        # Search for metadata fields in the record.
+        missing_fields = missing(row)
+        if missing_fields:
+            add_metadata_failure(failures, missing_fields, row)
+        if gap_finder is not None:
+            gap_finder.add_record(row)
+    return hours
+
+
+def analyze_csr_file(full_input_file, failures=None, gap_finder=None):
+    '''
+        Read the whole CSR file in one pass and return its hour coverage 
+        bitmap (see analyze_records).
+    '''
+    if failures is None:
+        failures = {}
+    with open(full_input_file, "rb") as file_handle:
+        return analyze_records(file_handle, failures, gap_finder)
+
+
+def tail_checksum(file_handle, offset):
+    '''
+        CRC32 of the (up to) TAIL_CHECK_SIZE bytes before offset.
+    '''
+    start = max(0, offset - TAIL_CHECK_SIZE)
+    file_handle.seek(start)
+    return zlib.crc32(file_handle.read(offset - start)) & 0xffffffff
+
 
-    # If there are missing entries/hours, notify the heroic billing team.
-    if errors_found == True:
+def analyze_csr_file_incremental(full_input_file, state, failures=None, 
+    gap_finder=None):
+    '''
+        Like analyze_csr_file, but only the bytes appended since the previous 
+        run are read. state is what this function returned for the same file 
+        in the previous run (or None): the inode, the offset read so far, the 
+        incomplete last line (carry), the hour bitmap and a checksum of the 
+        bytes before the offset. If the file was rotated (different inode), 
+        truncated (smaller than the offset) or rewritten (the checksum does 
+        not match), the whole file is read again.
+        With a gap_finder, the covered intervals are also kept in the state 
+        (a state without them means the file is read again).
+        Returns the hour bitmap and the new state.
+    '''
+    if failures is None:
+        failures = {}
+    with open(full_input_file, "rb") as file_handle:
+        file_stat = os.fstat(file_handle.fileno())
+        if (state is not None and state["inode"] == file_stat.st_ino and 
+            state["offset"] <= file_stat.st_size and 
+            tail_checksum(file_handle, state["offset"]) == state["tail_crc"] 
+            and (gap_finder is None or "intervals" in state)):
+            offset = state["offset"]
+            carry = base64.b64decode(state["carry"])
+            hours = state["hours"]
+            if gap_finder is not None:
+                for start, end in state["intervals"]:
+                    gap_finder.add(start, end)
+            log.info("Reading {0} from byte {1} ({2} new bytes).".format(
+                full_input_file, offset, file_stat.st_size - offset))
+        else:
+            if state is not None:
+                log.info("{0} was rotated, truncated or rewritten, reading "\
+                    "it from the beginning.".format(full_input_file))
+            offset = 0
+            carry = b""
+            hours = 0
+
+        file_handle.seek(offset)
+        for chunk in iter(lambda: file_handle.read(READ_CHUNK_SIZE), b""):
+            offset += len(chunk)
+            lines = (carry + chunk).split(b"\n")
+            # The last line may be incomplete (still being written), keep it 
+            # for the next chunk (or the next run).
+            carry = lines.pop()
+            hours |= analyze_records(lines, failures, gap_finder)
+
+        new_state = {
+            "inode": file_stat.st_ino,
+            "offset": offset,
+            "carry": base64.b64encode(carry).decode("ascii"),
+            "hours": hours,
+            "tail_crc": tail_checksum(file_handle, offset),
+            "updated": time.time()}
+        if gap_finder is not None:
+            new_state["intervals"] = gap_finder.intervals()
+
+    # If the last line is not terminated (E.g. the file is complete but 
+    # has no trailing newline), count its hour for this run only, it will be 
+    # fully checked once it is complete.
+    row = carry.split(b",", 4)
+    if len(row) > 4:
+        hours |= hour_bit(row[3].decode("ascii", "replace"))
+    return hours, new_state
+
+
+def load_state():
+    '''
+        Read the incremental mode state file (full path of the CSR file -> 
+        state). A missing or unreadable state file means an empty state.
+    '''
+    try:
+        with open(state_file) as file_handle:
+            return json.load(file_handle)
+    except (IOError, ValueError) as exception:
+        if os.path.exists(state_file):
+            log.warning("Ignoring unreadable state file {0}. Exception: "\
+                "{1}".format(state_file, exception))
+        return {}
+
+
+def save_state(states):
+    '''
+        Atomically write the incremental mode state file, forgetting the 
+        files that were not read in the last STATE_MAX_AGE seconds.
+    '''
+    now = time.time()
+    states = dict((file_name, state) for file_name, state in states.items() 
+        if now - state["updated"] < STATE_MAX_AGE)
+    temporary_file = state_file + ".tmp"
+    try:
+        with open(temporary_file, "w") as file_handle:
+            json.dump(states, file_handle)
+        os.rename(temporary_file, state_file)
+    except (IOError, OSError) as exception:
+        log.warning("Unable to write state file {0}. Exception: {1}".format(
+            state_file, exception))
+
+
+def check_provider(provider, full_date, comparison_hours, states=None, 
+    gaps=None):
+    '''
+        Check the CSR file of one MCS provider. This may run in a worker 
+        process, so instead of calling handle_error, the errors are returned 
+        to the caller in a dictionary, along with the hour coverage of the 
+        file: {"provider", "date", "process", "hours", 
+        "errors": [(error, category)], "file", "state"}
+        If states (the incremental mode state of all the files) is given, 
+        only the new data of the file is read, and its new state is returned.
+        If gaps is given as (first_second, last_second, threshold), the gaps 
+        longer than threshold seconds between the records in that part of 
+        the day are also reported.
+    '''
+    result = {"provider": provider, "date": full_date, "process": None, 
+        "hours": 0, "errors": [], "file": None, "state": None}
+
+    def report(error, category="Error"):
+        result["errors"].append((error, category))
+
+    # The "process" was inferred from the provider name by the registry.
+    provider_info = get_registry().get(provider)
+    if provider_info is None or provider_info.process is None:
+        report("The provider {0} is not valid.".format(provider), 
+            "Invalid provider")
+        return result
+    if provider_info.skip_reason:
+        log.info("Ignoring provider {0} ({1}).".format(provider, 
+            provider_info.skip_reason))
+        return result
+    process = provider_info.process
+    result["process"] = process
+    feed = provider
+
+    log.info("Checking CSR files for {0}...\n\tIn feed: {1}\n\tIn "\
+        "process: {2}".format(full_date, feed, process))
+
+    # Build the full path and filename of the input file.
+    input_file = full_date + ".txt"
+    input_file_path = provider_info.directory
+    full_input_file = os.path.join(input_file_path, input_file)
+    result["file"] = full_input_file
+
+    # Ensure the input file exist.
+    if os.path.exists(input_file_path):
+        if os.path.isfile(full_input_file):
+            log.info("Now checking {0}".format(full_input_file))
+        else:
+            report("The file {0} does not exist or is not a valid "\
+                "file.".format(full_input_file), "Missing file")
+    else:
+        report("The directory {0} does not exist or is not a valid "\
+            "directory.".format(input_file_path), "Missing directory")
+
+    # Read the CSR file and get the hours covered by the contents of the 
+    # fourth column (which is the start time of the MCS entry with format 
+    # HH:MM:SS).
+    failures = {}
+    gap_finder = GapFinder() if gaps is not None else None
+    try:
+        if states is not None:
+            result["hours"], result["state"] = analyze_csr_file_incremental(
+                full_input_file, states.get(full_input_file), failures, 
+                gap_finder)
+        else:
+            result["hours"] = analyze_csr_file(full_input_file, failures, 
+                gap_finder)
+    except Exception as exception:
+        report("Error reading CSR input file {0} \nException: "\
+            "{1}".format(full_input_file, exception), "Unreadable file")
+        gap_finder = None
+    report_metadata_failures(feed, failures, report)
+
+    # Any gap longer than the threshold should be reported (the gaps of an 
+    # unreadable file would only repeat the error above).
+    if gap_finder is not None:
+        first_second, last_second, threshold = gaps
+        for start, end in gap_finder.gaps(first_second, last_second, 
+            threshold):
+            report("Gap of {0} minute(s) in the MCS entries from {1} to {2} "\
+                "(process: {3}, feed: {4})".format((end - start + 1) // 60, 
+                format_seconds(start), format_seconds(end), process, feed), 
+                "Gaps")
+
+    # Any missing entries/hours in the CSR should be reported.
+    missing_hours = comparison_hours & ~result["hours"]
+    for hour in range(24):
+        if missing_hours & (1 << hour):
+            report("Missing MCS entries for {0:02d}:00:00 (process: {1}, "\
+                "feed: {2})".format(hour, process, feed), "Missing hours")
+        elif comparison_hours & (1 << hour):
+            log.info("Entries found for {0:02d}:00:00 in {1}".format(hour, 
+                feed))
+    return result
+
+
+def check_provider_worker(arguments):
+    '''
+        Pool.imap() passes a single argument, this unpacks it.
+    '''
+    return check_provider(*arguments)
+
+
+def run_checks(arguments, jobs):
+    '''
+        Run check_provider for every tuple of arguments, in a pool of jobs 
+        worker processes if jobs > 1. The results come back in the same 
+        order as the arguments, and their errors are added to the errors 
+        sink.
+    '''
+    if jobs > 1 and len(arguments) > 1:
+        log.info("Running {0} checks with {1} worker processes."\
+            .format(len(arguments), jobs))
+        pool = multiprocessing.Pool(min(jobs, len(arguments)))
+        try:
+            results = list(pool.imap(check_provider_worker, arguments))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [check_provider(*argument) for argument in arguments]
+    for result in results:
+        for error, category in result["errors"]:
+            handle_error(error, category)
+    return results
+
+
+def record_coverage(results):
+    '''
+        Keep the hour coverage of every checked (provider, day) in the 
+        coverage store. A problem with the store is logged, but it does not 
+        affect the checks.
+    '''
+    try:
+        store = coverage_store.CoverageStore(coverage_file)
+    except (IOError, OSError, ValueError) as exception:
+        log.warning("Unable to open coverage store {0}. Exception: {1}"\
+            .format(coverage_file, exception))
+        return
+    try:
+        for result in results:
+            # Skipped and invalid providers were not checked.
+            if result["process"] is not None:
+                store.set(result["provider"], 
+                    datetime.strptime(result["date"], "%Y%m%d").date(), 
+                    result["hours"])
+    finally:
+        store.close()
+
+
+def notify(header):
+    '''
+        If there are missing entries/hours, notify the heroic billing team.
+    '''
+    if errors:
         attachments = []
         attachments.append(full_log_file_name)
-        errors.append("\nFor more information, refer to the logfile {0}, "\
+        errors_file = errors.attachment()
+        if errors_file:
+            attachments.append(errors_file)
+        error_message_string = errors.summary(header, 
+            "\nFor more information, refer to the logfile {0}, "\
             "(which is attached to this email) or check the actual CSR files "\
             "in {1}.\n".format(full_log_file_name, COLLECTOR_LOGS))
-        error_message_string = "\n".join(errors)
-        # Send an email informing of any problems found.
-        emailer.build_email(distribution_group,
+        # Send an email informing of any problems found (it is queued and 
+        # sent in the background).
+        emailer.queue_email(distribution_group,
             "ERROR: MCS collection missing CSR records in {0}".format(hostname), 
             email_from,
             error_message_string, 
             attachments)
+        # The email was built, the spool file is no longer needed.
+        errors.reset()
+
+
+def main(full_date, all_day, up_to_now, jobs=1, incremental=False, 
+    gap_minutes=None):
+    # The "header" of the notification email.
+    header = "The following errors were found while verifying the MCS "\
+        "data for {0} in {1}:\n".format(full_date, hostname)
+
+    # Get the current timestamp and remove the minutes and seconds.
+    # RabbitMQ events use UTC timestamps so all timestamps in this code 
+    # should be handled in UTC.
+    current_time = datetime.utcnow()
+    rounded_current_hour = current_time.hour
+    rounded_current_time = "{0:02d}:00:00".format(rounded_current_hour)
+    current_second = (current_time.hour * 3600 + current_time.minute * 60 + 
+        current_time.second)
+
+    # According to what the user specified, build the bitmap of hours for 
+    # comparison against the content of the CSR files.
+    if all_day == True:
+        # All the hours of the day.
+        log.info("Now checking entries from 00:00:00 to 23:00:00...")
+        comparison_hours = hour_mask(0, 23)
+        gap_window = (0, SECONDS_PER_DAY - 1)
+    elif up_to_now == True:
+        # All the hours up until now.
+        log.info("Now checking entries from 00:00:00 to {0}..."\
+            .format(rounded_current_time))
+        comparison_hours = hour_mask(0, rounded_current_hour)
+        gap_window = (0, current_second)
+    else:
+        # We will check only the current hour.
+        log.info("Now checking entries for {0}..."\
+            .format(rounded_current_time))
+        comparison_hours = hour_mask(rounded_current_hour, 
+            rounded_current_hour)
+        gap_window = (rounded_current_hour * 3600, current_second)
+
+    # Get a list of providers using the get_providers() function.
+    providers = get_providers()
+    if providers is None:
+        handle_error("No active MCS providers were found in {0}"\
+            .format(provider_file), "No providers")
+    else:
+        states = load_state() if incremental else None
+        gaps = gap_checks(providers, gap_window[0], gap_window[1], 
+            gap_minutes)
+        results = run_checks([(provider, full_date, comparison_hours, states, 
+            gaps[provider]) for provider in providers], jobs)
+        if states is not None:
+            for result in results:
+                if result["state"] is not None:
+                    states[result["file"]] = result["state"]
+            save_state(states)
+        record_coverage(results)
+
+    notify(header)
+
+
+def backfill(start_date, end_date, jobs=1, gap_minutes=None):
+    '''
+        Check all 24 hours of every day from start_date to end_date 
+        (inclusive) for all the providers, in one process (fanned out over 
+        jobs worker processes), and keep their coverage in the coverage 
+        store.
+    '''
+    header = "The following errors were found while verifying the MCS "\
+        "data from {0} to {1} in {2}:\n".format(start_date, end_date, 
+        hostname)
+    providers = get_providers()
+    if providers is None:
+        handle_error("No active MCS providers were found in {0}"\
+            .format(provider_file), "No providers")
+    else:
+        gaps = gap_checks(providers, 0, SECONDS_PER_DAY - 1, gap_minutes)
+        arguments = []
+        day = start_date
+        while day <= end_date:
+            arguments.extend((provider, day.strftime("%Y%m%d"), 
+                hour_mask(0, 23), None, gaps[provider]) 
+                for provider in providers)
+            day += timedelta(days=1)
+        log.info("Backfilling {0} provider-days from {1} to {2}...".format(
+            len(arguments), start_date, end_date))
+        record_coverage(run_checks(arguments, jobs))
+    notify(header)
+
+
+def print_history(feed, start_date, end_date):
+    '''
+        Print the missing hours of feed for every day from start_date to 
+        end_date (inclusive), using only the coverage store.
+    '''
+    if not os.path.exists(coverage_file):
+        log.error("The coverage store {0} does not exist yet.".format(
+            coverage_file))
+        exit(4)
+    store = coverage_store.CoverageStore(coverage_file)
+    try:
+        if feed not in store.slots:
+            log.error("There is no coverage history for {0}.".format(feed))
+            exit(4)
+        for day, hours in store.history(feed, start_date, end_date):
+            if hours is None:
+                status = "not checked"
+            else:
+                missing_hours = hour_mask(0, 23) & ~hours
+                if missing_hours:
+                    status = "missing " + ", ".join("{0:02d}:00".format(hour) 
+                        for hour in range(24) if missing_hours & (1 << hour))
+                else:
+                    status = "complete"
+            print("{0} {1}".format(day.strftime("%Y%m%d"), status))
+    finally:
+        store.close()
+
+
+def parse_date(date_string):
+    '''
+        argparse type for the --from and --to arguments (CCYYMMDD).
+    '''
+    try:
+        return datetime.strptime(date_string, "%Y%m%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError("{0} is not a valid CCYYMMDD "\
+            "date.".format(date_string))
 
 
 def get_args(argv):
@@ -346,8 +988,65 @@ def get_args(argv):
         dest = "up_to_now",
         default = False,
         action = "store_true")
+    parser.add_argument("-j", "--jobs",
+        help = "Number of worker processes used to check the providers "\
+            "concurrently. Defaults to 1 (one provider after another).",
+        dest = "jobs",
+        default = 1,
+        type = int)
+    parser.add_argument("-i", "--incremental",
+        help = "Only read the data appended to the CSR files since the "\
+            "previous (incremental) run.",
+        dest = "incremental",
+        default = False,
+        action = "store_true")
+    parser.add_argument("-g", "--gaps",
+        help = "Also report every gap longer than this many minutes between "\
+            "the MCS entries (per-provider thresholds can be set in {0})."\
+            .format(gap_thresholds_file),
+        dest = "gap_minutes",
+        metavar = "MINUTES",
+        type = int)
+    parser.add_argument("--from",
+        help = "Backfill: check all 24 hours of every day from this date "\
+            "(CCYYMMDD) up to the --to date for all the providers.",
+        dest = "from_date",
+        type = parse_date)
+    parser.add_argument("--to",
+        help = "The last date (CCYYMMDD) of --from or --history. Defaults "\
+            "to yesterday (in UTC).",
+        dest = "to_date",
+        type = parse_date)
+    parser.add_argument("--history",
+        help = "Print the missing hours of this feed (provider) from the "\
+            "coverage history, without reading any CSR file. Uses --from "\
+            "and --to (defaults to the last 30 days).",
+        dest = "history",
+        metavar = "FEED")
     args = parser.parse_args()
 
+    # Set logging level.
+    if args.verbose:
+        log.setLevel(logging.INFO)
+
+    # Backfill and history modes work on a range of dates.
+    if args.from_date or args.to_date or args.history:
+        to_date = args.to_date or (datetime.utcnow().date() - 
+            timedelta(days=1))
+        from_date = args.from_date
+        if from_date is None:
+            if not args.history:
+                parser.error("--to requires --from")
+            from_date = to_date - timedelta(days=29)
+        if from_date > to_date:
+            logging.error("The --from date must not be after the --to date.")
+            exit(3)
+        if args.history:
+            print_history(args.history, from_date, to_date)
+        else:
+            backfill(from_date, to_date, args.jobs, args.gap_minutes)
+        return
+
     # Ensure that we have a valid date.
     try:
         full_date = datetime(year=int(args.year),
@@ -357,15 +1056,12 @@ def get_args(argv):
         logging.error("Provided date is invalid. {0}".format(exception))
         exit(3)
 
-    # Set logging level.
-    if args.verbose:
-        log.setLevel(logging.INFO)
-
     # Call the main function with the appropriate mode.
-    main(full_date, args.all_day, args.up_to_now)
+    main(full_date, args.all_day, args.up_to_now, args.jobs, 
+        args.incremental, args.gap_minutes)
 
 
 if __name__ == "__main__":
     # Parse arguments from the CLI.
     get_args(sys.argv[1:])
-exit(0)
+    exit(0)
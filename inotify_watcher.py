@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+'''
+    Usage:
+        import inotify_watcher
+
+        watcher = inotify_watcher.InotifyWatcher()
+        watcher.add_watch("/home/ftpuser/upload/consolidation_backups",
+            inotify_watcher.IN_CLOSE_WRITE | inotify_watcher.IN_MOVED_TO)
+        for path, mask, name in watcher.read_events(timeout=60):
+            ...
+        watcher.close()
+
+    Description:
+        A small wrapper around the Linux inotify(7) API, so the SCCM tools can
+        react to files as soon as they are written instead of waiting for the
+        next cron execution.
+        The standard library does not include inotify support (and we do not
+        want to install extra packages on the satellite and consolidation
+        servers), so the system calls are made directly to libc via ctypes.
+        This only works on Linux.
+'''
+
+# Needed for system and environment information.
+import os
+
+# Calling the inotify system calls in libc.
+import ctypes
+import ctypes.util
+
+# To unpack the inotify_event structures.
+import struct
+
+# To wait for events with a timeout.
+import select
+
+# To read errno values.
+import errno
+
+
+# Event masks (from <sys/inotify.h>).
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# Flags for inotify_init1().
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# Each event is a struct inotify_event:
+# int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[];
+EVENT_HEADER = struct.Struct("iIII")
+
+# Enough room for a few hundred events per read() call.
+READ_BUFFER_SIZE = 64 * 1024
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+    use_errno=True)
+
+
+class InotifyWatcher(object):
+    '''
+        Keeps one inotify file descriptor and the list of watched paths.
+        read_events() returns a list of (path, mask, name) tuples, where path
+        is the watched directory and name is the file (inside that directory)
+        that triggered the event. When the kernel queue overflows, a single
+        (None, IN_Q_OVERFLOW, "") event is returned, so the caller knows some
+        events were lost and a full rescan is needed.
+    '''
+    def __init__(self):
+        self.fd = _libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            error_number = ctypes.get_errno()
+            raise OSError(error_number, "inotify_init1: {0}".format(
+                os.strerror(error_number)))
+        # Watch descriptor -> path, and path -> watch descriptor.
+        self.watches = {}
+        self.paths = {}
+
+    def add_watch(self, path, mask):
+        '''
+            Start watching path for the events in mask. Returns the watch
+            descriptor. Watching the same path twice just updates the mask.
+        '''
+        wd = _libc.inotify_add_watch(self.fd, path.encode("utf-8")
+            if not isinstance(path, bytes) else path, mask)
+        if wd < 0:
+            error_number = ctypes.get_errno()
+            raise OSError(error_number, "inotify_add_watch {0}: {1}".format(
+                path, os.strerror(error_number)))
+        self.watches[wd] = path
+        self.paths[path] = wd
+        return wd
+
+    def remove_watch(self, path):
+        '''
+            Stop watching path (if it was being watched).
+        '''
+        wd = self.paths.pop(path, None)
+        if wd is not None:
+            self.watches.pop(wd, None)
+            _libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        '''
+            Wait up to timeout seconds (forever if None) and return all the
+            pending events.
+        '''
+        try:
+            readable = select.select([self.fd], [], [], timeout)[0]
+        except select.error as exception:
+            if exception.args[0] == errno.EINTR:
+                return []
+            raise
+        if not readable:
+            return []
+        try:
+            buf = os.read(self.fd, READ_BUFFER_SIZE)
+        except OSError as exception:
+            if exception.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if not isinstance(name, str):
+                name = name.decode("utf-8", "replace")
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, IN_Q_OVERFLOW, ""))
+                continue
+            path = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                # The watch was removed (explicitly or because the directory
+                # was deleted or unmounted).
+                self.watches.pop(wd, None)
+                if path is not None and self.paths.get(path) == wd:
+                    del self.paths[path]
+                continue
+            if path is None:
+                continue
+            events.append((path, mask, name))
+        return events
+
+    def close(self):
+        '''
+            Release the inotify file descriptor (and all of its watches).
+        '''
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self.watches = {}
+        self.paths = {}
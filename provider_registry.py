@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+'''
+    Usage:
+        import provider_registry
+
+        registry = provider_registry.ProviderRegistry(provider_file,
+            collector_logs, cache_file)
+        for name in registry.names():
+            provider = registry.get(name)
+            if provider.skip_reason:
+                ...
+            elif provider.process is None:
+                # Not a valid provider.
+                ...
+            else:
+                csr_file = os.path.join(provider.directory, "20171123.txt")
+
+    Description:
+        The MCS providers, as findMissingCSR.py needs them: the name, the
+        collector process that writes their CSR files (inferred from the
+        name), the directory of those CSR files and, if the provider should
+        not be checked, the reason.
+        The providers file of MCS stores one JSON object per line. It is
+        parsed only when it changes: the result is cached in a JSON file,
+        along with the modification time and size of the providers file (and
+        the collector logs directory used to build the paths).
+'''
+
+# Needed for system and environment information.
+import os
+
+# To read the providers file and the cache.
+import json
+
+# Handle logging.
+import logging
+
+
+# Change this when the cached data changes, so old caches are ignored.
+CACHE_VERSION = 1
+
+# Logging configuration.
+log = logging.getLogger("provider_registry")
+
+
+def infer_process(name):
+    '''
+        Infer the collector process from the provider name. Returns the
+        process (or None if the provider is not valid) and the reason to skip
+        the provider (or None).
+    '''
+    if name.endswith("_nova"):
+        return "nova_compute", None
+    elif name.endswith("_cinder"):
+        # per Charlotte Despres, ICO's OpenStack cinder does not support
+        # additional volumes with VMware, so we expect no records.
+        # Let's just silently ignore any cinder providers with "VMWARE"
+        # on their names.
+        if "VMWARE" in name:
+            return "cinder_volume", "Currently, there is no support for "\
+                "VMware cinder"
+        return "cinder_volume", None
+    return None, None
+
+
+class Provider(object):
+    '''
+        One MCS provider.
+    '''
+    __slots__ = ("name", "process", "directory", "skip_reason")
+
+    def __init__(self, name, process, directory, skip_reason):
+        self.name = name
+        self.process = process
+        self.directory = directory
+        self.skip_reason = skip_reason
+
+    def to_list(self):
+        return [self.name, self.process, self.directory, self.skip_reason]
+
+
+class ProviderRegistry(object):
+    '''
+        The providers of provider_file, in the order of the file, with O(1)
+        lookups by name. If cache_file is given, it is used (and updated)
+        when provider_file did not change.
+        Errors reading provider_file are raised (IOError or ValueError),
+        problems with the cache are only logged.
+    '''
+    def __init__(self, provider_file, collector_logs, cache_file=None):
+        self.provider_file = provider_file
+        self.collector_logs = collector_logs
+        self.cache_file = cache_file
+        self.providers = []
+        self.by_name = {}
+        self.key = None
+        self.load()
+
+    def _key(self):
+        file_stat = os.stat(self.provider_file)
+        return [CACHE_VERSION, file_stat.st_mtime, file_stat.st_size,
+            self.collector_logs]
+
+    def load(self):
+        '''
+            (Re)load the providers, if the providers file changed since they
+            were loaded.
+        '''
+        key = self._key()
+        if key == self.key:
+            return
+        providers = self._read_cache(key)
+        if providers is None:
+            providers = self._parse()
+            self._write_cache(key, providers)
+        self.providers = providers
+        self.by_name = dict((provider.name, provider)
+            for provider in providers)
+        self.key = key
+
+    def _parse(self):
+        '''
+            Parse the providers file (one JSON object per line).
+        '''
+        providers = []
+        with open(self.provider_file, "rb") as file_handle:
+            for row in file_handle:
+                if not row.strip():
+                    continue
+                name = json.loads(row)["provider_name"]
+                process, skip_reason = infer_process(name)
+                directory = None
+                if process is not None:
+                    directory = os.path.join(self.collector_logs, process,
+                        name)
+                providers.append(Provider(name, process, directory,
+                    skip_reason))
+        log.info("Parsed {0} providers from {1}".format(len(providers),
+            self.provider_file))
+        return providers
+
+    def _read_cache(self, key):
+        if self.cache_file is None:
+            return None
+        try:
+            with open(self.cache_file) as file_handle:
+                cache = json.load(file_handle)
+            if cache["key"] != key:
+                return None
+            return [Provider(*provider) for provider in cache["providers"]]
+        except (IOError, ValueError, KeyError, TypeError) as exception:
+            if os.path.exists(self.cache_file):
+                log.warning("Ignoring unreadable provider cache {0}. "\
+                    "Exception: {1}".format(self.cache_file, exception))
+            return None
+
+    def _write_cache(self, key, providers):
+        if self.cache_file is None:
+            return
+        temporary_file = self.cache_file + ".tmp"
+        try:
+            with open(temporary_file, "w") as file_handle:
+                json.dump({"key": key, "providers": [provider.to_list()
+                    for provider in providers]}, file_handle)
+            os.rename(temporary_file, self.cache_file)
+        except (IOError, OSError) as exception:
+            log.warning("Unable to write provider cache {0}. Exception: "\
+                "{1}".format(self.cache_file, exception))
+
+    def names(self):
+        return [provider.name for provider in self.providers]
+
+    def get(self, name):
+        '''
+            Return the Provider called name, or None.
+        '''
+        return self.by_name.get(name)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __iter__(self):
+        return iter(self.providers)
+
+    def __len__(self):
+        return len(self.providers)
@@ -41,11 +41,11 @@ import ibm_db
 # Handle logging.
 import logging
 
-# Date formating.
-import datetime
+# To read the configuration file (refer to config_loader.py)
+import config_loader
 
-# To read the configuration file.
-import json
+# Custom module for the CSR record format (refer to csr_reader.py)
+import csr_reader
 
 
 # Configuration files.
@@ -67,7 +67,8 @@ def main():
     # Read the connection parameters from a file.
     try:
         log.info("Reading connection parameters from {0}".format(config_file))
-        config = json.load(open(config_file, "r+"))
+        # (Never cached on disk, it has the password.)
+        config = config_loader.load(config_file, cache=False)
         host = config["hostname"]
         db = config["database"]
         user = config["username"]
@@ -127,17 +128,8 @@ def main():
             # For that reason, I need to iterate over the result tuple and add 
             # the values separately to every row which will be added to the 
             # final output file.
-            row = ""
-
-            # A list to append all the str values in each row.
-            row_list = []
-
-            for value in result:
-                # Detect datetime values and format accordingly (CCYYMMDD)
-                if type(value) is datetime.date:
-                    value = value.strftime("%Y%m%d")
-                row_list.append(str(value))
-            row = ",".join(row_list)
+            # Dates are formatted as CCYYMMDD (refer to csr_reader.py).
+            row = csr_reader.format_record(result)
 
             # Finally, write the row to the actual file.
             output_file_handle.write(row+"\n")
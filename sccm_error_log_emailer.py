@@ -1,7 +1,24 @@
 #!/usr/bin/env python
 '''
     Usage:
-        python sccm_error_log_emailer.py job1 job2 job3...
+        python sccm_error_log_emailer.py [-j JOBS] [-w [-i INTERVAL]] 
+            [-s MINUTES] job1 job2 job3...
+
+    Arguments:
+        -j JOBS, --jobs JOBS
+            Number of worker processes used to check the jobs (the age of 
+            their newest log and its errors) concurrently. Defaults to 1.
+        -w, --watch
+            Keep running: watch the log directories of the jobs with inotify, 
+            scan every log as soon as it is written, and report the jobs 
+            whose next log did not show up in time.
+        -i INTERVAL, --interval INTERVAL
+            In watch mode, the seconds expected between two logs of a job. 
+            A job is reported when INTERVAL plus MAX_AGE_OF_LAST_LOG_FILE 
+            seconds pass without a new log. Defaults to 86400.
+        -s MINUTES, --suppress MINUTES
+            Minutes during which an error that was reported is not reported 
+            again (0 reports every error). Defaults to 60.
 
     Description:
         This program will accept a list of SCCM job names as arguments.
@@ -9,6 +26,31 @@
         for those jobs and parse them looking for errors.
         If any errors are found, they will be sent to the email distribution 
         list.
+        Every log that was scanned is recorded in a ledger 
+        (/tmp/logs/sccm/sccm_error_log_emailer_ledger.json) with its size, 
+        modification time and the number of errors already reported, so the 
+        next executions skip the logs that did not change (at the cost of one 
+        stat) and only report the errors appended to the ones that grew.
+        The active jobs of every jobfile are cached too 
+        (/tmp/logs/sccm/sccm_error_log_emailer_jobfiles.json), so a jobfile 
+        is only parsed again when its contents change.
+        All the jobs are checked before anything is reported: a single email 
+        lists the problems of every job (stale or malformed logs, errors), 
+        and the exit status is 2 if the newest log of any job was too old.
+        The newest log of every job directory is found with a single scandir 
+        pass, and remembered along with the modification time of the 
+        directory (/tmp/logs/sccm/sccm_error_log_emailer_newest.json): while 
+        the directory does not change, no new log was created, so finding 
+        the newest one costs two stats.
+        In watch mode (-w), the same checks are driven by inotify events 
+        instead of cron: the staleness of every job is tracked by a timer 
+        (refer to timer_wheel.py) that each new log of the job pushes back.
+        The errors of all the jobs are reported in one digest: the messages 
+        are normalized and fingerprinted, every distinct error is listed 
+        once with its occurrences and jobs, and a fingerprint is not 
+        reported again during the suppression window (-s, stored in 
+        /tmp/logs/sccm/sccm_error_log_emailer_digest.json). Refer to 
+        error_digest.py.
 
     Author:
         Alan Verdugo (alanvemu@mx1.ibm.com)
@@ -62,11 +104,21 @@ import sys
 # Needed for system and environment information.
 import socket
 
-# Needed to get the newest log files.
-import glob
-
-# XML navigation.
-import xml.etree.ElementTree as ET
+# scandir() avoids one stat per directory entry, but it is only part of the 
+# standard library since Python 3.5 (otherwise it is the scandir package).
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# XML navigation (the C implementation, if available).
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 # For timestamp information in the email subject.
 from datetime import datetime
@@ -83,6 +135,26 @@ import logging
 # To get current seconds since Epoch.
 import time
 
+# To read and write the scan ledger.
+import json
+
+# To detect the jobfiles whose contents changed.
+import hashlib
+
+# To check the jobs concurrently.
+import multiprocessing
+
+# Custom module to group the errors of all the jobs (refer to 
+# error_digest.py)
+import error_digest
+
+# Custom module for inotify watches (refer to inotify_watcher.py)
+import inotify_watcher
+
+# Custom module for the staleness timers of watch mode (refer to 
+# timer_wheel.py)
+import timer_wheel
+
 
 # Home of the SCCM installation.
 sccm_home = os.path.join("/opt", "ibm", "sccm")
@@ -96,19 +168,48 @@ job_file_dir = os.path.join(sccm_home, "jobfiles")
 # The root location of the collectors log files.
 log_path = os.path.join(sccm_home, "logs", "jobrunner")
 
-# A list of the jobnames.
-list_of_job_names = []
+# Where the logs that were already scanned (and their reported errors) are 
+# recorded. Losing this file only means the newest logs are reported again.
+ledger_file = os.path.join(os.sep, "tmp", "logs", "sccm", 
+    "sccm_error_log_emailer_ledger.json")
+
+# Where the active jobs of every jobfile are cached.
+jobfile_cache_file = os.path.join(os.sep, "tmp", "logs", "sccm", 
+    "sccm_error_log_emailer_jobfiles.json")
+
+# The newest log of every job directory (refer to find_newest_log).
+newest_log_index_file = os.path.join(os.sep, "tmp", "logs", "sccm", 
+    "sccm_error_log_emailer_newest.json")
 
-# A list of the found logs.
-list_of_log_files = []
+# When every error fingerprint was last reported (refer to error_digest.py).
+digest_state_file = os.path.join(os.sep, "tmp", "logs", "sccm", 
+    "sccm_error_log_emailer_digest.json")
 
-# Placeholder for the log filenames.
-newest_log = ""
+# SCCM job_files use namespaces.
+JOBS_NAMESPACE = "{http://www.ibm.com/TUAMJobs.xsd}"
+
+# Entries of the ledger that were not seen in this many seconds are removed 
+# (their logs are no longer the newest ones of their jobs).
+LEDGER_MAX_AGE = 7 * 24 * 3600
 
 # The max age we are willing to accept for the creation of the newest 
 # log file (in seconds). This is a global constant.
 MAX_AGE_OF_LAST_LOG_FILE = 600
 
+# In watch mode, the seconds expected between two logs of a job (the 
+# default of --interval).
+DEFAULT_LOG_INTERVAL = 24 * 3600
+
+# Minutes during which an error that was reported is not reported again 
+# (the default of --suppress).
+DEFAULT_SUPPRESSION_MINUTES = 60
+
+# Resolution of the staleness timers of watch mode (in seconds).
+WHEEL_RESOLUTION = 10
+
+# The inotify events of a log that was written.
+LOG_EVENTS = inotify_watcher.IN_CLOSE_WRITE | inotify_watcher.IN_MOVED_TO
+
 # The hostname where this is running.
 hostname = socket.gethostname()
 
@@ -126,7 +227,450 @@ log = logging.getLogger("sccm_error_log_emailer")
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def main(arguments):
+def scan_log(log_file):
+    '''
+        Stream the XML log_file and return the name of its job (the "name" 
+        attribute of the Job element under the root) and the list of its 
+        ERROR messages ("Timestamp: ... Message: ...").
+        Every element is discarded as soon as it has been seen, so the memory 
+        used does not depend on the size of the log (ET.parse would build the 
+        whole tree first). Malformed XML raises ET.ParseError.
+        The messages are returned as (timestamp, text) tuples.
+    '''
+    job_name = None
+    error_message = []
+    # The elements from the root down to the current one.
+    stack = []
+    for event, element in ET.iterparse(log_file, events=("start", "end")):
+        if event == "start":
+            # The attributes are already available when the element starts.
+            if (job_name is None and len(stack) == 1 and 
+                element.tag == "Job"):
+                job_name = element.get("name")
+            stack.append(element)
+            continue
+        stack.pop()
+        # Since the error messages could be in any part of the XML 
+        # structure, every message element is checked.
+        if (element.tag == "message" and 
+            (element.get("type") or "").strip() == "ERROR"):
+            # (A message without text has None as its text.)
+            error_message.append((element.get("time"), element.text or ""))
+        # The previous siblings were already removed, so this is cheap.
+        element.clear()
+        if stack:
+            stack[-1].remove(element)
+    return job_name, error_message
+
+
+def read_json_file(file_name, description):
+    '''
+        Read one of the JSON files this program keeps (E.g. the ledger). A 
+        missing or unreadable file means an empty dictionary.
+    '''
+    try:
+        with open(file_name) as file_handle:
+            return json.load(file_handle)
+    except (IOError, ValueError) as exception:
+        if os.path.exists(file_name):
+            log.warning("Ignoring unreadable {0} {1}. Exception: "\
+                "{2}".format(description, file_name, exception))
+        return {}
+
+
+def write_json_file(file_name, data, description):
+    '''
+        Atomically write one of the JSON files this program keeps.
+    '''
+    temporary_file = file_name + ".tmp"
+    try:
+        directory = os.path.dirname(file_name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(temporary_file, "w") as file_handle:
+            json.dump(data, file_handle)
+        os.rename(temporary_file, file_name)
+    except (IOError, OSError) as exception:
+        log.warning("Unable to write {0} {1}. Exception: {2}".format(
+            description, file_name, exception))
+
+
+def load_ledger():
+    '''
+        Read the scan ledger (full path of the log -> {"inode", "size", 
+        "mtime", "errors", "last_time", "malformed", "updated"}).
+    '''
+    return read_json_file(ledger_file, "ledger")
+
+
+def save_ledger(ledger):
+    '''
+        Atomically write the scan ledger, forgetting the logs that were not 
+        seen in the last LEDGER_MAX_AGE seconds.
+    '''
+    now = time.time()
+    write_json_file(ledger_file, dict((log_file, entry) 
+        for log_file, entry in ledger.items() 
+        if now - entry["updated"] < LEDGER_MAX_AGE), "ledger")
+
+
+def newest_log_in(log_dir):
+    '''
+        Return the newest (by ctime) .xml log in log_dir and its ctime, or 
+        (None, None). One pass over the directory: with scandir, the stat of 
+        every entry is only done once (glob + getctime listed the directory 
+        twice and called stat again for the newest log).
+    '''
+    newest_log = None
+    newest_ctime = None
+    if scandir is not None:
+        entries = ((entry.path, entry.stat) for entry in scandir(log_dir) 
+            if entry.name.endswith(".xml") and not entry.name.startswith("."))
+    else:
+        entries = ((path, lambda path=path: os.stat(path)) for path in 
+            (os.path.join(log_dir, name) for name in os.listdir(log_dir) 
+            if name.endswith(".xml") and not name.startswith(".")))
+    for path, get_stat in entries:
+        try:
+            ctime = get_stat().st_ctime
+        except OSError:
+            # Removed while the directory was being read.
+            continue
+        if newest_ctime is None or ctime > newest_ctime:
+            newest_log, newest_ctime = path, ctime
+    return newest_log, newest_ctime
+
+
+def find_newest_log(log_dir, index_entry=None):
+    '''
+        Return the newest .xml log in log_dir (or None), its ctime and the 
+        new entry of the newest-log index for log_dir ({"mtime", "newest"}).
+        A new log changes the modification time of its directory, so if it 
+        did not change since index_entry was built, the newest log is still 
+        the same one: only the directory and that log are stat'ed.
+    '''
+    dir_mtime = os.stat(log_dir).st_mtime
+    if (index_entry is not None and index_entry["mtime"] == dir_mtime and 
+        index_entry["newest"] is not None):
+        try:
+            return (index_entry["newest"], 
+                os.stat(index_entry["newest"]).st_ctime, index_entry)
+        except OSError:
+            pass
+    newest_log, newest_ctime = newest_log_in(log_dir)
+    # A log created in the same clock tick as the scan would not change the 
+    # modification time, so a directory modified just now is not indexed.
+    if time.time() - dir_mtime < 2:
+        return newest_log, newest_ctime, None
+    return newest_log, newest_ctime, {"mtime": dir_mtime, 
+        "newest": newest_log}
+
+
+def reported_errors(entry, file_stat):
+    '''
+        How many of the errors of a log were already reported, according to 
+        its ledger entry: None if the log did not change since it was 
+        scanned, the number of errors reported if it only grew (the new 
+        errors are after those), or 0 if it is a new or rewritten log.
+    '''
+    if entry is None or entry["inode"] != file_stat.st_ino:
+        return 0
+    if (entry["size"] == file_stat.st_size and 
+        entry["mtime"] == file_stat.st_mtime):
+        return None
+    if file_stat.st_size > entry["size"] and not entry["malformed"]:
+        return entry["errors"]
+    return 0
+
+
+def ledger_entry(file_stat, errors, last_time, malformed=False):
+    return {"inode": file_stat.st_ino, "size": file_stat.st_size, 
+        "mtime": file_stat.st_mtime, "errors": errors, 
+        "last_time": last_time, "malformed": malformed, 
+        "updated": time.time()}
+
+
+def parse_job_file(job_file):
+    '''
+        Parse a jobfile and return its active jobs, as a list of {"id", 
+        "log_dir"} dictionaries (the id is the name of the job, and its logs 
+        are written to log_dir). Malformed XML raises an exception.
+    '''
+    jobs = []
+    root = ET.parse(job_file).getroot()
+    for job in root.findall(JOBS_NAMESPACE + "Job"):
+        # Look for the content of the "Job id" tag.
+        # (Get only the jobs that have an "active" tag on them).
+        if job.get("active") == "true":
+            jobs.append({"id": job.get("id"), 
+                "log_dir": os.path.join(log_path, job.get("id"))})
+    return jobs
+
+
+class JobFileCache(object):
+    '''
+        The active jobs of the jobfiles, keyed by the full path of the 
+        jobfile and validated with its modification time and size (one stat) 
+        and, if those changed, the MD5 of its contents (a read, but still no 
+        XML parsing).
+    '''
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.changed = False
+        self.entries = {}
+        try:
+            with open(cache_file) as file_handle:
+                cache = json.load(file_handle)
+            # The log directories depend on log_path.
+            if cache["log_path"] == log_path:
+                self.entries = cache["jobfiles"]
+        except (IOError, ValueError, KeyError, TypeError) as exception:
+            if os.path.exists(cache_file):
+                log.warning("Ignoring unreadable jobfile cache {0}. "\
+                    "Exception: {1}".format(cache_file, exception))
+
+    def get_jobs(self, job_file):
+        '''
+            Return the active jobs of job_file (refer to parse_job_file).
+        '''
+        file_stat = os.stat(job_file)
+        entry = self.entries.get(job_file)
+        if (entry is not None and entry["mtime"] == file_stat.st_mtime and 
+            entry["size"] == file_stat.st_size):
+            return entry["jobs"]
+        with open(job_file, "rb") as file_handle:
+            checksum = hashlib.md5(file_handle.read()).hexdigest()
+        if entry is None or entry["md5"] != checksum:
+            log.info("Parsing jobfile {0}".format(job_file))
+            entry = {"md5": checksum, "jobs": parse_job_file(job_file)}
+        entry["mtime"] = file_stat.st_mtime
+        entry["size"] = file_stat.st_size
+        self.entries[job_file] = entry
+        self.changed = True
+        return entry["jobs"]
+
+    def save(self):
+        '''
+            Atomically write the cache (if anything changed).
+        '''
+        if not self.changed:
+            return
+        temporary_file = self.cache_file + ".tmp"
+        try:
+            cache_dir = os.path.dirname(self.cache_file)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(temporary_file, "w") as file_handle:
+                json.dump({"log_path": log_path, "jobfiles": self.entries}, 
+                    file_handle)
+            os.rename(temporary_file, self.cache_file)
+            self.changed = False
+        except (IOError, OSError) as exception:
+            log.warning("Unable to write jobfile cache {0}. Exception: "\
+                "{1}".format(self.cache_file, exception))
+
+
+def check_job(job_name, log_dir, ledger, index_entry=None):
+    '''
+        Check one job: find its newest log, verify its age and scan it for 
+        the errors that were not reported yet (according to the ledger). 
+        This may run in a worker process, so nothing is reported here, the 
+        outcome is returned in a dictionary: {"job", "log_file", "stale", 
+        "problems": [(email subject, email body)], "errors": the new errors 
+        of log_file [(job name, timestamp, message)], "entry": the new 
+        ledger entry of log_file (or None if it did not change), "index": 
+        the new newest-log index entry of log_dir}.
+    '''
+    result = new_result(job_name)
+    # Check if any of the log paths are invalid directories.
+    if not os.path.exists(log_dir):
+        log.error("The path {0} does not exist. Verify the "\
+            "arguments.".format(log_dir))
+        return result
+    # Get the newest log in the directory
+    try:
+        newest_log, newest_ctime, result["index"] = find_newest_log(log_dir, 
+            index_entry)
+    except OSError as exception:
+        log.error("Unable to read {0}: {1}".format(log_dir, exception))
+        return result
+    # Validate that we have at least one log file to work with.
+    if newest_log is None:
+        log.error("No XML logs found in {0}".format(log_dir))
+        return result
+    # If the newest log file was created more than, say, 10 minutes ago, we 
+    # will assume the startJobRunner.sh script failed and did not create a 
+    # proper log file, in which case we may be missing data, so let's send a 
+    # notification email.
+    if (time.time() - newest_ctime) > MAX_AGE_OF_LAST_LOG_FILE:
+        # The newest file is older than 10 minutes.
+        result["stale"] = True
+        result["problems"].append(stale_job_problem(job_name))
+        return result
+    return check_log(result, newest_log, ledger)
+
+
+def new_result(job_name):
+    '''
+        An empty outcome of the checks of job_name (refer to check_job).
+    '''
+    return {"job": job_name, "log_file": None, "stale": False, 
+        "problems": [], "errors": [], "entry": None, "index": None}
+
+
+def stale_job_problem(job_name):
+    '''
+        The (email subject, email body) of a job without a recent log.
+    '''
+    email_subject = "ERROR: Missing {0} log file in {1}".format(job_name, 
+        hostname)
+    error_body = "At {0}, a recent log file was not found for the {1} "\
+        "job.\n\rThis may indicate a malfunction in startJobRunner.sh."\
+        "\n\rCheck the console logs located in /tmp/logs/sccm/."\
+        .format(datetime.now(), job_name)
+    log.error(error_body)
+    return email_subject, error_body
+
+
+def check_log(result, log_file, ledger):
+    '''
+        Scan log_file for the errors that were not reported yet (according 
+        to the ledger), filling the "log_file", "entry", "errors" and 
+        "problems" of result (refer to check_job). Returns result.
+    '''
+    result["log_file"] = log_file
+
+    # Skip the logs that did not change since they were scanned.
+    try:
+        file_stat = os.stat(log_file)
+    except OSError as exception:
+        log.error("Unable to stat {0}: {1}".format(log_file, exception))
+        return result
+    reported = reported_errors(ledger.get(log_file), file_stat)
+    if reported is None:
+        log.info("{0} did not change since it was scanned.".format(
+            log_file))
+        return result
+
+    # Get the name of the failed job and the error output messages 
+    # (from the log file).
+    try:
+        log_job_name, error_message = scan_log(log_file)
+    except Exception as exception:
+        result["entry"] = ledger_entry(file_stat, 0, None, True)
+        email_subject = "ERROR: Malformed XML log."
+        error_body = "The file {0} contains malformed XML: "\
+            "{1}".format(log_file, exception)
+        log.error(error_body)
+        result["problems"].append((email_subject, error_body))
+        return result
+
+    # Only the errors that were not reported yet (they are reported in the 
+    # digest of all the jobs, refer to digest_problem).
+    result["errors"] = [(log_job_name, timestamp, text) 
+        for timestamp, text in error_message[reported:]]
+    result["entry"] = ledger_entry(file_stat, len(error_message), 
+        error_message[-1][0] if error_message else None)
+    return result
+
+
+def update_ledger(ledger, result):
+    '''
+        Record the outcome of check_job (or check_log) in the ledger.
+    '''
+    if result["entry"] is not None:
+        ledger[result["log_file"]] = result["entry"]
+    elif result["log_file"] in ledger:
+        ledger[result["log_file"]]["updated"] = time.time()
+
+
+def check_job_worker(arguments):
+    '''
+        Pool.imap() passes a single argument, this unpacks it.
+    '''
+    return check_job(*arguments)
+
+
+def run_job_checks(arguments, jobs):
+    '''
+        Run check_job for every tuple of arguments, in a pool of jobs worker 
+        processes if jobs > 1 (so a slow job does not delay the others). The 
+        results come back in the same order as the arguments.
+    '''
+    if jobs > 1 and len(arguments) > 1:
+        log.info("Checking {0} jobs with {1} worker processes.".format(
+            len(arguments), jobs))
+        pool = multiprocessing.Pool(min(jobs, len(arguments)))
+        try:
+            return list(pool.imap(check_job_worker, arguments))
+        finally:
+            pool.close()
+            pool.join()
+    return [check_job(*argument) for argument in arguments]
+
+
+def digest_problem(errors, suppression):
+    '''
+        Group the errors [(job name, timestamp, message)] of all the jobs by 
+        fingerprint (refer to error_digest.py) and return the (email 
+        subject, email body) of their digest, or None if there is nothing 
+        to report (no errors, or all of them were reported within the 
+        suppression window).
+    '''
+    if not errors:
+        return None
+    digest = error_digest.ErrorDigest()
+    for job_name, timestamp, text in errors:
+        digest.add(job_name, timestamp, text)
+    groups = suppression.filter(digest.groups())
+    suppression.save()
+    log.info("{0} errors, {1} distinct, {2} not suppressed.".format(
+        len(digest), len(digest.groups()), len(groups)))
+    if not groups:
+        return None
+    job_names = set(job_name for group in groups for job_name in group.jobs)
+    if len(job_names) == 1:
+        email_subject = "The {0} job failed in the server {1} at "\
+            "{2}".format(groups[0].jobs[0], hostname, 
+            str(datetime.now().time()))
+    else:
+        email_subject = "ERROR: {0} distinct errors in {1} SCCM jobs in "\
+            "{2}".format(len(groups), len(job_names), hostname)
+    return email_subject, error_digest.format_digest(groups, "\n\r")
+
+
+def notify(problems):
+    '''
+        Send one email with all the problems found (a list of (subject, 
+        body)). A single problem keeps its own subject. Returns False if 
+        the email could not be queued.
+    '''
+    if not problems:
+        return True
+    log.info("Sending notification email...")
+    if len(problems) == 1:
+        email_subject, error_body = problems[0]
+    else:
+        email_subject = "ERROR: {0} problems found in the SCCM jobs in "\
+            "{1}".format(len(problems), hostname)
+        error_body = "\n\r\n\r".join("{0}\n\r{1}".format(subject, body) 
+            for subject, body in problems)
+    # (Queued, and sent in the background.)
+    return emailer.queue_email(distribution_group, email_subject, email_from, 
+        error_body, None)
+
+
+def load_jobs(arguments):
+    '''
+        Get the active jobs of the jobfiles named in arguments. Returns the 
+        job names, the log directory of every job, and the problems found 
+        (as (email subject, email body)).
+    '''
+    jobfile_cache = JobFileCache(jobfile_cache_file)
+    problems = []
+    # The jobs to check, and the log directory of every job.
+    job_names = []
+    job_log_dirs = {}
     # Get the list of arguments (i.e. the jobs to check).
     for argument in arguments:
         job_file = os.path.join(job_file_dir, argument) + ".xml"
@@ -139,107 +683,194 @@ def main(arguments):
         # If the XML is malformed, that could mean that we have problems.
         # (Sometimes the jobs fail and are unable to create a proper XML log)
         try:
-            tree = ET.parse(job_file)
-            root = tree.getroot()
-            # SCCM job_files use namespaces, hence they needed to be added here.
-            for job in root.findall("{http://www.ibm.com/TUAMJobs.xsd}Job"):
-                # Look for the content of the "Job id" tag.
-                # (Get only the jobs that have an "active" tag on them).
-                if job.get("active") == "true":
-                    list_of_job_names.append(job.get("id"))
+            for job in jobfile_cache.get_jobs(job_file):
+                if job["id"] not in job_log_dirs:
+                    job_names.append(job["id"])
+                    job_log_dirs[job["id"]] = job["log_dir"]
         except Exception as exception:
             email_subject = "ERROR: Malformed XML job file."
             error_body = "The file {0} contains malformed XML: "\
                 "{1}".format(job_file, exception)
             log.error(error_body)
-            emailer.build_email(distribution_group, email_subject, email_from, 
-                error_body, None)
-
-        for job_name in list_of_job_names:
-            absolute_job_file = os.path.join(log_path, job_name)
-            # Check if any of the log paths are invalid directories.
-            if os.path.exists(absolute_job_file):
-                # Validate that we have at least one log file to work with.
-                if len(glob.glob(absolute_job_file + "/*.xml")) > 0:
-                    # Get the newest log in the directory
-                    newest_log = max(glob.iglob(absolute_job_file + "/*.xml"),
-                        key=os.path.getctime)
-                    # If the newest log file was created more than, say, 10 
-                    # minutes ago, we will assume the startJobRunner.sh script 
-                    # failed and did not create a proper log file, in which 
-                    # case we may be missing data, so let's send a notification 
-                    # email.
-                    if ((time.time() - os.path.getctime(newest_log)) >
-                        MAX_AGE_OF_LAST_LOG_FILE):
-                        # The newest file is older than 10 minutes.
-                        email_subject = "ERROR: Missing {0} log file in "\
-                            "{1}".format(job_name, hostname)
-                        error_body = "At {0}, a recent log file was not "\
-                            "found for the {1} job.\n\rThis may "\
-                            "indicate a malfunction in startJobRunner.sh."\
-                            "\n\rCheck the console logs located in "\
-                            "/tmp/logs/sccm/.".format(datetime.now(), job_name)
-                        log.error(error_body)
-                        emailer.build_email(distribution_group, email_subject, 
-                            email_from, error_body, None)
-                        sys.exit(2)
-
-                    # Make a list with all the valid log files.
-                    list_of_log_files.append(newest_log)
-                else:
-                    log.error("No XML logs found in "\
-                        "{0}".format(absolute_job_file))
-            else:
-                log.error("The path {0} does not exist. Verify the "\
-                    "arguments.".format(absolute_job_file))
-
-    for log_file in list_of_log_files:
-        error_message = []
-        error_found = False
+            problems.append((email_subject, error_body))
+    jobfile_cache.save()
+    return job_names, job_log_dirs, problems
+
+
+def watch(job_names, job_log_dirs, interval, suppression):
+    '''
+        Long-running watch mode. The log directory of every job is watched 
+        with inotify, and every log is scanned for new errors as soon as it 
+        is closed after writing (or moved into place). Every job has a timer 
+        in a timer wheel, which is pushed back to interval (plus 
+        MAX_AGE_OF_LAST_LOG_FILE) seconds after each of its logs: if it 
+        expires, the job did not create its log in time and that is 
+        reported (again after every interval, until a log shows up).
+        The errors found at the same time are reported in one digest.
+    '''
+    watcher = inotify_watcher.InotifyWatcher()
+    wheel = timer_wheel.TimerWheel(WHEEL_RESOLUTION, now=time.time())
+    ledger = load_ledger()
+    # The jobs that write their logs in every watched directory.
+    dir_jobs = {}
+    problems = []
+    errors = []
+
+    def expect_log(log_dir, log_time):
+        for job_name in dir_jobs[log_dir]:
+            wheel.schedule(job_name, 
+                log_time + interval + MAX_AGE_OF_LAST_LOG_FILE)
+
+    def rescan(log_dir):
+        # Scan the newest log of log_dir (in case its events were missed).
         try:
-            tree = ET.parse(log_file)
-            root = tree.getroot()
-        except Exception as exception:
-            email_subject = "ERROR: Malformed XML log."
-            error_body = "The file {0} contains malformed XML: "\
-                "{1}".format(log_file, exception)
-            log.error(error_body)
-            emailer.build_email(distribution_group, email_subject, email_from, 
-                error_body, None)
-
-        # Get the name of the failed job (from the log file).
-        job_name = root.find("./Job").get("name")
-
-        # Get the error output messages.
-        # Since the error messages could be in any part of the XML structure,
-        # we use the // notation for finding any occurrence of them
-        # (.// Selects all subelements, on all levels beneath the 
-        # current element.)
-        for message in root.findall(".//message"):
-            if message.get("type").strip() == "ERROR":
-                error_message.append("Timestamp: {0} Message: "\
-                    "{1}".format(message.get("time"), message.text))
-                error_found = True
-
-        # Send an email to the distribution list.
-        if error_found:
-            log.info("Sending notification email...")
-            email_subject = "The {0} job failed in the server {1} at "\
-                "{2}".format(job_name, hostname, str(datetime.now().time()))
-            error_message_string = "\n\r".join(error_message)
-            emailer.build_email(distribution_group, email_subject, email_from, 
-                error_message_string, None)
+            newest_log, newest_ctime, index_entry = find_newest_log(log_dir)
+        except OSError as exception:
+            log.error("Unable to read {0}: {1}".format(log_dir, exception))
+            return
+        if newest_log is None:
+            return
+        if newest_ctime > time.time() - interval:
+            expect_log(log_dir, newest_ctime)
+        result = check_log(new_result(dir_jobs[log_dir][0]), newest_log, 
+            ledger)
+        update_ledger(ledger, result)
+        problems.extend(result["problems"])
+        errors.extend(result["errors"])
+
+    for job_name in job_names:
+        log_dir = job_log_dirs[job_name]
+        if log_dir not in dir_jobs:
+            try:
+                watcher.add_watch(log_dir, LOG_EVENTS)
+            except OSError as exception:
+                log.error("Unable to watch {0}: {1}".format(log_dir, 
+                    exception))
+                continue
+            dir_jobs[log_dir] = []
+        dir_jobs[log_dir].append(job_name)
+        # The first timer of a job: a whole interval from now.
+        wheel.schedule(job_name, 
+            time.time() + interval + MAX_AGE_OF_LAST_LOG_FILE)
+    for log_dir in dir_jobs:
+        rescan(log_dir)
+
+    log.info("Watching the logs of {0} jobs in {1} directories".format(
+        len(wheel), len(dir_jobs)))
+
+    try:
+        while True:
+            if problems or errors:
+                digest = digest_problem(errors, suppression)
+                if digest is not None:
+                    problems.append(digest)
+                save_ledger(ledger)
+                notify(problems)
+                problems = []
+                errors = []
+
+            for path, mask, name in watcher.read_events(
+                timeout=WHEEL_RESOLUTION):
+                if mask & inotify_watcher.IN_Q_OVERFLOW:
+                    # Some events were lost, look at every directory.
+                    log.warning("inotify queue overflow, rescanning.")
+                    for log_dir in dir_jobs:
+                        rescan(log_dir)
+                elif path in dir_jobs and name.endswith(".xml"):
+                    expect_log(path, time.time())
+                    log_file = os.path.join(path, name)
+                    result = check_log(new_result(dir_jobs[path][0]), 
+                        log_file, ledger)
+                    update_ledger(ledger, result)
+                    problems.extend(result["problems"])
+                    errors.extend(result["errors"])
+
+            now = time.time()
+            for job_name in wheel.advance(now):
+                problems.append(stale_job_problem(job_name))
+                wheel.schedule(job_name, now + interval)
+    finally:
+        watcher.close()
+
+
+def main(arguments, jobs=1, interval=None, 
+    suppress_minutes=DEFAULT_SUPPRESSION_MINUTES):
+    '''
+        Check the jobs of the jobfiles named in arguments once (or, if 
+        interval is given, keep watching their logs).
+    '''
+    # Everything that should be reported, as (email subject, email body).
+    job_names, job_log_dirs, problems = load_jobs(arguments)
+    suppression = error_digest.SuppressionStore(digest_state_file, 
+        suppress_minutes * 60)
+    if interval is not None:
+        notify(problems)
+        watch(job_names, job_log_dirs, interval, suppression)
+        return
+
+    # Check all the jobs, then report everything at once.
+    ledger = load_ledger()
+    index = read_json_file(newest_log_index_file, "newest-log index")
+    errors = []
+    results = run_job_checks([(job_name, job_log_dirs[job_name], ledger, 
+        index.get(job_log_dirs[job_name])) for job_name in job_names], jobs)
+    for result in results:
+        if result["index"] is not None:
+            index[job_log_dirs[result["job"]]] = result["index"]
+        update_ledger(ledger, result)
+        problems.extend(result["problems"])
+        errors.extend(result["errors"])
+    digest = digest_problem(errors, suppression)
+    if digest is not None:
+        problems.append(digest)
+    # (Saved before the email is sent, so a failure to send it does not 
+    # make the next execution scan the same logs again.)
+    save_ledger(ledger)
+    write_json_file(newest_log_index_file, index, "newest-log index")
+    if not notify(problems):
+        sys.exit(1)
+
+    stale_jobs = [result["job"] for result in results if result["stale"]]
+    if stale_jobs:
+        log.error("No recent log file for: {0}".format(", ".join(stale_jobs)))
+        sys.exit(2)
 
 
 def get_args(argv):
     parser = argparse.ArgumentParser(description="Analyze SCCM logs.")
+    parser.add_argument("-j", "--jobs",
+        help = "Number of worker processes used to check the jobs "\
+            "concurrently. Defaults to 1.",
+        dest = "jobs",
+        default = 1,
+        type = int)
+    parser.add_argument("-w", "--watch",
+        help = "Keep running, scanning every log as soon as it is written "\
+            "and reporting the jobs without a recent log.",
+        dest = "watch",
+        default = False,
+        action = "store_true")
+    parser.add_argument("-i", "--interval",
+        help = "In watch mode, the seconds expected between two logs of a "\
+            "job. Defaults to {0}.".format(DEFAULT_LOG_INTERVAL),
+        dest = "interval",
+        default = DEFAULT_LOG_INTERVAL,
+        type = int)
+    parser.add_argument("-s", "--suppress",
+        help = "Minutes during which an error that was reported is not "\
+            "reported again. 0 reports every error. Defaults to {0}.".format(
+            DEFAULT_SUPPRESSION_MINUTES),
+        dest = "suppress_minutes",
+        default = DEFAULT_SUPPRESSION_MINUTES,
+        type = int)
     parser.add_argument("arguments", metavar="N", type=str, nargs="+",
         help="The job name.")
     args = parser.parse_args()
-    main(args.arguments)
+    main(args.arguments, args.jobs, args.interval if args.watch else None, 
+        args.suppress_minutes)
 
 
 if __name__ == "__main__":
     # Parse arguments from the CLI.
     get_args(sys.argv[1:])
-exit(0)
+    exit(0)
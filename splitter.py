@@ -44,8 +44,8 @@ import os
 # Needed for system and environment information.
 import sys
 
-# For reading the configuration file.
-import json
+# For reading the configuration file (refer to config_loader.py)
+import config_loader
 
 # Handling arguments.
 import argparse
@@ -81,24 +81,21 @@ def main(log_date, input_file, prod_output_file, non_prod_output_file):
     # Open and parse the configuration file.
     try:
         log.info("Parsing config file {0}".format(config_file))
-        config = json.load(open(config_file, "r+"))
+        config = config_loader.load(config_file, 
+            config_loader.compile_regions)
 
         # Read every record and classify it for prod or non-prod 
         # (according to the lists in the config file).
-        for region in config["regions"]:
-            if region["type"] == "prod":
-                for subregion in region["regions"]:
-                    # If "date" is before TODAY, send the region to the 
-                    # non-prod list. Otherwise, it means it is prod and it is 
-                    # active now, so let's add it to the prod list.
-                    if datetime.strptime(subregion["date"], '%Y-%m-%d').date() \
-                        <= log_date:
-                        prod_list.append(subregion["name"])
-                    else:
-                        non_prod_list.append(subregion["name"])
+        for name, prod_date in config["prod"]:
+            # If "date" is before TODAY, send the region to the 
+            # non-prod list. Otherwise, it means it is prod and it is 
+            # active now, so let's add it to the prod list.
+            # (The dates are YYYY-MM-DD, so they compare as strings.)
+            if prod_date <= log_date.isoformat():
+                prod_list.append(name)
             else:
-                for subregion in region["regions"]:
-                    non_prod_list.append(subregion["name"])
+                non_prod_list.append(name)
+        non_prod_list.extend(config["non_prod"])
 
     except Exception as exception:
         log.exception("Error parsing configuration file {0} \nException: "\
@@ -137,8 +134,9 @@ def main(log_date, input_file, prod_output_file, non_prod_output_file):
                 # any false positives or false negatives. I 
                 # recommend much testing here.
                 for prod_item in prod_list:
-                    if (found_in_record == False) and (prod_item in record):
+                    if prod_item in record:
                         found_in_record = True
+                        break
 
                 # Write the records to their respective files.
                 try:
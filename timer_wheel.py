@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+'''
+    Usage:
+        import timer_wheel
+
+        wheel = timer_wheel.TimerWheel(resolution=10)
+        wheel.schedule("Nightly", time.time() + 3600)
+        ...
+        for key in wheel.advance(time.time()):
+            # The timer of key expired.
+            ...
+
+    Description:
+        A hashed timer wheel for the long-running (watch) modes: a ring of
+        slots, each one covering resolution seconds, where every timer is
+        kept in the slot of its deadline. Scheduling and cancelling a timer
+        is O(1), and advancing the wheel only looks at the slots of the time
+        that passed (not at every timer).
+        Every key has at most one active timer: scheduling a key again
+        replaces its timer. Replaced and cancelled timers are dropped from
+        their slots when the wheel gets to them.
+        Timers further away than one turn of the wheel stay in their slot
+        until the turn of their deadline.
+'''
+
+class TimerWheel(object):
+    '''
+        Timers (key -> deadline, in seconds since the Epoch) grouped in
+        slots of resolution seconds.
+    '''
+    def __init__(self, resolution=1.0, slots=4096, now=0):
+        self.resolution = float(resolution)
+        self.slots = [[] for slot in range(slots)]
+        # The tick (time // resolution) the wheel was last advanced to.
+        self.current_tick = int(now // self.resolution)
+        # The deadline of the active timer of every key.
+        self.timers = {}
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def schedule(self, key, deadline):
+        '''
+            Make key expire at deadline (replacing its previous timer, if
+            any). A deadline in the past expires on the next advance().
+        '''
+        self.timers[key] = deadline
+        tick = max(int(deadline // self.resolution), self.current_tick)
+        self.slots[tick % len(self.slots)].append((deadline, key))
+
+    def cancel(self, key):
+        '''
+            Forget the timer of key (if any).
+        '''
+        self.timers.pop(key, None)
+
+    def deadline(self, key):
+        return self.timers.get(key)
+
+    def advance(self, now):
+        '''
+            Move the wheel up to now and return the keys whose timers
+            expired (in the order of their slots).
+        '''
+        expired = []
+        target_tick = int(now // self.resolution)
+        # After a long pause, a single turn of the wheel sees every slot.
+        if target_tick - self.current_tick >= len(self.slots):
+            self.current_tick = target_tick - len(self.slots) + 1
+        while True:
+            index = self.current_tick % len(self.slots)
+            pending = []
+            for deadline, key in self.slots[index]:
+                if self.timers.get(key) != deadline:
+                    # Cancelled or rescheduled.
+                    continue
+                if deadline <= now:
+                    del self.timers[key]
+                    expired.append(key)
+                else:
+                    # A later turn of the wheel (or later in this slot).
+                    pending.append((deadline, key))
+            self.slots[index] = pending
+            # The current slot is looked at again on the next call, it may
+            # still have timers that expire later in its time.
+            if self.current_tick >= target_tick:
+                break
+            self.current_tick += 1
+        return expired